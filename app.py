@@ -1,30 +1,68 @@
-from flask import Flask, request, jsonify, send_from_directory
+import time
+STARTUP_BEGAN = time.perf_counter()  # start of the startup-time report
+
+from flask import Flask, request, jsonify, g
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import pandas as pd
 import numpy as np
 import io
+import mimetypes
 import threading
 import hashlib
+import hmac
 import secrets
+import sqlite3
 from datetime import datetime, timedelta
 import logging
 import os
 import re
+import shutil
+import tempfile
 import bcrypt
-from sklearn.ensemble import RandomForestClassifier, GradientBoostingRegressor
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
-from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
-from scipy import stats
+from openpyxl import load_workbook
+import sys
+import functools
+import tracemalloc
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import base64
+import bisect
+import heapq
+import itertools
+import gzip
+import json
 import warnings
 warnings.filterwarnings('ignore')
 
+# scikit-learn and joblib are imported by load_ml() on first AI use (or at startup with PRELOAD_ML=1)
+sklearn = joblib = None
+GradientBoostingRegressor = IsolationForest = KMeans = StandardScaler = silhouette_score = None
+
+# Optional accelerators: orjson for response encoding, brotli for compression
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+IMPORTS_DONE = time.perf_counter()
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-app = Flask(__name__, static_folder=BASE_DIR)
+app = Flask(__name__, static_folder=None)  # front-end files are served from StaticAssetManifest
 app.config['MAX_CONTENT_LENGTH'] = 100 * 1024 * 1024
 
 # CORS Configuration for Production
@@ -32,37 +70,217 @@ ALLOWED_ORIGINS = os.environ.get('ALLOWED_ORIGINS', '*').split(',')
 CORS(app, 
      resources={r"/*": {
          "origins": ALLOWED_ORIGINS,
-         "methods": ["GET", "POST", "OPTIONS"],
-         "allow_headers": ["Content-Type", "X-Session-Token"],
+         "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"],
+         "allow_headers": ["Content-Type", "X-Session-Token", "X-Profile", "X-Chunk-SHA256"],
          "expose_headers": ["X-Session-Token"],
          "supports_credentials": False
      }})
 
+class InstrumentedLock:
+    """
+    threading.Lock wrapper that records how long callers wait to acquire it
+    and how long it is held. Counters are only updated by the thread that
+    holds the lock, so they need no extra synchronisation.
+    """
+    WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._acquired_at = 0.0
+        self.acquisitions = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.hold_seconds = 0.0
+        self.max_hold_seconds = 0.0
+        self.wait_counts = [0] * (len(self.WAIT_BUCKETS) + 1)
+        self.hold_counts = [0] * (len(self.WAIT_BUCKETS) + 1)
+    
+    def acquire(self, blocking=True, timeout=-1):
+        started = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired_at = time.perf_counter()
+            waited = self._acquired_at - started
+            self.acquisitions += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+            self.wait_counts[bisect.bisect_left(self.WAIT_BUCKETS, waited)] += 1
+        return acquired
+    
+    def release(self):
+        held = time.perf_counter() - self._acquired_at
+        self.hold_seconds += held
+        self.max_hold_seconds = max(self.max_hold_seconds, held)
+        self.hold_counts[bisect.bisect_left(self.WAIT_BUCKETS, held)] += 1
+        self._lock.release()
+    
+    def locked(self):
+        return self._lock.locked()
+    
+    def __enter__(self):
+        self.acquire()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.release()
+    
+    def stats(self):
+        """Counter snapshot, read without taking the lock (may be a moment stale)."""
+        return {
+            'acquisitions': self.acquisitions,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'hold_seconds': self.hold_seconds,
+            'max_hold_seconds': self.max_hold_seconds,
+            'wait_buckets': list(zip(self.WAIT_BUCKETS + (float('inf'),), self.wait_counts)),
+            'hold_buckets': list(zip(self.WAIT_BUCKETS + (float('inf'),), self.hold_counts))
+        }
+
+
 # Session & Storage with enhanced security
-sessions = {}
+sessions = {}  # token id -> issued session; only login, logout and the reaper touch it
 files = {}
 analytics_cache = {}
+dataset_indexes = {}
 progress = {}
-lock = threading.Lock()
+lock = InstrumentedLock()
 login_attempts = {}  # Track failed login attempts for rate limiting
+sessions_per_ip = {}  # ip -> live session count, enforces MAX_SESSIONS_PER_IP
+revoked_tokens = {}   # token id -> expiry of a logged-out token, kept until it would have expired
+file_leases = {}      # file_id -> when its data may be dropped (latest expiry of the sessions using it)
+file_cache_keys = {}  # file_id -> analytics_cache/dataset_indexes keys derived from it
+chunked_uploads = {}  # upload id -> ChunkedUpload still being assembled
 
 # Security settings
 SESSION_TIMEOUT = timedelta(hours=2)
-MAX_SESSIONS_PER_IP = 5
+MAX_SESSIONS_PER_IP = int(os.environ.get('MAX_SESSIONS_PER_IP', 5))
 MAX_LOGIN_ATTEMPTS = 5
 LOGIN_ATTEMPT_TIMEOUT = 15 * 60  # 15 minutes
+REAPER_MAX_SLEEP = 60  # seconds; the reaper also wakes when an earlier deadline is scheduled
+
+# Session tokens are HMAC-signed and verified without touching shared state. Set
+# SESSION_SECRET so tokens survive restarts and are accepted by every worker
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '').encode() or secrets.token_bytes(32)
+SESSION_TOKEN_VERSION = 'v1'
+SESSION_BIND_IP = os.environ.get('SESSION_BIND_IP', '1') == '1'
+if not os.environ.get('SESSION_SECRET'):
+    logger.info("SESSION_SECRET not set: using a per-process key, sessions end on restart")
+
+# bcrypt runs on its own small pool; logins beyond workers + queue are turned away
+LOGIN_HASH_WORKERS = int(os.environ.get('LOGIN_HASH_WORKERS', 2))
+LOGIN_QUEUE_LIMIT = int(os.environ.get('LOGIN_QUEUE_LIMIT', 16))
+login_hash_executor = ThreadPoolExecutor(max_workers=LOGIN_HASH_WORKERS, thread_name_prefix='bcrypt')
+login_slots = threading.BoundedSemaphore(LOGIN_HASH_WORKERS + LOGIN_QUEUE_LIMIT)
+
+# Trained AI models are persisted here and reused across /ai-analyze calls
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(BASE_DIR, '.model_cache'))
+MODEL_CACHE_MAX_BYTES = int(os.environ.get('MODEL_CACHE_MAX_MB', 256)) * 1024 * 1024
+MODEL_CACHE_MEMORY_ENTRIES = 8
+
+# Anomaly detection: thresholds, chunking and paging of flagged rows
+ANOMALY_Z_THRESHOLD = 3.0
+ANOMALY_MAD_THRESHOLD = 3.5
+ANOMALY_CHUNK_ROWS = 65536
+ANOMALY_IFOREST_SAMPLE_ROWS = 20000
+ANOMALY_IFOREST_CONTAMINATION = 0.01
+ANOMALY_PAGE_SIZE = 100
+ANOMALY_MAX_PAGE_SIZE = 1000
+
+# Large-data /ai-analyze mode: exact streamed aggregates + reservoir-sampled models
+AI_LARGE_DATA_BYTES = int(os.environ.get('AI_LARGE_DATA_MB', 25)) * 1024 * 1024
+AI_SAMPLE_ROWS = int(os.environ.get('AI_SAMPLE_ROWS', 50000))
+AI_SAMPLE_MAX_ROWS = max(int(os.environ.get('AI_SAMPLE_MAX_ROWS', 200000)), AI_SAMPLE_ROWS)  # cap on sample_size
+STREAM_CHUNK_ROWS = 20000
+
+# Parsed sheets and column projections of them kept in memory, newest first out last
+FRAME_CACHE_MAX_BYTES = int(os.environ.get('FRAME_CACHE_MAX_MB', 256)) * 1024 * 1024
+
+# Filter engine: width of the rating buckets indexed for /query
+RATING_INDEX_BUCKET_WIDTH = 0.5
+QUERY_DEFAULT_TOP_N = 10
+QUERY_MAX_TOP_N = 100
+
+# Worker pool shared by the independent /ai-analyze stages
+AI_STAGE_WORKERS = int(os.environ.get('AI_STAGE_WORKERS', 4))
+ai_stage_executor = ThreadPoolExecutor(max_workers=AI_STAGE_WORKERS, thread_name_prefix='ai-stage')
+
+# Background jobs: bounded workers, interactive work ahead of batch, round-robin
+# between sessions within a class. Job state is kept in SQLite so queued work
+# survives a restart; inputs of unfinished jobs are spooled next to it
+JOB_DIR = os.environ.get('JOB_DIR', os.path.join(BASE_DIR, '.jobs'))
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETENTION = timedelta(hours=24)
+JOB_LIST_LIMIT = 50
+JOB_INTERACTIVE = 0
+JOB_BATCH = 1
+JOB_PRIORITY_NAMES = {JOB_INTERACTIVE: 'interactive', JOB_BATCH: 'batch'}
+
+# Uploads are spooled to disk chunk by chunk and parsed from there (never held whole in memory)
+UPLOAD_DIR = os.environ.get('UPLOAD_DIR', os.path.join(JOB_DIR, 'uploads'))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+UPLOAD_SNIFF_BYTES = 512
+# Warm restart: uploads, parsed sheets and analysis results kept on disk by content hash ('' disables)
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR', os.path.join(JOB_DIR, 'snapshots'))
+SNAPSHOT_MAX_BYTES = int(os.environ.get('SNAPSHOT_MAX_MB', 1024)) * 1024 * 1024
+SNAPSHOT_RETENTION = timedelta(hours=int(os.environ.get('SNAPSHOT_RETENTION_HOURS', 72)))
+# Trend history: per-period sufficient statistics of tagged uploads ('' keeps them in memory only)
+PERIOD_DB = os.environ.get('PERIOD_DB', os.path.join(JOB_DIR, 'periods.sqlite3'))
+PERIOD_FORECAST_MAX = 8
+PERIOD_TREND_ORDERS = ('growth', 'decline', 'name', 'latest')
+# Two-sided 95% Student t quantiles for 1..10 degrees of freedom (normal beyond)
+T_QUANTILES_975 = (12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262, 2.228)
+# /compare: Welch t-test level for "significant" changes between two uploads
+COMPARE_ALPHA = 0.05
+COMPARE_ORDERS = ('delta', 'improved', 'declined', 'rank_change', 'p_value', 'name')
+CHUNKED_UPLOAD_CHUNK_SIZE = int(os.environ.get('CHUNKED_UPLOAD_CHUNK_SIZE', 4 * 1024 * 1024))  # suggested to clients
+
+# Response encoding: compression negotiated by Accept-Encoding, cursor paging of long lists
+RESPONSE_COMPRESS_MIN_BYTES = 1024
+RESPONSE_GZIP_LEVEL = 6
+RESPONSE_BROTLI_QUALITY = 5
+COMPRESSIBLE_MIMETYPES = {'application/json', 'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript'}
+DEPT_DETAILS_PAGE_SIZE = 50
+CHART_LABELS_PAGE_SIZE = 500
+MAX_RESPONSE_PAGE_SIZE = 5000
+
+# Conditional requests: results are immutable per content-hashed file_id, so they
+# carry strong ETags. Browser/proxy caches may store them but must revalidate, so
+# every hit still passes the session check before a 304 is returned
+RESULT_FORMAT_VERSION = 1  # bump when a cached endpoint's response format changes
+ANALYTICS_CACHE_CONTROL = os.environ.get('ANALYTICS_CACHE_CONTROL', 'no-cache')
+
+# Front-end files: fingerprinted and precompressed once at startup
+STATIC_ASSETS = ('index.html', 'script.js', 'styles.css')
+STATIC_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+STATIC_REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# Instrumentation: /metrics in Prometheus text format. Peak memory per stage needs
+# tracemalloc, which slows allocation-heavy code, so it is opt-in
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC') == '1'  # explicit opt-in to unauthenticated scrapes
+METRICS_TRACE_MEMORY = os.environ.get('METRICS_TRACE_MEMORY') == '1'
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Sampling profiler: off unless a request sends X-Profile: 1 (admin session), the
+# admin toggle is on, or PROFILE_SLOW_MS is set (then eligible requests are sampled
+# and kept only when slower than the threshold)
+PROFILE_ROUTES = tuple(r for r in os.environ.get('PROFILE_ROUTES', '/upload,/analyze-custom,/ai-analyze').split(',') if r)
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))
+PROFILE_INTERVAL_MS = float(os.environ.get('PROFILE_INTERVAL_MS', 10))
+PROFILE_RING_SIZE = int(os.environ.get('PROFILE_RING_SIZE', 20))
+PROFILE_MAX_STACKS = 20000  # distinct stacks kept per profile; the rest count as [truncated]
 
 # Default credentials (hash bcrypt for secure storage)
 # Username: admin, Password: admin123456
+# The default hash is precomputed so no bcrypt round runs at import; generate your
+# own with `python app.py --hash-password` and pass it as ADMIN_PASSWORD_HASH
 DEFAULT_USERNAME = os.environ.get('ADMIN_USERNAME', 'admin')
-DEFAULT_PASSWORD_HASH = os.environ.get('ADMIN_PASSWORD_HASH', '$2b$12$Xvq6wFhYjcT3L3V5K6Q5q.R3Q5K5Q5K5Q5K5Q5K5Q5K5Q5K5Q5Q5')  # bcrypt hash of 'admin123456'
+DEFAULT_PASSWORD_HASH = os.environ.get('ADMIN_PASSWORD_HASH', '$2b$12$lv1WK.uLwXztTu5pBOZnyOm6Pg6fgxsafSgyZ5iKJV4hQpPPBNSXy')  # bcrypt hash of 'admin123456'
 
-# If password hash not set, generate one
-if DEFAULT_PASSWORD_HASH == '$2b$12$Xvq6wFhYjcT3L3V5K6Q5q.R3Q5K5Q5K5Q5K5Q5K5Q5K5Q5K5Q5Q5':
-    try:
-        DEFAULT_PASSWORD_HASH = bcrypt.hashpw(b'admin123456', bcrypt.gensalt()).decode()
-    except:
-        logger.warning("bcrypt not available, using default hash")
+# Startup: PRELOAD_ML=1 imports scikit-learn while the app loads (with gunicorn
+# --preload that happens once in the master and workers share the pages)
+PRELOAD_ML = os.environ.get('PRELOAD_ML') == '1'
 
 SAUDI_REGIONS = {
     'الرياض': {'lat': 24.7136, 'lng': 46.6753, 'color': '#00d9ff'},
@@ -81,6 +299,717 @@ SAUDI_REGIONS = {
 }
 
 
+# ============= INSTRUMENTATION =============
+
+class _MemoryWindow:
+    __slots__ = ('base', 'peak')
+    
+    def __init__(self, base):
+        self.base = base
+        self.peak = base
+
+
+class MetricsRegistry:
+    """
+    In-process metrics rendered in Prometheus text format.
+
+    Pipeline stages record wall time, CPU time of the executing thread and,
+    when tracemalloc is tracing, the peak traced memory above the stage's
+    starting point (process-wide, so concurrent stages are included).
+    Requests record latency per route. Global-lock figures come from the
+    InstrumentedLock counters.
+    """
+    
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = tuple(buckets)
+        self.stages = {}
+        self.requests = {}
+        self.responses = {}
+        self._windows = []
+    
+    def _histogram(self):
+        return {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0}
+    
+    def _observe(self, histogram, value):
+        histogram['counts'][bisect.bisect_left(self.buckets, value)] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+    
+    def _fold_peak(self):
+        # Caller holds self._lock. reset_peak is global, so every open window
+        # takes the peak reached so far before it is reset
+        current, peak = tracemalloc.get_traced_memory()
+        for window in self._windows:
+            window.peak = max(window.peak, peak)
+        tracemalloc.reset_peak()
+        return current
+    
+    def _open_window(self):
+        if not tracemalloc.is_tracing():
+            return None
+        with self._lock:
+            window = _MemoryWindow(self._fold_peak())
+            self._windows.append(window)
+        return window
+    
+    def _close_window(self, window):
+        with self._lock:
+            self._fold_peak()
+            self._windows = [w for w in self._windows if w is not window]
+        return window.peak - window.base
+    
+    @contextmanager
+    def stage(self, name):
+        """Time a pipeline stage: `with metrics.stage('excel_parse'): ...`"""
+        window = self._open_window()
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        failed = False
+        try:
+            yield
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            wall = time.perf_counter() - wall_started
+            cpu = time.thread_time() - cpu_started
+            peak = self._close_window(window) if window is not None else None
+            with self._lock:
+                entry = self.stages.get(name)
+                if entry is None:
+                    entry = self.stages[name] = {'wall': self._histogram(), 'cpu': 0.0, 'errors': 0, 'peak_bytes': None}
+                self._observe(entry['wall'], wall)
+                entry['cpu'] += cpu
+                entry['errors'] += failed
+                if peak is not None:
+                    entry['peak_bytes'] = max(entry['peak_bytes'] or 0, peak)
+    
+    def observe_request(self, route, method, status, seconds):
+        with self._lock:
+            histogram = self.requests.get((route, method))
+            if histogram is None:
+                histogram = self.requests[(route, method)] = self._histogram()
+            self._observe(histogram, seconds)
+            key = (route, method, str(status))
+            self.responses[key] = self.responses.get(key, 0) + 1
+    
+    @staticmethod
+    def _labels(**labels):
+        def escape(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels.items()) + '}'
+    
+    def _render_histogram(self, lines, name, bounds, counts, total, count, **labels):
+        cumulative = 0
+        for bound, n in zip(tuple(bounds) + (float('inf'),), counts):
+            cumulative += n
+            le = '+Inf' if bound == float('inf') else repr(float(bound))
+            lines.append(f'{name}_bucket{self._labels(**labels, le=le)} {cumulative}')
+        label_text = self._labels(**labels) if labels else ''
+        lines.append(f'{name}_sum{label_text} {total!r}')
+        lines.append(f'{name}_count{label_text} {count}')
+    
+    def render(self, lock_stats=None):
+        lines = []
+        with self._lock:
+            stages = {name: dict(entry, wall=dict(entry['wall'], counts=list(entry['wall']['counts'])))
+                      for name, entry in self.stages.items()}
+            requests = {key: dict(h, counts=list(h['counts'])) for key, h in self.requests.items()}
+            responses = dict(self.responses)
+        
+        lines += ['# HELP hr_stage_duration_seconds Wall time of pipeline stages.',
+                  '# TYPE hr_stage_duration_seconds histogram']
+        for name, entry in sorted(stages.items()):
+            h = entry['wall']
+            self._render_histogram(lines, 'hr_stage_duration_seconds', self.buckets, h['counts'], h['sum'],
+                                   h['count'], stage=name)
+        lines += ['# HELP hr_stage_cpu_seconds_total CPU time of the thread running each stage.',
+                  '# TYPE hr_stage_cpu_seconds_total counter']
+        lines += [f'hr_stage_cpu_seconds_total{self._labels(stage=n)} {e["cpu"]!r}' for n, e in sorted(stages.items())]
+        lines += ['# HELP hr_stage_errors_total Stages that raised.',
+                  '# TYPE hr_stage_errors_total counter']
+        lines += [f'hr_stage_errors_total{self._labels(stage=n)} {e["errors"]}' for n, e in sorted(stages.items())]
+        lines += ['# HELP hr_stage_peak_memory_bytes Largest traced memory peak above the stage start '
+                  '(METRICS_TRACE_MEMORY=1).',
+                  '# TYPE hr_stage_peak_memory_bytes gauge']
+        lines += [f'hr_stage_peak_memory_bytes{self._labels(stage=n)} {e["peak_bytes"]}'
+                  for n, e in sorted(stages.items()) if e['peak_bytes'] is not None]
+        
+        lines += ['# HELP hr_http_request_duration_seconds Request latency per route.',
+                  '# TYPE hr_http_request_duration_seconds histogram']
+        for (route, method), h in sorted(requests.items()):
+            self._render_histogram(lines, 'hr_http_request_duration_seconds', self.buckets, h['counts'], h['sum'],
+                                   h['count'], route=route, method=method)
+        lines += ['# HELP hr_http_requests_total Responses per route and status.',
+                  '# TYPE hr_http_requests_total counter']
+        lines += [f'hr_http_requests_total{self._labels(route=r, method=m, status=s)} {n}'
+                  for (r, m, s), n in sorted(responses.items())]
+        
+        if lock_stats is not None:
+            bounds = [b for b, _ in lock_stats['wait_buckets']][:-1]
+            for kind in ('wait', 'hold'):
+                lines += [f'# HELP hr_lock_{kind}_seconds Global lock {kind} time per acquisition.',
+                          f'# TYPE hr_lock_{kind}_seconds histogram']
+                counts = [n for _, n in lock_stats[f'{kind}_buckets']]
+                self._render_histogram(lines, f'hr_lock_{kind}_seconds', bounds, counts,
+                                       lock_stats[f'{kind}_seconds'], sum(counts))
+                lines += [f'# TYPE hr_lock_max_{kind}_seconds gauge',
+                          f'hr_lock_max_{kind}_seconds {lock_stats[f"max_{kind}_seconds"]!r}']
+        
+        with lock:
+            gauges = {'hr_sessions_active': len(sessions), 'hr_files_stored': len(files),
+                      'hr_analytics_cached': len(analytics_cache), 'hr_login_attempts_tracked': len(login_attempts),
+                      'hr_chunked_uploads_active': len(chunked_uploads), 'hr_frame_cache_bytes': frame_cache_bytes}
+        gauges['hr_expiry_pending'] = reaper.pending()
+        jobs = job_scheduler.stats()
+        gauges['hr_jobs_running'] = jobs['running']
+        lines += ['# TYPE hr_jobs_queued gauge']
+        lines += [f'hr_jobs_queued{self._labels(priority=p)} {n}' for p, n in jobs['queued'].items()]
+        lines += ['# HELP hr_startup_seconds Time spent per startup phase in this process.',
+                  '# TYPE hr_startup_seconds gauge']
+        lines += [f'hr_startup_seconds{self._labels(phase=phase)} {seconds}'
+                  for phase, seconds in startup_report().items()
+                  if phase in ('imports', 'static_assets', 'ml_import', 'app_ready') and seconds is not None]
+        if resource is not None:
+            gauges['hr_process_max_resident_memory_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        for name, value in gauges.items():
+            lines += [f'# TYPE {name} gauge', f'{name} {value}']
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+if METRICS_TRACE_MEMORY:
+    tracemalloc.start()
+
+
+def instrumented(stage):
+    """Decorator form of metrics.stage()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+startup_timings = {'imports': IMPORTS_DONE - STARTUP_BEGAN}
+_ml_lock = threading.Lock()
+
+
+def load_ml():
+    """Import scikit-learn and joblib on first use; later calls return immediately"""
+    global sklearn, joblib, GradientBoostingRegressor, IsolationForest, KMeans, StandardScaler, silhouette_score
+    if sklearn is not None:
+        return
+    with _ml_lock:
+        if sklearn is not None:
+            return
+        started = time.perf_counter()
+        import joblib as _joblib
+        from sklearn.ensemble import GradientBoostingRegressor as _gbr, IsolationForest as _iforest
+        from sklearn.cluster import KMeans as _kmeans
+        from sklearn.preprocessing import StandardScaler as _scaler
+        from sklearn.metrics import silhouette_score as _silhouette
+        import sklearn as _sklearn
+        joblib, GradientBoostingRegressor, IsolationForest = _joblib, _gbr, _iforest
+        KMeans, StandardScaler, silhouette_score = _kmeans, _scaler, _silhouette
+        sklearn = _sklearn
+        startup_timings['ml_import'] = time.perf_counter() - started
+        logger.info(f"🧠 ML stack loaded in {startup_timings['ml_import']:.2f}s")
+
+
+def startup_report():
+    """Seconds spent per startup phase; ml_import is None until the ML stack is loaded"""
+    return {
+        'imports': round(startup_timings.get('imports', 0), 3),
+        'static_assets': round(startup_timings.get('static_assets', 0), 3),
+        'ml_import': round(startup_timings['ml_import'], 3) if 'ml_import' in startup_timings else None,
+        'app_ready': round(startup_timings.get('app_ready', 0), 3),
+        'ml_preloaded': PRELOAD_ML,
+        'pid': os.getpid()
+    }
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    # Registered before compress_response, so it runs after it and includes compression
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe_request(route, request.method, response.status_code, time.perf_counter() - started)
+    return response
+
+
+# ============= EXPIRY REAPER =============
+
+class ExpiryReaper:
+    """
+    Evicts expired sessions, login-attempt records and file data in the background.
+
+    Deadlines go into a min-heap as (deadline, seq, kind, key); a daemon thread
+    sleeps until the earliest one and pops only what is due, so each pass costs
+    O(expired * log n). Entries are not removed when a deadline moves: the
+    handler for a kind re-checks the live record and ignores stale entries.
+    """
+    
+    def __init__(self, max_sleep):
+        self.max_sleep = max_sleep
+        self.handlers = {}
+        self.reaped = Counter()
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+        self._deferred = deque()
+    
+    def handler(self, kind):
+        """Register func(key, now) -> bool, called with the global lock held (slow cleanup goes through defer)"""
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+    
+    def defer(self, func, *args):
+        """From a handler: run func(*args) once the global lock is released, e.g. slow disk cleanup"""
+        self._deferred.append((func, args))
+    
+    def run_deferred(self):
+        while self._deferred:
+            func, args = self._deferred.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                logger.warning(f"Deferred cleanup {func.__name__} failed: {e}")
+    
+    def schedule(self, kind, key, deadline):
+        seq = next(self._seq)
+        with self._cond:
+            heapq.heappush(self._heap, (deadline, seq, kind, key))
+            if self._heap[0][1] == seq:  # new earliest deadline: shorten the current sleep
+                self._cond.notify()
+    
+    def start(self):
+        """Start the reaper thread (idempotent, post-fork safe)"""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='expiry-reaper', daemon=True)
+                self._thread.start()
+    
+    def _due(self):
+        with self._cond:
+            while True:
+                now = datetime.now()
+                if self._heap and self._heap[0][0] <= now:
+                    due = []
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap))
+                    return due, now
+                timeout = self.max_sleep
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                self._cond.wait(timeout)
+    
+    def _run(self):
+        while True:
+            due, now = self._due()
+            reaped = Counter()
+            for _, _, kind, key in due:
+                with lock:
+                    if self.handlers[kind](key, now):
+                        reaped[kind] += 1
+            self.run_deferred()
+            if reaped:
+                self.reaped.update(reaped)
+                logger.debug(f"🧹 Reaped {dict(reaped)}")
+    
+    def pending(self):
+        with self._cond:
+            return len(self._heap)
+
+
+reaper = ExpiryReaper(REAPER_MAX_SLEEP)
+
+
+def end_session(token_id):
+    """Remove a session and free its per-IP slot (caller holds lock)"""
+    session_data = sessions.pop(token_id, None)
+    if session_data is not None:
+        ip = session_data.get('ip')
+        remaining = sessions_per_ip.get(ip, 0) - 1
+        if remaining > 0:
+            sessions_per_ip[ip] = remaining
+        else:
+            sessions_per_ip.pop(ip, None)
+    return session_data
+
+
+def note_failed_login(client_ip):
+    """Count a failed login for rate limiting (caller holds lock)"""
+    attempts, _ = login_attempts.get(client_ip, (0, None))
+    now = datetime.now()
+    login_attempts[client_ip] = (attempts + 1, now)
+    reaper.schedule('login_attempt', client_ip, now + timedelta(seconds=LOGIN_ATTEMPT_TIMEOUT))
+
+
+def lease_file(file_id, until):
+    """Keep a file's data at least until `until` (caller holds lock)"""
+    if file_leases.get(file_id, datetime.min) < until:
+        file_leases[file_id] = until
+        reaper.schedule('file', file_id, until)
+
+
+def remember_cache_key(file_id, cache_key):
+    """Record a cache entry derived from a file so it is dropped with it (caller holds lock)"""
+    file_cache_keys.setdefault(file_id, set()).add(cache_key)
+    if file_id not in file_leases:
+        lease_file(file_id, datetime.now() + SESSION_TIMEOUT)
+
+
+@reaper.handler('session')
+def reap_session(token_id, now):
+    session_data = sessions.get(token_id)
+    if session_data is None or session_data['expires'] > now:
+        return False
+    end_session(token_id)
+    return True
+
+
+@reaper.handler('revocation')
+def reap_revocation(token_id, now):
+    return revoked_tokens.pop(token_id, None) is not None
+
+
+@reaper.handler('login_attempt')
+def reap_login_attempt(client_ip, now):
+    record = login_attempts.get(client_ip)
+    if record is None or now - record[1] < timedelta(seconds=LOGIN_ATTEMPT_TIMEOUT):
+        return False
+    del login_attempts[client_ip]
+    return True
+
+
+@reaper.handler('file')
+def reap_file(file_id, now):
+    until = file_leases.get(file_id)
+    if until is None or until > now:
+        return False
+    del file_leases[file_id]
+    discard_upload(files.pop(file_id, None))
+    forget_frames(file_id)
+    progress.pop(file_id, None)
+    for cache_key in file_cache_keys.pop(file_id, ()):
+        analytics_cache.pop(cache_key, None)
+        dataset_indexes.pop(cache_key, None)
+    # An expired file must not come back from disk after a restart; rmtree runs after the lock is released
+    reaper.defer(discard_expired_snapshot, file_id)
+    return True
+
+
+def discard_expired_snapshot(file_id):
+    with lock:
+        if file_id in file_leases:
+            return  # uploaded again since it expired
+    snapshots.discard(file_id)
+
+
+@reaper.handler('chunked_upload')
+def reap_chunked_upload(upload_id, now):
+    upload = chunked_uploads.get(upload_id)
+    if upload is None or upload.expires > now:
+        return False
+    del chunked_uploads[upload_id]
+    upload.discard()
+    return True
+
+
+@app.before_request
+def start_reaper():
+    reaper.start()
+
+
+# ============= SESSION TOKENS =============
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _token_signature(body):
+    message = f'{SESSION_TOKEN_VERSION}.{body}'.encode()
+    return _b64encode(hmac.new(SESSION_SECRET, message, hashlib.sha256).digest())
+
+
+def issue_session_token(username, client_ip):
+    """
+    Signed token `v1.<claims>.<hmac>` carrying username, client IP, issue and
+    expiry time and a random token id (used for revocation).
+    """
+    now = time.time()
+    claims = {
+        'u': username,
+        'ip': client_ip,
+        'iat': int(now),
+        'exp': int(now + SESSION_TIMEOUT.total_seconds()),
+        'jti': secrets.token_urlsafe(12)
+    }
+    body = _b64encode(json.dumps(claims, separators=(',', ':')).encode())
+    return f'{SESSION_TOKEN_VERSION}.{body}.{_token_signature(body)}', claims
+
+
+def verify_session_token(token, client_ip):
+    """Return (claims, None) for a valid token, else (None, error). Reads only revoked_tokens."""
+    try:
+        version, body, signature = token.split('.')
+        if version != SESSION_TOKEN_VERSION or not hmac.compare_digest(signature.encode(),
+                                                                       _token_signature(body).encode()):
+            return None, 'Invalid session'
+        claims = json.loads(_b64decode(body))
+        expires, token_id, bound_ip = claims['exp'], claims['jti'], claims['ip']
+    except (AttributeError, ValueError, TypeError, KeyError):
+        return None, 'Invalid session'
+    
+    if expires < time.time():
+        return None, 'Session expired'
+    if token_id in revoked_tokens:
+        return None, 'Invalid session'
+    if SESSION_BIND_IP and bound_ip != client_ip:
+        return None, 'Invalid session'
+    return claims, None
+
+
+def session_from_claims(claims):
+    return {
+        'username': claims['u'],
+        'ip': claims['ip'],
+        'token_id': claims['jti'],
+        'login_time': datetime.fromtimestamp(claims['iat']),
+        'expires': datetime.fromtimestamp(claims['exp']),
+        'authenticated': True
+    }
+
+
+def revoke_session_token(claims):
+    """Log a token out before it expires (caller holds lock)"""
+    revoked_tokens[claims['jti']] = claims['exp']
+    reaper.schedule('revocation', claims['jti'], datetime.fromtimestamp(claims['exp']))
+    end_session(claims['jti'])
+
+
+# ============= PROFILER =============
+
+class Profile:
+    """One captured profile: folded stacks from every thread attached to it."""
+    
+    def __init__(self, profile_id, route, method, forced):
+        self.id = profile_id
+        self.route = route
+        self.method = method
+        self.forced = forced
+        self.started_at = datetime.now()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.samples = 0
+        self.stacks = Counter()
+        self.threads = {}  # thread id -> role
+        self.roles = set()
+        self.refs = 0
+    
+    def summary(self):
+        return {
+            'id': self.id,
+            'route': self.route,
+            'method': self.method,
+            'trigger': 'forced' if self.forced else 'slow',
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'duration_ms': round(self.duration * 1000, 1) if self.duration is not None else None,
+            'samples': self.samples,
+            'stacks': len(self.stacks),
+            'threads': sorted(self.roles)
+        }
+    
+    def folded(self):
+        """Brendan Gregg's folded format, readable by flamegraph.pl, inferno and speedscope"""
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class SamplingProfiler:
+    """
+    Statistical profiler for selected requests.
+
+    A single daemon thread wakes every interval while any profile is open,
+    reads sys._current_frames() and counts the stack of each attached thread.
+    Nothing is sampled when no profile is open. Work handed to other threads
+    (analysis threads, AI stage pool) joins the profile through wrap(); the
+    profile closes when its last thread detaches and is kept in a ring buffer
+    if it was forced or ran longer than the slow threshold.
+    """
+    
+    def __init__(self, interval, ring_size, slow_seconds=0.0):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.interval = interval
+        self.slow_seconds = slow_seconds
+        self.enabled = False  # admin toggle: keep every eligible request
+        self.ring = deque(maxlen=ring_size)
+        self._attached = {}  # thread id -> Profile
+        self._open = 0
+        self._sampler = None
+        self._next_id = 0
+    
+    def wanted(self, forced):
+        return forced or self.enabled or self.slow_seconds > 0
+    
+    def start(self, route, method, forced=False):
+        """Open a profile and attach the calling thread as its handler"""
+        with self._lock:
+            self._next_id += 1
+            profile = Profile(f'{int(time.time())}-{self._next_id}', route, method, forced or self.enabled)
+            self._open += 1
+            if self._sampler is None or not self._sampler.is_alive():
+                self._sampler = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._sampler.start()
+        self._attach(profile, 'handler')
+        return profile
+    
+    def current(self):
+        return getattr(self._local, 'profile', None)
+    
+    def _attach(self, profile, role):
+        with self._lock:
+            profile.refs += 1
+            profile.threads[threading.get_ident()] = role
+            profile.roles.add(role)
+            self._attached[threading.get_ident()] = profile
+        self._local.profile = profile
+    
+    def detach(self, profile):
+        tid = threading.get_ident()
+        self._local.profile = None
+        with self._lock:
+            if self._attached.get(tid) is profile:
+                del self._attached[tid]
+            profile.threads.pop(tid, None)
+            self._release(profile)
+    
+    def _release(self, profile):
+        # Caller holds self._lock
+        profile.refs -= 1
+        if profile.refs > 0:
+            return
+        profile.duration = time.perf_counter() - profile.started
+        self._open -= 1
+        if profile.forced or (self.slow_seconds and profile.duration >= self.slow_seconds):
+            self.ring.append(profile)
+    
+    def wrap(self, func, role):
+        """
+        Bind func to the calling thread's profile, if any, so a thread or pool
+        worker running it is sampled too. The profile stays open until the
+        wrapped call returns, even if the handler finishes first.
+        """
+        profile = self.current()
+        if profile is None:
+            return func
+        with self._lock:
+            profile.refs += 1  # reserved now so the profile cannot close before the worker starts
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tid = threading.get_ident()
+            with self._lock:
+                profile.threads[tid] = role
+                profile.roles.add(role)
+                self._attached[tid] = profile
+            self._local.profile = profile
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.detach(profile)
+        
+        def cancel():
+            # The wrapped call will never run: give back the reserved reference
+            with self._lock:
+                self._release(profile)
+        wrapper.cancel = cancel
+        return wrapper
+    
+    @staticmethod
+    def _fold(frame, role):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'.replace(';', ':'))
+            frame = frame.f_back
+        names.append(role)
+        return ';'.join(reversed(names))
+    
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._open == 0:
+                    self._sampler = None
+                    return
+                attached = {tid: (profile, profile.threads.get(tid)) for tid, profile in self._attached.items()}
+            frames = sys._current_frames()
+            for tid, (profile, role) in attached.items():
+                frame = frames.get(tid)
+                if frame is None or role is None:
+                    continue
+                stack = self._fold(frame, role)
+                with self._lock:
+                    if profile.duration is not None:  # closed since the snapshot
+                        continue
+                    if stack in profile.stacks or len(profile.stacks) < PROFILE_MAX_STACKS:
+                        profile.stacks[stack] += 1
+                    else:
+                        profile.stacks[f'{role};[truncated]'] += 1
+                    profile.samples += 1
+            del frames
+            time.sleep(self.interval)
+    
+    def profiles(self):
+        with self._lock:
+            return [p.summary() for p in reversed(self.ring)]
+    
+    def get(self, profile_id):
+        with self._lock:
+            return next((p for p in self.ring if p.id == profile_id), None)
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL_MS / 1000, PROFILE_RING_SIZE, PROFILE_SLOW_MS / 1000)
+
+
+@app.before_request
+def start_request_profile():
+    if request.url_rule is None or request.url_rule.rule not in PROFILE_ROUTES:
+        return
+    forced = False
+    if request.headers.get('X-Profile') == '1':
+        claims, error = verify_session_token(request.headers.get('X-Session-Token'), request.remote_addr)
+        forced = error is None and claims['u'] == DEFAULT_USERNAME
+    if profiler.wanted(forced):
+        g.profile = profiler.start(request.url_rule.rule, request.method, forced)
+
+
+@app.teardown_request
+def finish_request_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        profiler.detach(profile)
+
+
 def normalize_text(text):
     """
     Normalize text for fuzzy matching.
@@ -265,9 +1194,9 @@ class FastAnalyzer:
         with lock:
             progress[self.file_id] = {'status': status, 'progress': pct}
     
-    def analyze(self):
-        self.update_progress('🔍 كشف الأعمدة...', 10)
-        
+    @instrumented('column_detection')
+    def detect_columns(self):
+        """كشف أعمدة الإدارة والتقييم والمنطقة. يرجع (dept_col, rating_col, region_col)"""
         logger.info(f"📋 Available columns: {list(self.df.columns)}")
         
         dept_col = None
@@ -341,8 +1270,6 @@ class FastAnalyzer:
         
         logger.info(f"✅ Final selection - Department: '{dept_col}', Rating: '{rating_col}'")
         
-        self.update_progress('⚡ معالجة التقييمات...', 30)
-        
         # Detect if there's a region/location column
         region_col = None
         region_keywords = ['منطقة', 'region', 'location', 'مكان', 'الموقع', 'city', 'مدينة', 'province']
@@ -353,173 +1280,92 @@ class FastAnalyzer:
                 logger.info(f"✓ Region column found: {col}")
                 break
         
-        ratings = []
-        for val in self.df[rating_col]:
-            r = self._convert_rating(val)
-            if r:
-                ratings.append(r)
+        return dept_col, rating_col, region_col
+    
+    @instrumented('analysis.dashboard')
+    def analyze(self):
+        self.update_progress('🔍 كشف الأعمدة...', 10)
         
-        self.update_progress('📊 تحليل الأقسام...', 60)
+        dept_col, rating_col, region_col = self.detect_columns()
+        self.columns_used = (dept_col, rating_col, region_col)
         
-        depts = {}
-        for dept, group in self.df.groupby(dept_col, observed=True):
-            dept_ratings = []
-            for val in group[rating_col]:
-                r = self._convert_rating(val)
-                if r:
-                    dept_ratings.append(r)
-            
-            if dept_ratings:
-                depts[str(dept)] = {
-                    'count': len(group),
-                    'avg': round(np.mean(dept_ratings), 2)
-                }
+        self.update_progress('⚡ معالجة التقييمات...', 30)
         
-        top_depts = sorted(depts.items(), key=lambda x: x[1]['avg'], reverse=True)[:10]
+        # Build the inverted indexes and the region × department × rating cube once;
+        # everything below is a roll-up of the cube
+        self.index = DatasetIndex(self.df, dept_col, rating_col, region_col)
+        cube = self.index.cube
+        
+        self.update_progress('📊 تحليل الأقسام...', 60)
+        
+        overall = cube.rollup(None)
+        dept_rows, dept_valid, dept_sums, _ = cube.rollup('dept')
+        dept_means = _group_means(dept_sums[:cube.n_depts], dept_valid[:cube.n_depts])
+        top_codes, _ = rank_extremes(dept_means, 10)
         
         self.update_progress('🗺️ تحليل المناطق...', 80)
         
-        # Regional analysis - use region column if available, otherwise skip or use department
+        # Regional analysis - regions come from the region column if available,
+        # otherwise from department names (see DatasetIndex)
         regions = {}
         
-        if region_col:
-            # Use the dedicated region column for accurate regional data
-            for region, group in self.df.groupby(region_col, observed=True):
-                region_name = str(region).strip()
-                if region_name == 'nan' or not region_name:
-                    continue
-                    
-                # Find matching SAUDI_REGION using fuzzy matching
-                matched_region = match_region(region_name)
-                
-                if not matched_region:
-                    # Log unmatched regions for debugging
-                    logger.debug(f"Could not match region: {region_name}")
-                    continue
-                
-                region_ratings = []
-                region_depts = {}
-                
-                for idx, row in group.iterrows():
-                    dept_name = str(row.get(dept_col, 'غير محدد'))
-                    r = self._convert_rating(row[rating_col])
-                    if r:
-                        region_ratings.append(r)
-                        if dept_name not in region_depts:
-                            region_depts[dept_name] = []
-                        region_depts[dept_name].append(r)
-                
-                if region_ratings:
-                    dept_details = []
-                    for dept, dratings in region_depts.items():
-                        dept_details.append({
-                            'name': dept,
-                            'avg_rating': round(np.mean(dratings), 2),
-                            'employees': len(dratings)
-                        })
-                    dept_details.sort(key=lambda x: x['avg_rating'], reverse=True)
-                    
-                    avg_rating = round(np.mean(region_ratings), 2)
-                    regions[matched_region] = {
-                        'lat': SAUDI_REGIONS[matched_region]['lat'],
-                        'lng': SAUDI_REGIONS[matched_region]['lng'],
-                        'color': SAUDI_REGIONS[matched_region]['color'],
-                        'employees': len(group),
-                        'avg_rating': avg_rating,
-                        'departments': len(region_depts),
-                        'dept_details': dept_details,
-                        'top_dept': dept_details[0] if dept_details else None,
-                        'low_dept': dept_details[-1] if dept_details else None
-                    }
-        else:
-            # No region column - try to extract from department names
-            logger.info("No region column found, attempting to extract from department names")
+        if cube.n_regions:
+            if not region_col:
+                logger.info("No region column found, attempting to extract from department names")
+            region_rows, region_valid, region_sums, _ = cube.rollup('region')
+            pair_rows, pair_valid, pair_sums, _ = cube.rollup('region_dept')
             
-            # Group by department and try to infer region
-            dept_regions = {}
-            for dept_name in depts.keys():
-                matched_region = match_region(dept_name)
-                if matched_region:
-                    if matched_region not in dept_regions:
-                        dept_regions[matched_region] = []
-                    dept_regions[matched_region].append(dept_name)
-            
-            if dept_regions:
-                logger.info(f"Found regions in departments: {list(dept_regions.keys())}")
-                
-                for region_name, region_depts in dept_regions.items():
-                    region_ratings = []
-                    region_depts_data = {}
-                    
-                    for dept in region_depts:
-                        if dept in depts:
-                            for i in range(depts[dept]['count']):
-                                region_ratings.append(depts[dept]['avg'])
-                            region_depts_data[dept] = {
-                                'avg_rating': depts[dept]['avg'],
-                                'employees': depts[dept]['count']
-                            }
-                    
-                    if region_ratings:
-                        dept_details = [{'name': k, 'avg_rating': v['avg_rating'], 'employees': v['employees']} 
-                                       for k, v in region_depts_data.items()]
-                        dept_details.sort(key=lambda x: x['avg_rating'], reverse=True)
-                        
-                        avg_rating = round(np.mean(region_ratings), 2)
-                        regions[region_name] = {
-                            'lat': SAUDI_REGIONS[region_name]['lat'],
-                            'lng': SAUDI_REGIONS[region_name]['lng'],
-                            'color': SAUDI_REGIONS[region_name]['color'],
-                            'employees': sum(d['employees'] for d in region_depts_data.values()),
-                            'avg_rating': avg_rating,
-                            'departments': len(region_depts),
-                            'dept_details': dept_details,
-                            'top_dept': dept_details[0] if dept_details else None,
-                            'low_dept': dept_details[-1] if dept_details else None
-                        }
-            else:
-                # Last resort: distribute data across regions for visualization
-                logger.warning("No regions detected in data - creating aggregated view")
-                all_ratings = []
-                all_depts = {}
-                
-                for dept_name, dept_data in depts.items():
-                    all_ratings.extend([dept_data['avg']] * dept_data['count'])
-                    all_depts[dept_name] = {
-                        'avg_rating': dept_data['avg'],
-                        'employees': dept_data['count']
-                    }
+            for r in np.flatnonzero(region_valid[:cube.n_regions]):
+                region_name = cube.regions[r]
+                # With a region column only rated employees are counted per department
+                dept_employees = pair_valid[r] if region_col else pair_rows[r]
+                means = _group_means(pair_sums[r, :cube.n_depts], pair_valid[r, :cube.n_depts])
+                dept_details = _dept_rows(cube.departments, rank_order(means), means, dept_employees)
+                top_code, low_code = rank_extremes(means, 1)
+                extremes = _dept_rows(cube.departments, np.concatenate([top_code, low_code]), means, dept_employees)
+                top_dept, low_dept = extremes if extremes else (None, None)
                 
-                if all_ratings:
-                    # Show all regions with equal weighting but note data is aggregated
-                    dept_details = [{'name': k, 'avg_rating': v['avg_rating'], 'employees': v['employees']} 
-                                   for k, v in all_depts.items()]
-                    dept_details.sort(key=lambda x: x['avg_rating'], reverse=True)
-                    avg_rating = round(np.mean(all_ratings), 2)
-                    
-                    # Add all regions with same data (visual representation only)
-                    for region_name in list(SAUDI_REGIONS.keys())[:5]:  # Show top 5 regions
-                        regions[region_name] = {
-                            'lat': SAUDI_REGIONS[region_name]['lat'],
-                            'lng': SAUDI_REGIONS[region_name]['lng'],
-                            'color': SAUDI_REGIONS[region_name]['color'],
-                            'employees': sum(d['employees'] for d in all_depts.values()),
-                            'avg_rating': avg_rating,
-                            'departments': len(all_depts),
-                            'dept_details': dept_details,
-                            'top_dept': dept_details[0] if dept_details else None,
-                            'low_dept': dept_details[-1] if dept_details else None,
-                            '_aggregated': True  # Flag to indicate this is aggregated data
-                        }
+                regions[region_name] = {
+                    'lat': SAUDI_REGIONS[region_name]['lat'],
+                    'lng': SAUDI_REGIONS[region_name]['lng'],
+                    'color': SAUDI_REGIONS[region_name]['color'],
+                    'employees': int(region_rows[r]),
+                    'avg_rating': round(float(region_sums[r] / region_valid[r]), 2),
+                    'departments': len(dept_details),
+                    'dept_details': dept_details,
+                    'top_dept': top_dept,
+                    'low_dept': low_dept
+                }
+        elif len(top_codes):
+            # Last resort: distribute data across regions for visualization
+            logger.warning("No regions detected in data - creating aggregated view")
+            dept_details = _dept_rows(cube.departments, rank_order(dept_means), dept_means, dept_rows)
+            avg_rating = round(float(overall[2] / overall[1]), 2)
+            
+            # Add all regions with same data (visual representation only)
+            for region_name in list(SAUDI_REGIONS.keys())[:5]:  # Show top 5 regions
+                regions[region_name] = {
+                    'lat': SAUDI_REGIONS[region_name]['lat'],
+                    'lng': SAUDI_REGIONS[region_name]['lng'],
+                    'color': SAUDI_REGIONS[region_name]['color'],
+                    'employees': sum(d['employees'] for d in dept_details),
+                    'avg_rating': avg_rating,
+                    'departments': len(dept_details),
+                    'dept_details': dept_details,
+                    'top_dept': dept_details[0] if dept_details else None,
+                    'low_dept': dept_details[-1] if dept_details else None,
+                    '_aggregated': True  # Flag to indicate this is aggregated data
+                }
         
         logger.info(f"✓ Found {len(regions)} regions with data")
         self.update_progress('✅ اكتمل!', 100)
         
+        total_rows, valid_ratings, rating_sum, _ = overall
         return {
             'total_records': len(self.df),
-            'valid_ratings': len(ratings),
-            'avg_rating': round(np.mean(ratings), 2) if ratings else 0,
-            'top_departments': [{'name': d[0], 'rating': d[1]['avg'], 'employees': d[1]['count']} for d in top_depts],
+            'valid_ratings': int(valid_ratings),
+            'avg_rating': round(float(rating_sum / valid_ratings), 2) if valid_ratings else 0,
+            'top_departments': _dept_rows(cube.departments, top_codes, dept_means, dept_rows, 'rating'),
             'regional_data': regions
         }
     
@@ -576,62 +1422,1960 @@ class FastAnalyzer:
             logger.debug(f"Rating conversion error for value '{val}': {e}")
             return None
 
-def analyze_background(file_id, sheet_name, file_bytes):
-    try:
-        with lock:
-            if file_id not in progress:
-                progress[file_id] = {'status': '📥 جاري قراءة...', 'progress': 1}
-        
-        logger.info(f"Reading sheet: {sheet_name}")
-        df, _ = load_dataframe(file_bytes, sheet_name)
-        df = df.dropna(how='all')
-        
-        logger.info(f"Loaded {len(df)} records")
-        
-        analyzer = FastAnalyzer(df, file_id)
-        result = analyzer.analyze()
-        
-        with lock:
-            analytics_cache[f"{file_id}_{sheet_name}"] = result
-        
-        logger.info("✓ Analysis complete")
-    except Exception as e:
-        logger.error(f"Error: {e}")
-        with lock:
-            progress[file_id] = {'status': f'❌ خطأ: {str(e)}', 'progress': 0}
+# ============= RANKING =============
+
+def rank_extremes(values, k, offset=0):
+    """
+    Top and bottom ranks offset..offset+k of per-group values in one partition
+    pass (np.partition with both kth positions), O(n + k log k) instead of a
+    full sort. NaN groups are unranked. Ties are broken by group code, lower
+    code first at the top; the bottom list is the top ordering reversed.
+    Returns (top_codes, bottom_codes) as int arrays.
+    """
+    if k < 1 or offset < 0:
+        raise ValueError('k must be >= 1 and offset >= 0')
+    values = np.asarray(values, dtype=float)
+    codes = np.flatnonzero(~np.isnan(values))
+    ranked = values[codes]
+    n = len(ranked)
+    m = min(offset + k, n)
+    if m <= offset:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty
+    
+    if 2 * m < n:
+        partitioned = np.partition(ranked, [m - 1, n - m])
+        high_cut, low_cut = partitioned[n - m], partitioned[m - 1]
+        top_mask, bottom_mask = ranked >= high_cut, ranked <= low_cut
+    else:
+        top_mask = bottom_mask = np.ones(n, dtype=bool)
+    
+    top_codes, top_values = codes[top_mask], ranked[top_mask]
+    top = top_codes[np.lexsort((top_codes, -top_values))][offset:m]
+    bottom_codes, bottom_values = codes[bottom_mask], ranked[bottom_mask]
+    bottom = bottom_codes[np.lexsort((-bottom_codes, bottom_values))][offset:m]
+    return top, bottom
 
 
-def load_dataframe(file_bytes, sheet_name=None):
-    try:
-        excel = pd.ExcelFile(io.BytesIO(file_bytes))
-        if sheet_name and sheet_name in excel.sheet_names:
-            use_sheet = sheet_name
-        else:
-            use_sheet = excel.sheet_names[0] if excel.sheet_names else 0
-        df = pd.read_excel(excel, sheet_name=use_sheet)
-        return df, excel.sheet_names
-    except Exception as excel_error:
-        try:
-            df = pd.read_csv(io.BytesIO(file_bytes))
-            return df, ['Sheet1']
-        except Exception:
-            raise excel_error
+def rank_order(values):
+    """Every ranked group in descending order, same tie-breaking as rank_extremes"""
+    values = np.asarray(values, dtype=float)
+    codes = np.flatnonzero(~np.isnan(values))
+    return codes[np.lexsort((codes, -values[codes]))]
 
 
-# ============= AUTHENTICATION ENDPOINTS =============
+def rank_positions(values):
+    """1-based rank of every group (0 = unranked), for paging through all groups"""
+    ranks = np.zeros(len(values), dtype=np.int64)
+    order = rank_order(values)
+    ranks[order] = np.arange(1, len(order) + 1)
+    return ranks
 
-@app.route('/login', methods=['POST'])
-def login():
-    """تسجيل دخول المستخدم"""
+
+def _group_means(sums, counts, decimals=2):
+    """Rounded per-group means, NaN where a group has no valid ratings"""
+    means = np.full(len(counts), np.nan)
+    rated = counts > 0
+    means[rated] = np.round(sums[rated] / counts[rated], decimals)
+    return means
+
+
+def _dept_rows(names, codes, means, employees, rating_key='avg_rating'):
+    """Department entries for `codes`, converting the numeric columns in one pass each"""
+    codes = np.asarray(codes, dtype=np.intp)
+    return [{'name': names[c], rating_key: m, 'employees': e}
+            for c, m, e in zip(codes.tolist(), means[codes].tolist(), employees[codes].astype(np.int64).tolist())]
+
+
+def _factorize_sorted(series):
+    """Codes in sorted value order, so rank ties fall back to name order as groupby did"""
     try:
-        data = request.get_json()
-        username = data.get('username', '').strip()
-        password = data.get('password', '').strip()
-        client_ip = request.remote_addr
-        
-        if not username or not password:
-            return jsonify({'error': 'Username and password required'}), 400
-        
+        return pd.factorize(series, sort=True)
+    except TypeError:
+        return pd.factorize(series)
+
+
+def _build_postings(codes, n_values):
+    """Inverted index: list of sorted row-position arrays, one per code (code -1 = missing)"""
+    positions = np.flatnonzero(codes >= 0).astype(np.int32)
+    order = positions[np.argsort(codes[positions], kind='stable')]
+    counts = np.bincount(codes[positions], minlength=n_values)
+    return np.split(order, np.cumsum(counts)[:-1])
+
+
+def _union_postings(postings):
+    if len(postings) == 1:
+        return postings[0]
+    return np.unique(np.concatenate(postings)) if postings else np.empty(0, dtype=np.int32)
+
+
+def _ranked_departments(names, employees, means, top_n, offset=0, include_ranks=False):
+    """top/bottom department payload for /query, paged by offset"""
+    top, bottom = rank_extremes(means, top_n, offset)
+    employees = np.asarray(employees)
+    
+    result = {
+        'matched_departments': int((~np.isnan(means)).sum()),
+        'offset': offset,
+        'top_departments': _dept_rows(names, top, means, employees, 'rating'),
+        'bottom_departments': _dept_rows(names, bottom, means, employees, 'rating')
+    }
+    if include_ranks:
+        ranks = rank_positions(means)
+        result['ranks'] = {names[c]: int(ranks[c]) for c in np.flatnonzero(ranks)}
+    return result
+
+
+def canonical_group(scope, name):
+    """Key matching a region or department across datasets: canonical region, normalized department name"""
+    if scope == 'region':
+        return match_region(name) or str(name).strip()
+    if scope == 'dept':
+        return normalize_text(name)
+    return ''
+
+
+class DatasetIndex:
+    """
+    Per-dataset inverted indexes from department, matched region and rating
+    bucket to row positions. Dashboard filters are answered by intersecting
+    the sorted position lists and aggregating only the selected rows.
+    """
+    def __init__(self, df, dept_col, rating_col, region_col=None):
+        self.total_rows = len(df)
+        self.columns_used = {'dept': dept_col, 'rating': rating_col, 'region': region_col}
+        
+        self.ratings = _convert_ratings(df[rating_col])
+        
+        self.dept_codes, dept_values = _factorize_sorted(df[dept_col])
+        self.departments = [str(v) for v in dept_values]
+        self.dept_lookup = {name: code for code, name in enumerate(self.departments)}
+        
+        # Regions: canonical SAUDI_REGIONS names, from the region column or department names
+        with metrics.stage('region_matching'):
+            if region_col:
+                region_raw_codes, region_raw_values = pd.factorize(df[region_col])
+                matched = [match_region(str(v).strip()) for v in region_raw_values]
+            else:
+                region_raw_codes, matched = self.dept_codes, [match_region(name) for name in self.departments]
+        self.regions = sorted({m for m in matched if m})
+        # The region column already holds canonical names only, so grouping by it or by region code agrees
+        self.regions_verbatim = bool(region_col) and all(m == v for v, m in zip(region_raw_values, matched))
+        region_lookup = {name: code for code, name in enumerate(self.regions)}
+        raw_to_region = np.array([region_lookup.get(m, -1) for m in matched] + [-1], dtype=np.int64)
+        self.region_codes = raw_to_region[region_raw_codes]  # -1 maps to the trailing sentinel
+        
+        n_buckets = int(np.ceil(4 / RATING_INDEX_BUCKET_WIDTH))
+        valid = ~np.isnan(self.ratings)
+        self.bucket_codes = np.full(self.total_rows, -1, dtype=np.int64)
+        self.bucket_codes[valid] = np.clip(((self.ratings[valid] - 1) / RATING_INDEX_BUCKET_WIDTH).astype(np.int64),
+                                           0, n_buckets - 1)
+        
+        with metrics.stage('index_build'):
+            self.dept_index = _build_postings(self.dept_codes, len(self.departments))
+            self.region_index = _build_postings(self.region_codes, len(self.regions))
+            self.bucket_index = _build_postings(self.bucket_codes, n_buckets)
+        with metrics.stage('groupby.cube'):
+            self.cube = RatingCube(self)
+        self._totals = {}
+    
+    def _dept_codes(self, departments):
+        if not departments:
+            return None
+        return [self.dept_lookup[d] for d in departments if d in self.dept_lookup]
+    
+    def _region_codes(self, regions):
+        if not regions:
+            return None
+        wanted = {match_region(r) or r for r in regions}
+        return [i for i, name in enumerate(self.regions) if name in wanted]
+    
+    def select(self, regions=None, departments=None, rating_min=None, rating_max=None):
+        """Row positions matching all filters, or None when no filter is set"""
+        candidates = []
+        
+        if departments:
+            codes = self._dept_codes(departments)
+            candidates.append(_union_postings([self.dept_index[c] for c in codes]))
+        
+        if regions:
+            codes = self._region_codes(regions)
+            candidates.append(_union_postings([self.region_index[c] for c in codes]))
+        
+        if rating_min is not None or rating_max is not None:
+            low = 1.0 if rating_min is None else float(rating_min)
+            high = 5.0 if rating_max is None else float(rating_max)
+            first = max(int((low - 1) // RATING_INDEX_BUCKET_WIDTH), 0)
+            last = min(int((high - 1) // RATING_INDEX_BUCKET_WIDTH), len(self.bucket_index) - 1)
+            positions = _union_postings(self.bucket_index[first:last + 1]) if first <= last else np.empty(0, dtype=np.int32)
+            # Only the two boundary buckets can hold out-of-range ratings
+            values = self.ratings[positions]
+            candidates.append(positions[(values >= low) & (values <= high)])
+        
+        if not candidates:
+            return None
+        
+        candidates.sort(key=len)
+        selected = candidates[0]
+        for other in candidates[1:]:
+            selected = np.intersect1d(selected, other, assume_unique=True)
+        return selected
+    
+    def query(self, regions=None, departments=None, rating_min=None, rating_max=None, top_n=QUERY_DEFAULT_TOP_N,
+              offset=0, include_ranks=False):
+        # Filters on whole cube cells are rolled up from the cube without touching rows
+        buckets = None
+        if rating_min is not None or rating_max is not None:
+            buckets = self.cube.bucket_range(rating_min, rating_max)
+        if buckets is not None or (rating_min is None and rating_max is None):
+            result = self.cube.query(self._region_codes(regions), self._dept_codes(departments), buckets, top_n,
+                                     offset, include_ranks)
+            result['source'] = 'cube'
+            return result
+        
+        selected = self.select(regions, departments, rating_min, rating_max)
+        if selected is None:
+            ratings, dept_codes, region_codes = self.ratings, self.dept_codes, self.region_codes
+        else:
+            ratings, dept_codes, region_codes = (self.ratings[selected], self.dept_codes[selected],
+                                                 self.region_codes[selected])
+        
+        valid = ~np.isnan(ratings)
+        dept_employees, dept_means = self._group_arrays(dept_codes, ratings, valid, len(self.departments))
+        region_rows = self._group_stats(region_codes, ratings, valid, len(self.regions))
+        
+        return {
+            'source': 'index',
+            'total_records': int(len(ratings)),
+            'valid_ratings': int(valid.sum()),
+            'avg_rating': round(float(ratings[valid].mean()), 2) if valid.any() else 0,
+            **_ranked_departments(self.departments, dept_employees, dept_means, top_n, offset, include_ranks),
+            'regions': [{'name': self.regions[c], 'employees': count, 'avg_rating': avg}
+                        for c, count, avg in region_rows]
+        }
+    
+    @staticmethod
+    def _group_arrays(codes, ratings, valid, n_groups):
+        """(employees, rounded mean) arrays per group code"""
+        present = codes >= 0
+        employees = np.bincount(codes[present], minlength=n_groups)
+        rated = present & valid
+        rated_counts = np.bincount(codes[rated], minlength=n_groups)
+        sums = np.bincount(codes[rated], weights=ratings[rated], minlength=n_groups)
+        return employees, _group_means(sums, rated_counts)
+    
+    @staticmethod
+    def _group_stats(codes, ratings, valid, n_groups):
+        """(code, employees, avg) for every group with at least one valid rating"""
+        present = codes >= 0
+        employees = np.bincount(codes[present], minlength=n_groups)
+        rated = present & valid
+        rated_counts = np.bincount(codes[rated], minlength=n_groups)
+        sums = np.bincount(codes[rated], weights=ratings[rated], minlength=n_groups)
+        return [(int(c), int(employees[c]), round(float(sums[c] / rated_counts[c]), 2))
+                for c in np.flatnonzero(rated_counts)]
+    
+    def facets(self):
+        return {'regions': list(self.regions), 'departments': sorted(self.departments)}
+    
+    def group_totals(self, scope):
+        """
+        Employees, valid ratings, rating sum and sum of squares per 'region' or
+        'dept', indexed by canonical_group so datasets and periods line up;
+        spelling variants of one department pool into one row. Built once.
+        """
+        totals = self._totals.get(scope)
+        if totals is not None:
+            return totals
+        
+        names = self.regions if scope == 'region' else self.departments
+        rows, valid, sums, sumsq = self.cube.rollup(scope)
+        size = len(names)
+        totals = pd.DataFrame({
+            'name': names,
+            'employees': rows[:size].astype(np.int64),
+            'valid_ratings': valid[:size].astype(np.int64),
+            'rating_sum': sums[:size],
+            'rating_sumsq': sumsq[:size]
+        }, index=pd.Index([canonical_group(scope, name) for name in names], name='key'))
+        totals = totals[(totals.index != '') & (totals['employees'] > 0)]
+        totals = totals.groupby(level=0, sort=False).agg({'name': 'first', 'employees': 'sum', 'valid_ratings': 'sum',
+                                                          'rating_sum': 'sum', 'rating_sumsq': 'sum'})
+        self._totals[scope] = totals
+        return totals
+
+
+class RatingCube:
+    """
+    Region × department × rating-bucket cube of count, sum and sum of squares.
+    Stored sparse (one entry per non-empty cell) so thousands of departments
+    stay compact. The last code on each axis collects rows with no matched
+    region, no department or no valid rating.
+    """
+    def __init__(self, index):
+        self.regions = index.regions
+        self.departments = index.departments
+        self.n_regions = len(index.regions)
+        self.n_depts = len(index.departments)
+        self.n_buckets = len(index.bucket_index)
+        self.shape = (self.n_regions + 1, self.n_depts + 1, self.n_buckets + 1)
+        
+        region = np.where(index.region_codes >= 0, index.region_codes, self.n_regions)
+        dept = np.where(index.dept_codes >= 0, index.dept_codes, self.n_depts)
+        bucket = np.where(index.bucket_codes >= 0, index.bucket_codes, self.n_buckets)
+        ratings = np.nan_to_num(index.ratings)
+        
+        cells, inverse = np.unique(np.ravel_multi_index((region, dept, bucket), self.shape), return_inverse=True)
+        cell_region, cell_dept, cell_bucket = np.unravel_index(cells, self.shape)
+        self.cell_region = cell_region.astype(np.int32)
+        self.cell_dept = cell_dept.astype(np.int32)
+        self.cell_bucket = cell_bucket.astype(np.int32)
+        self.count = np.bincount(inverse, minlength=len(cells))
+        self.sum = np.bincount(inverse, weights=ratings, minlength=len(cells))
+        self.sumsq = np.bincount(inverse, weights=ratings * ratings, minlength=len(cells))
+        self.rated = self.cell_bucket < self.n_buckets
+    
+    def mask(self, regions=None, departments=None, buckets=None):
+        """Cells matching the given region / department / bucket codes (None = all, incl. missing)"""
+        selected = np.ones(len(self.count), dtype=bool)
+        if regions is not None:
+            selected &= np.isin(self.cell_region, regions)
+        if departments is not None:
+            selected &= np.isin(self.cell_dept, departments)
+        if buckets is not None:
+            selected &= np.isin(self.cell_bucket, buckets)
+        return selected
+    
+    def rollup(self, by, selected=None):
+        """
+        Sum the cube down to 'region', 'dept', 'region_dept' or None (grand total).
+        Returns (rows, valid_ratings, rating_sum, rating_sumsq).
+        """
+        if selected is None:
+            selected = np.ones(len(self.count), dtype=bool)
+        valid = selected & self.rated
+        
+        if by is None:
+            return (int(self.count[selected].sum()), int(self.count[valid].sum()),
+                    float(self.sum[valid].sum()), float(self.sumsq[valid].sum()))
+        
+        if by == 'region':
+            keys, size, shape = self.cell_region, self.shape[0], None
+        elif by == 'dept':
+            keys, size, shape = self.cell_dept, self.shape[1], None
+        else:
+            keys = self.cell_region.astype(np.int64) * self.shape[1] + self.cell_dept
+            size, shape = self.shape[0] * self.shape[1], self.shape[:2]
+        
+        def total(values, cells):
+            out = np.bincount(keys[cells], weights=values[cells], minlength=size)
+            return out.reshape(shape) if shape else out
+        
+        return total(self.count, selected), total(self.count, valid), total(self.sum, valid), total(self.sumsq, valid)
+    
+    def bucket_range(self, rating_min=None, rating_max=None):
+        """
+        Bucket codes exactly covering [rating_min, rating_max], or None when the
+        bounds fall inside a bucket and only the row index can answer exactly
+        """
+        low = 1.0 if rating_min is None else float(rating_min)
+        high = 5.0 if rating_max is None else float(rating_max)
+        first = (low - 1) / RATING_INDEX_BUCKET_WIDTH
+        if low > 1.0 and first != int(first):
+            return None
+        if high < 5.0:
+            return None
+        return list(range(max(int(first), 0), self.n_buckets))
+    
+    def query(self, regions=None, departments=None, buckets=None, top_n=QUERY_DEFAULT_TOP_N, offset=0,
+              include_ranks=False):
+        """Same payload as DatasetIndex.query, answered from the cube"""
+        selected = self.mask(regions, departments, buckets)
+        total_rows, valid_ratings, rating_sum, _ = self.rollup(None, selected)
+        dept_rows, dept_valid, dept_sums, _ = self.rollup('dept', selected)
+        region_rows, region_valid, region_sums, _ = self.rollup('region', selected)
+        
+        return {
+            'total_records': total_rows,
+            'valid_ratings': valid_ratings,
+            'avg_rating': round(rating_sum / valid_ratings, 2) if valid_ratings else 0,
+            **_ranked_departments(self.departments, dept_rows[:self.n_depts],
+                                  _group_means(dept_sums[:self.n_depts], dept_valid[:self.n_depts]),
+                                  top_n, offset, include_ranks),
+            'regions': [{'name': self.regions[c], 'employees': int(region_rows[c]),
+                         'avg_rating': round(float(region_sums[c] / region_valid[c]), 2)}
+                        for c in np.flatnonzero(region_valid[:self.n_regions])]
+        }
+
+
+def get_dataset_index(file_id, sheet):
+    """إرجاع فهرس الملف أو بناؤه عند الطلب الأول"""
+    cache_key = f"{file_id}_{sheet}"
+    with lock:
+        index = dataset_indexes.get(cache_key)
+        missing = file_id not in files
+    if index is not None or missing:
+        return index
+    
+    df = load_columns(file_id, sheet)
+    df = df.dropna(how='all')
+    index = DatasetIndex(df, *FastAnalyzer(df, file_id).detect_columns())
+    with lock:
+        dataset_indexes[cache_key] = index
+        remember_cache_key(file_id, cache_key)
+    return index
+
+
+def analyze_background(file_id, sheet_name):
+    try:
+        with lock:
+            if file_id not in progress:
+                progress[file_id] = {'status': '📥 جاري قراءة...', 'progress': 1}
+        
+        logger.info(f"Reading sheet: {sheet_name}")
+        df = load_columns(file_id, sheet_name)
+        snapshots.save_frame(file_id, sheet_name, df)
+        df = df.dropna(how='all')
+        
+        logger.info(f"Loaded {len(df)} records")
+        
+        analyzer = FastAnalyzer(df, file_id)
+        result = analyzer.analyze()
+        snapshots.save_result(file_id, sheet_name, result)
+        
+        with lock:
+            analytics_cache[f"{file_id}_{sheet_name}"] = result
+            dataset_indexes[f"{file_id}_{sheet_name}"] = analyzer.index
+            remember_cache_key(file_id, f"{file_id}_{sheet_name}")
+        
+        logger.info("✓ Analysis complete")
+    except Exception as e:
+        logger.error(f"Error: {e}")
+        with lock:
+            progress[file_id] = {'status': f'❌ خطأ: {str(e)}', 'progress': 0}
+        raise
+
+
+# ============= UPLOAD SPOOL =============
+
+OLE_SIGNATURE = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'  # legacy .xls (compound document)
+
+
+class SpooledFile:
+    """An uploaded file kept in UPLOAD_DIR; parsers open it by path"""
+    
+    __slots__ = ('path', 'size', 'head')
+    
+    def __init__(self, path, size, head):
+        self.path = path
+        self.size = size
+        self.head = head
+    
+    def __len__(self):
+        return self.size
+
+
+def sniff_file_type(head):
+    """'xlsx', 'xls' or 'csv' from the first bytes of a file, None if it is none of them"""
+    if head.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    if head.startswith(OLE_SIGNATURE):
+        return 'xls'
+    if head and b'\x00' not in head:
+        return 'csv'
+    return None
+
+
+def source_head(source):
+    return source.head if isinstance(source, SpooledFile) else bytes(source[:UPLOAD_SNIFF_BYTES])
+
+
+def parser_input(source):
+    """What pandas/openpyxl should open: the spooled path, or a buffer over in-memory bytes"""
+    return source.path if isinstance(source, SpooledFile) else io.BytesIO(source)
+
+
+_upload_dir_swept = False
+
+
+def _prepare_upload_dir():
+    """Create UPLOAD_DIR; the first call also drops partial writes and stale uploads of a previous run"""
+    global _upload_dir_swept
+    os.makedirs(UPLOAD_DIR, exist_ok=True)
+    if _upload_dir_swept:
+        return
+    _upload_dir_swept = True
+    cutoff = time.time() - SESSION_TIMEOUT.total_seconds()
+    for entry in os.scandir(UPLOAD_DIR):
+        try:
+            if entry.name.endswith(('.part', '.tmp')) or entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _adopt_upload(tmp_path, file_id, size, head):
+    # The extension matters: openpyxl refuses paths that do not end in .xlsx
+    path = os.path.join(UPLOAD_DIR, f'{file_id}.{sniff_file_type(head)}')
+    if os.path.exists(path):
+        # Same content already on disk: keep that copy and refresh its age
+        os.remove(tmp_path)
+        os.utime(path)
+    else:
+        os.replace(tmp_path, path)
+    return SpooledFile(path, size, head)
+
+
+def spool_upload(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copy an upload stream into UPLOAD_DIR in fixed-size chunks, hashing as it
+    goes, and return (file_id, SpooledFile). The signature is checked as soon
+    as the first bytes arrive so a wrong file type is rejected before the rest
+    is read. Raises ValueError for empty or unrecognised content.
+    """
+    _prepare_upload_dir()
+    fd, tmp_path = tempfile.mkstemp(dir=UPLOAD_DIR, suffix='.part')
+    digest = hashlib.sha256()
+    head = b''
+    size = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                if len(head) < UPLOAD_SNIFF_BYTES:
+                    head += chunk[:UPLOAD_SNIFF_BYTES - len(head)]
+                    if len(head) == UPLOAD_SNIFF_BYTES and sniff_file_type(head) is None:
+                        raise ValueError('Unrecognised file content')
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+        if not size:
+            raise ValueError('Empty file')
+        if sniff_file_type(head) is None:
+            raise ValueError('Unrecognised file content')
+        file_id = digest.hexdigest()[:16]
+        return file_id, _adopt_upload(tmp_path, file_id, size, head)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def link_or_copy(path, target):
+    """Place `path` at `target` atomically: a hard link costs no copy, copying is the cross-filesystem fallback"""
+    tmp_path = f'{target}.{secrets.token_hex(4)}.tmp'
+    try:
+        try:
+            os.link(path, tmp_path)
+        except OSError:
+            shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, target)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def restore_upload(file_id, path):
+    """Put a file kept elsewhere (job spool, snapshot) back into UPLOAD_DIR"""
+    _prepare_upload_dir()
+    tmp_path = os.path.join(UPLOAD_DIR, f'{file_id}.{secrets.token_hex(4)}.part')
+    link_or_copy(path, tmp_path)
+    with open(tmp_path, 'rb') as f:
+        head = f.read(UPLOAD_SNIFF_BYTES)
+    return _adopt_upload(tmp_path, file_id, os.path.getsize(tmp_path), head)
+
+
+def discard_upload(source):
+    if isinstance(source, SpooledFile):
+        try:
+            os.remove(source.path)
+        except OSError:
+            pass
+
+
+class ChunkedUpload:
+    """
+    A resumable upload assembled in UPLOAD_DIR from chunks sent in order.
+
+    Each chunk carries its own sha256; a chunk that does not match (or was cut
+    off mid-transfer) is truncated away again, so `received` is always the end
+    of the last acknowledged chunk and the client resumes from there. The
+    whole-file hash is carried across chunks and becomes the file id.
+    """
+    
+    def __init__(self, upload_id, owner, filename, size, expires, checksum=None):
+        self.upload_id = upload_id
+        self.owner = owner
+        self.filename = filename
+        self.size = size
+        self.expires = expires
+        self.checksum = checksum
+        self.received = 0
+        self.head = b''
+        self.busy = threading.Lock()  # one chunk or completion at a time
+        self._digest = hashlib.sha256()
+        _prepare_upload_dir()
+        self.path = os.path.join(UPLOAD_DIR, f'{upload_id}.part')
+        open(self.path, 'wb').close()
+    
+    def describe(self):
+        return {'upload_id': self.upload_id, 'filename': self.filename, 'size': self.size,
+                'offset': self.received, 'chunk_size': CHUNKED_UPLOAD_CHUNK_SIZE,
+                'expires': self.expires.isoformat()}
+    
+    def write_chunk(self, stream, checksum):
+        """Append one chunk read from `stream` at `received`; raises ValueError and keeps nothing on failure"""
+        digest = self._digest.copy()
+        chunk_digest = hashlib.sha256()
+        head = self.head
+        written = 0
+        with open(self.path, 'r+b') as out:
+            out.seek(self.received)
+            try:
+                while True:
+                    data = stream.read(UPLOAD_CHUNK_SIZE)
+                    if not data:
+                        break
+                    if self.received + written + len(data) > self.size:
+                        raise ValueError('Chunk runs past the declared size')
+                    if len(head) < UPLOAD_SNIFF_BYTES:
+                        head += data[:UPLOAD_SNIFF_BYTES - len(head)]
+                        if len(head) == UPLOAD_SNIFF_BYTES and sniff_file_type(head) is None:
+                            raise ValueError('Unrecognised file content')
+                    chunk_digest.update(data)
+                    digest.update(data)
+                    out.write(data)
+                    written += len(data)
+                if not written:
+                    raise ValueError('Empty chunk')
+                if not hmac.compare_digest(chunk_digest.hexdigest(), checksum.lower()):
+                    raise ValueError('Chunk checksum mismatch')
+            except BaseException:
+                out.truncate(self.received)
+                raise
+        self.received += written
+        self.head = head
+        self._digest = digest
+    
+    def complete(self):
+        """Check the assembled file and move it into place; returns (file_id, SpooledFile)"""
+        if self.received != self.size:
+            raise ValueError(f'Upload incomplete: {self.received} of {self.size} bytes received')
+        if sniff_file_type(self.head) is None:
+            raise ValueError('Unrecognised file content')
+        full_digest = self._digest.hexdigest()
+        if self.checksum and not hmac.compare_digest(full_digest, self.checksum.lower()):
+            raise ValueError('File checksum mismatch')
+        file_id = full_digest[:16]
+        return file_id, _adopt_upload(self.path, file_id, self.size, self.head)
+    
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+@instrumented('excel_parse')
+def load_dataframe(source, sheet_name=None, columns=None):
+    """
+    Parse one sheet from a SpooledFile or raw bytes; returns (df, sheet_names).
+    With `columns` only those are converted (usecols); names not in the sheet are ignored.
+    """
+    usecols = None
+    if columns is not None:
+        wanted = set(columns)
+        usecols = lambda c: c in wanted
+    try:
+        excel = pd.ExcelFile(parser_input(source))
+        if sheet_name and sheet_name in excel.sheet_names:
+            use_sheet = sheet_name
+        else:
+            use_sheet = excel.sheet_names[0] if excel.sheet_names else 0
+        df = pd.read_excel(excel, sheet_name=use_sheet, usecols=usecols)
+        return df, excel.sheet_names
+    except Exception as excel_error:
+        try:
+            df = pd.read_csv(parser_input(source), usecols=usecols)
+            return df, ['Sheet1']
+        except Exception:
+            raise excel_error
+
+
+def iter_dataframe_chunks(source, sheet_name=None, columns=None, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Yield a sheet as DataFrames of at most chunk_rows rows without loading it
+    whole. xlsx is streamed through openpyxl read-only mode and CSV through
+    pandas chunks; legacy .xls cannot be streamed and is sliced after loading.
+    The index continues across chunks so row positions match load_dataframe.
+    """
+    wanted = set(columns) if columns is not None else None
+    kind = sniff_file_type(source_head(source))
+    
+    if kind == 'xlsx':
+        workbook = load_workbook(parser_input(source), read_only=True, data_only=True)
+        try:
+            if sheet_name and sheet_name in workbook.sheetnames:
+                worksheet = workbook[sheet_name]
+            else:
+                worksheet = workbook.worksheets[0]
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            header = [h if h is not None else f'Unnamed: {i}' for i, h in enumerate(header)]
+            positions = [i for i, h in enumerate(header) if wanted is None or h in wanted]
+            names = [header[i] for i in positions]
+            
+            buffer = []
+            offset = 0
+            for row in rows:
+                buffer.append([row[i] if i < len(row) else None for i in positions])
+                if len(buffer) >= chunk_rows:
+                    yield pd.DataFrame(buffer, columns=names, index=pd.RangeIndex(offset, offset + len(buffer)))
+                    offset += len(buffer)
+                    buffer = []
+            if buffer:
+                yield pd.DataFrame(buffer, columns=names, index=pd.RangeIndex(offset, offset + len(buffer)))
+        finally:
+            workbook.close()
+        return
+    
+    if kind == 'xls':
+        df, _ = load_dataframe(source, sheet_name, columns)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows]
+        return
+    
+    usecols = (lambda c: c in wanted) if wanted is not None else None
+    for chunk in pd.read_csv(parser_input(source), usecols=usecols, chunksize=chunk_rows):
+        yield chunk
+
+
+def sheet_header(source, sheet_name=None):
+    """Column names of a sheet, read from its first row only"""
+    first = next(iter_dataframe_chunks(source, sheet_name, chunk_rows=1), None)
+    return list(first.columns) if first is not None else []
+
+
+frame_cache = OrderedDict()  # (file_id, sheet, columns or None) -> (DataFrame, bytes)
+frame_cache_bytes = 0
+
+
+def remember_frame(file_id, sheet, columns, df):
+    """Keep a parsed sheet (columns=None) or projection; oldest entries go first past FRAME_CACHE_MAX_BYTES"""
+    global frame_cache_bytes
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    if size > FRAME_CACHE_MAX_BYTES:
+        return
+    key = (file_id, sheet, tuple(sorted(map(str, columns))) if columns is not None else None)
+    with lock:
+        if key in frame_cache:
+            frame_cache_bytes -= frame_cache.pop(key)[1]
+        frame_cache[key] = (df, size)
+        frame_cache_bytes += size
+        while frame_cache_bytes > FRAME_CACHE_MAX_BYTES:
+            frame_cache_bytes -= frame_cache.popitem(last=False)[1][1]
+
+
+def forget_frames(file_id=None):
+    """Drop cached frames of one file, or all of them (caller holds lock)"""
+    global frame_cache_bytes
+    for key in [k for k in frame_cache if file_id is None or k[0] == file_id]:
+        frame_cache_bytes -= frame_cache.pop(key)[1]
+
+
+def load_columns(file_id, sheet, columns=None):
+    """
+    Only the given columns of a sheet (all of them when columns is None), as a
+    DataFrame the caller may modify. Served from the smallest cached frame that
+    covers the columns; otherwise parsed with projection and cached as its own
+    entry, so narrow queries on wide sheets only pay for the columns they use.
+    """
+    wanted = None if columns is None else set(map(str, columns))
+    with lock:
+        source = files.get(file_id)
+        best = None
+        for (cached_file, cached_sheet, cached_columns), (df, size) in frame_cache.items():
+            if cached_file != file_id or cached_sheet != sheet:
+                continue
+            if cached_columns is None or (wanted is not None and wanted.issubset(cached_columns)):
+                if best is None or size < best[2]:
+                    best = ((cached_file, cached_sheet, cached_columns), df, size)
+        if best is not None:
+            frame_cache.move_to_end(best[0])
+    if source is None:
+        raise ValueError('File not found')
+    
+    if best is not None:
+        df = best[1]
+    else:
+        df = snapshots.load_frame(file_id, sheet, columns)
+        if df is None:
+            df, _ = load_dataframe(source, sheet, columns)
+        remember_frame(file_id, sheet, columns, df)
+    if columns is not None:
+        return df[[c for c in df.columns if str(c) in wanted]].copy()
+    return df.copy()
+
+
+# ============= SNAPSHOTS =============
+
+class SnapshotStore:
+    """
+    On-disk snapshots that let a restarted process serve files it has seen before.
+
+    Everything is keyed by file id (the content hash) under directory/<file_id>/:
+    the upload itself (hard-linked), a manifest with sheet names and the column
+    profile, each parsed sheet in a columnar layout (one .npy per column, text
+    dictionary-encoded with the dictionary in JSON, read back memory-mapped and
+    only for the columns asked for) and the gzipped FastAnalyzer result per
+    sheet. Nothing is pickled, so a file planted in the directory cannot run
+    code on load. Snapshots older than retention, or the oldest past max_bytes,
+    are removed after each write.
+    """
+    
+    def __init__(self, directory, max_bytes, retention):
+        self.directory = directory or None
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self._evict_lock = threading.Lock()
+    
+    def _path(self, file_id, *parts):
+        return os.path.join(self.directory, file_id, *parts)
+    
+    @staticmethod
+    def _sheet_key(sheet):
+        return hashlib.sha256(str(sheet).encode('utf-8')).hexdigest()[:16]
+    
+    def manifest(self, file_id):
+        if not self.directory or not re.fullmatch(r'[0-9a-f]{16}', file_id or ''):
+            return None
+        try:
+            with open(self._path(file_id, 'manifest.json'), encoding='utf-8') as f:
+                manifest = json.load(f)
+            os.utime(self._path(file_id))  # recently used: evicted last
+        except (OSError, ValueError):
+            return None
+        return manifest
+    
+    def source_path(self, file_id, manifest):
+        return self._path(file_id, f"source.{manifest['kind']}")
+    
+    def save_file(self, file_id, source, sheets, columns):
+        """Keep an upload and its sheet names / column profile; the manifest is written last"""
+        if not self.directory or not isinstance(source, SpooledFile):
+            return
+        kind = sniff_file_type(source.head)
+        try:
+            os.makedirs(self._path(file_id, 'frames'), exist_ok=True)
+            os.makedirs(self._path(file_id, 'results'), exist_ok=True)
+            if not os.path.exists(self._path(file_id, f'source.{kind}')):
+                link_or_copy(source.path, self._path(file_id, f'source.{kind}'))
+            manifest = {'file_id': file_id, 'kind': kind, 'size': source.size, 'sheets': sheets,
+                        'columns': columns, 'created': datetime.now().isoformat()}
+            tmp_path = self._path(file_id, f'manifest.json.{secrets.token_hex(4)}.tmp')
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(app.json.dumps(manifest))
+            os.replace(tmp_path, self._path(file_id, 'manifest.json'))
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not snapshot {file_id}: {e}")
+            return
+        self._evict()
+    
+    def has_frame(self, file_id, sheet):
+        return bool(self.directory) and os.path.exists(self._path(file_id, 'frames', self._sheet_key(sheet)))
+    
+    def save_frame(self, file_id, sheet, df):
+        """Write a parsed sheet column by column; numeric columns as they are, the rest as codes + values"""
+        if not self.directory or self.has_frame(file_id, sheet) or not os.path.isdir(self._path(file_id, 'frames')):
+            return
+        target = self._path(file_id, 'frames', self._sheet_key(sheet))
+        tmp_dir = f'{target}.{secrets.token_hex(4)}.tmp'
+        try:
+            os.makedirs(tmp_dir)
+            columns = []
+            for i, (name, series) in enumerate(df.items()):
+                entry = {'name': name, 'dtype': str(series.dtype), 'data': f'{i}.npy'}
+                if isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufmM':
+                    np.save(os.path.join(tmp_dir, entry['data']), series.to_numpy())
+                else:
+                    codes, values = pd.factorize(series, use_na_sentinel=True)
+                    values = np.asarray(values, dtype=object).tolist()
+                    if not {type(value) for value in values} <= {str, int, float, bool}:
+                        raise TypeError(f'column {name!r} holds values that are not plain text or numbers')
+                    entry['values'] = f'{i}.values.json'
+                    np.save(os.path.join(tmp_dir, entry['data']), codes.astype(np.int32))
+                    with open(os.path.join(tmp_dir, entry['values']), 'w', encoding='utf-8') as f:
+                        json.dump(values, f, ensure_ascii=False)
+                columns.append(entry)
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+                json.dump({'sheet': sheet, 'rows': len(df), 'columns': columns}, f, ensure_ascii=False)
+            os.rename(tmp_dir, target)
+        except (OSError, TypeError, ValueError) as e:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            logger.warning(f"Could not snapshot sheet {sheet} of {file_id}: {e}")
+            return
+        self._evict()
+    
+    def load_frame(self, file_id, sheet, columns=None):
+        """The snapshotted sheet, or only `columns` of it; None when there is no snapshot"""
+        if not self.directory:
+            return None
+        frame_dir = self._path(file_id, 'frames', self._sheet_key(sheet))
+        try:
+            with open(os.path.join(frame_dir, 'meta.json'), encoding='utf-8') as f:
+                meta = json.load(f)
+            wanted = None if columns is None else set(map(str, columns))
+            data = {}
+            for entry in meta['columns']:
+                if wanted is not None and str(entry['name']) not in wanted:
+                    continue
+                values = np.load(os.path.join(frame_dir, entry['data']), mmap_mode='r')
+                if 'values' in entry:
+                    codes = values
+                    with open(os.path.join(frame_dir, entry['values']), encoding='utf-8') as f:
+                        uniques = np.array(json.load(f), dtype=object)
+                    values = np.full(len(codes), np.nan, dtype=object)
+                    present = codes >= 0
+                    values[present] = uniques[codes[present]]
+                    series = pd.Series(values, dtype=object)
+                    if entry['dtype'] != 'object':
+                        series = series.astype(entry['dtype'])
+                else:
+                    series = pd.Series(values)
+                data[entry['name']] = series
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if not isinstance(e, FileNotFoundError):
+                logger.warning(f"Snapshot of sheet {sheet} of {file_id} unreadable: {e}")
+            return None
+        return pd.DataFrame(data, index=pd.RangeIndex(meta['rows']))
+    
+    def has_result(self, file_id, sheet):
+        return bool(self.directory) and os.path.exists(self._path(file_id, 'results', f'{self._sheet_key(sheet)}.json.gz'))
+    
+    def save_result(self, file_id, sheet, result):
+        if not self.directory or not os.path.isdir(self._path(file_id, 'results')):
+            return
+        path = self._path(file_id, 'results', f'{self._sheet_key(sheet)}.json.gz')
+        tmp_path = f'{path}.{secrets.token_hex(4)}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(gzip.compress(app.json.dumps(result).encode('utf-8'), RESPONSE_GZIP_LEVEL))
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Could not snapshot result of {file_id}/{sheet}: {e}")
+            return
+        self._evict()
+    
+    def load_result(self, file_id, sheet):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(file_id, 'results', f'{self._sheet_key(sheet)}.json.gz'), 'rb') as f:
+                return json.loads(gzip.decompress(f.read()))
+        except (OSError, ValueError):
+            return None
+    
+    def discard(self, file_id=None):
+        """Remove one snapshot, or all of them"""
+        if not self.directory:
+            return
+        shutil.rmtree(self._path(file_id) if file_id else self.directory, ignore_errors=True)
+    
+    def _evict(self):
+        if not self._evict_lock.acquire(blocking=False):
+            return  # another thread is already evicting
+        try:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if not entry.is_dir():
+                    continue
+                size = 0
+                for root, _, names in os.walk(entry.path):
+                    for name in names:
+                        try:
+                            size += os.path.getsize(os.path.join(root, name))
+                        except OSError:
+                            pass
+                entries.append((entry.stat().st_mtime, size, entry.name))
+            
+            cutoff = time.time() - self.retention.total_seconds()
+            total = sum(e[1] for e in entries)
+            for mtime, size, file_id in sorted(entries):
+                if total <= self.max_bytes and mtime >= cutoff:
+                    break
+                self.discard(file_id)
+                total -= size
+                logger.info(f"🧹 Evicted snapshot: {file_id}")
+        except OSError as e:
+            logger.warning(f"Snapshot eviction failed: {e}")
+        finally:
+            self._evict_lock.release()
+
+
+snapshots = SnapshotStore(SNAPSHOT_DIR, SNAPSHOT_MAX_BYTES, SNAPSHOT_RETENTION)
+
+
+def file_available(file_id):
+    """True if the file is loaded, restoring it from its snapshot after a restart"""
+    if not file_id:
+        return False
+    with lock:
+        if file_id in files:
+            return True
+    manifest = snapshots.manifest(file_id)
+    if manifest is None:
+        return False
+    try:
+        restored = restore_upload(file_id, snapshots.source_path(file_id, manifest))
+    except OSError as e:
+        logger.warning(f"Snapshot of {file_id} has no usable upload: {e}")
+        return False
+    with lock:
+        files.setdefault(file_id, restored)
+        lease_file(file_id, datetime.now() + SESSION_TIMEOUT)
+        if snapshots.has_result(file_id, manifest['sheets'][0]):
+            progress.setdefault(file_id, {'status': '✅ اكتمل!', 'progress': 100})
+    logger.info(f"♻️ Restored {file_id} from snapshot")
+    return True
+
+
+def restore_result(file_id, sheet):
+    """Put a sheet's snapshotted analysis back into analytics_cache; True if it is cached now"""
+    cache_key = f"{file_id}_{sheet}"
+    if cache_key in analytics_cache:
+        return True
+    result = snapshots.load_result(file_id, sheet)
+    if result is None:
+        return False
+    with lock:
+        analytics_cache.setdefault(cache_key, result)
+        remember_cache_key(file_id, cache_key)
+    return True
+
+
+# ============= PERIOD HISTORY =============
+
+PERIOD_PATTERN = re.compile(r'(\d{4})(?:-(H[12]|Q[1-4]|0[1-9]|1[0-2]))?')
+PERIOD_STEPS = {'H': 2, 'Q': 4, 'M': 12}
+
+
+def parse_period(label):
+    """
+    '2025', '2025-H1', '2025-Q3' or '2025-07' -> (label, position in years).
+    Positions put mixed granularities on one time axis (2025-H2 = 2025-Q3 = 2025.5).
+    """
+    match = PERIOD_PATTERN.fullmatch(str(label or '').strip().upper())
+    if match is None:
+        raise ValueError(f'Invalid period "{label}". Use YYYY, YYYY-H1, YYYY-Q3 or YYYY-MM')
+    year, part = int(match.group(1)), match.group(2)
+    if part is None:
+        return match.group(0), float(year)
+    kind = part[0] if part[0] in 'HQ' else 'M'
+    number = int(part[1:]) if kind != 'M' else int(part)
+    return match.group(0), year + (number - 1) / PERIOD_STEPS[kind]
+
+
+def shift_period(label, steps):
+    """The label `steps` periods after `label`, at the same granularity"""
+    label, _ = parse_period(label)
+    year, _, part = label.partition('-')
+    if not part:
+        return str(int(year) + steps)
+    kind = part[0] if part[0] in 'HQ' else 'M'
+    per_year = PERIOD_STEPS[kind]
+    number = int(part[1:]) if kind != 'M' else int(part)
+    year, index = divmod(int(year) * per_year + number - 1 + steps, per_year)
+    return f'{year}-{kind}{index + 1}' if kind != 'M' else f'{year}-{index + 1:02d}'
+
+
+def _fit_trends(x, means, observed):
+    """
+    Least-squares line through each row's observed (period, mean) points, all rows at once.
+    Returns (slope, intercept, x_bar, sxx, residual_std, points); NaN where undefined.
+    """
+    points = observed.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        x_bar = np.where(observed, x, 0.0).sum(axis=1) / points
+        y_bar = np.where(observed, means, 0.0).sum(axis=1) / points
+        dx = np.where(observed, x - x_bar[:, None], 0.0)
+        dy = np.where(observed, means - y_bar[:, None], 0.0)
+        sxx = (dx * dx).sum(axis=1)
+        slope = np.where(sxx > 0, (dx * dy).sum(axis=1) / sxx, np.nan)
+        intercept = y_bar - slope * x_bar
+        residuals = np.where(observed, means - (intercept[:, None] + slope[:, None] * x), 0.0)
+        residual_std = np.where(points > 2, np.sqrt((residuals * residuals).sum(axis=1) / (points - 2)), np.nan)
+    return slope, intercept, x_bar, sxx, residual_std, points
+
+
+def _rounded(value, digits=2):
+    return round(float(value), digits) if np.isfinite(value) else None
+
+
+class PeriodStore:
+    """
+    Compact history of tagged uploads for trend analysis.
+
+    Tagging an analysed sheet with a period (2025-H1) stores, per company,
+    region and department, the row count and the count, sum and sum of squares
+    of valid ratings - the sufficient statistics for means, spreads and
+    pooled figures. Trend, growth and forecast queries read only these rows
+    from SQLite, so they never touch the old workbooks. One sheet per period:
+    tagging a period again replaces its statistics.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = None
+    
+    def _connect(self):
+        try:
+            if not self.path:
+                raise OSError('PERIOD_DB is empty')
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Period store unavailable ({e}); trend history will not survive a restart")
+            db = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+        db.execute("""CREATE TABLE IF NOT EXISTS periods (
+            period TEXT PRIMARY KEY, position REAL NOT NULL, file_id TEXT NOT NULL, sheet TEXT NOT NULL,
+            recorded_at REAL NOT NULL)""")
+        db.execute("""CREATE TABLE IF NOT EXISTS period_stats (
+            period TEXT NOT NULL, scope TEXT NOT NULL, group_key TEXT NOT NULL, name TEXT NOT NULL,
+            rows INTEGER NOT NULL, n INTEGER NOT NULL, total REAL NOT NULL, total_sq REAL NOT NULL,
+            PRIMARY KEY (scope, group_key, period))""")
+        return db
+    
+    def _sql(self, query, params=()):
+        with self._lock:
+            if self._db is None:
+                self._db = self._connect()
+            cursor = self._db.execute(query, params)
+            return cursor.fetchall() if cursor.description else cursor.rowcount
+    
+    def record(self, period, file_id, sheet, index):
+        """Store the company / region / department statistics of one indexed sheet under `period`"""
+        label, position = parse_period(period)
+        rows, n, total, total_sq = index.cube.rollup(None)
+        stats = [('all', '', '', rows, n, total, total_sq)]
+        for scope in ('region', 'dept'):
+            stats += [(scope, key, name, int(employees), int(valid), float(rating_sum), float(rating_sumsq))
+                      for key, name, employees, valid, rating_sum, rating_sumsq
+                      in index.group_totals(scope).itertuples()]
+        
+        with self._lock:
+            if self._db is None:
+                self._db = self._connect()
+            try:
+                self._db.execute('BEGIN')
+                self._db.execute('DELETE FROM period_stats WHERE period = ?', (label,))
+                self._db.executemany('INSERT INTO period_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     [(label, *entry) for entry in stats])
+                self._db.execute('INSERT OR REPLACE INTO periods VALUES (?, ?, ?, ?, ?)',
+                                 (label, position, file_id, str(sheet), time.time()))
+                self._db.execute('COMMIT')
+            except sqlite3.Error:
+                self._db.execute('ROLLBACK')
+                raise
+        
+        logger.info(f"📅 Period {label}: {file_id}/{sheet}, {len(stats) - 1} groups")
+        return {'period': label, 'file_id': file_id, 'sheet': str(sheet), 'employees': rows,
+                'avg_rating': round(total / n, 2) if n else 0,
+                'regions': len(index.group_totals('region')), 'departments': len(index.group_totals('dept'))}
+    
+    def remove(self, period):
+        label, _ = parse_period(period)
+        self._sql('DELETE FROM period_stats WHERE period = ?', (label,))
+        return self._sql('DELETE FROM periods WHERE period = ?', (label,)) > 0
+    
+    def periods(self):
+        """Tagged periods in time order with their company-wide figures"""
+        rows = self._sql("""SELECT p.period, p.file_id, p.sheet, p.recorded_at, s.rows, s.n, s.total
+            FROM periods p LEFT JOIN period_stats s ON s.scope = 'all' AND s.group_key = '' AND s.period = p.period
+            ORDER BY p.position""")
+        return [{'period': period, 'file_id': file_id, 'sheet': sheet,
+                 'recorded_at': datetime.fromtimestamp(recorded_at).isoformat(),
+                 'employees': employees or 0, 'avg_rating': round(total / n, 2) if n else 0}
+                for period, file_id, sheet, recorded_at, employees, n, total in rows]
+    
+    def trend(self, scope='all', groups=None, start=None, end=None, forecast=0):
+        """
+        Per-group series, growth and a linear forecast `forecast` periods ahead.
+        Every group is fitted at once on a groups × periods matrix of means.
+        """
+        where, params = '', []
+        if start:
+            where += ' AND position >= ?'
+            params.append(parse_period(start)[1])
+        if end:
+            where += ' AND position <= ?'
+            params.append(parse_period(end)[1])
+        period_rows = self._sql(f'SELECT period, position FROM periods WHERE 1 = 1{where} ORDER BY position',
+                                params)
+        labels = [label for label, _ in period_rows]
+        x = np.array([position for _, position in period_rows], dtype=float)
+        
+        query = """SELECT s.period, s.group_key, s.name, s.rows, s.n, s.total, s.total_sq
+            FROM period_stats s JOIN periods p ON p.period = s.period WHERE s.scope = ?""" + where.replace(
+            'position', 'p.position')
+        params = [scope] + params
+        if groups:
+            keys = sorted({canonical_group(scope, name) for name in groups})
+            query += f" AND s.group_key IN ({', '.join('?' * len(keys))})"
+            params += keys
+        stat_rows = self._sql(query + ' ORDER BY p.position', params)
+        
+        period_code = {label: i for i, label in enumerate(labels)}
+        group_code, names = {}, []
+        shape = (len({row[1] for row in stat_rows}), len(labels))
+        employees, n, total, total_sq = (np.zeros(shape) for _ in range(4))
+        for period, key, name, rows, count, rating_sum, rating_sq in stat_rows:
+            g = group_code.setdefault(key, len(group_code))
+            if g == len(names):
+                names.append(name)
+            names[g] = name  # rows come in time order: the latest spelling wins
+            p = period_code[period]
+            employees[g, p], n[g, p], total[g, p], total_sq[g, p] = rows, count, rating_sum, rating_sq
+        
+        observed = n > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = total / n
+            std = np.sqrt(np.maximum(total_sq - n * means * means, 0) / (n - 1))
+        slope, intercept, x_bar, sxx, residual_std, points = _fit_trends(x, means, observed)
+        
+        forecast = max(0, min(int(forecast), PERIOD_FORECAST_MAX)) if labels else 0
+        future = [shift_period(labels[-1], step) for step in range(1, forecast + 1)]
+        
+        results = []
+        for g, key in enumerate(group_code):
+            seen = np.flatnonzero(observed[g])
+            if not len(seen):
+                continue  # staffed in range but never rated: nothing to trend
+            series = [{'period': labels[p], 'employees': int(employees[g, p]), 'valid_ratings': int(n[g, p]),
+                       'avg_rating': _rounded(means[g, p]), 'std': _rounded(std[g, p])} for p in seen]
+            first, last = seen[0], seen[-1]
+            growth = {
+                'first_period': labels[first], 'last_period': labels[last],
+                'change': _rounded(means[g, last] - means[g, first]),
+                'change_pct': _rounded((means[g, last] / means[g, first] - 1) * 100, 1),
+                'last_change': _rounded(means[g, last] - means[g, seen[-2]]) if len(seen) > 1 else None,
+                'slope_per_year': _rounded(slope[g], 3)
+            }
+            predicted = []
+            if np.isfinite(slope[g]):
+                df_resid = int(points[g]) - 2
+                t = T_QUANTILES_975[df_resid - 1] if 0 < df_resid <= len(T_QUANTILES_975) else 1.96
+                for label in future:
+                    position = parse_period(label)[1]
+                    value = intercept[g] + slope[g] * position
+                    margin = t * residual_std[g] * np.sqrt(1 + 1 / points[g] + (position - x_bar[g]) ** 2 / sxx[g])
+                    predicted.append({'period': label, 'avg_rating': _rounded(np.clip(value, 1, 5)),
+                                      'low': _rounded(np.clip(value - margin, 1, 5)),
+                                      'high': _rounded(np.clip(value + margin, 1, 5))})
+            results.append({'name': names[g], 'key': key, 'latest_avg_rating': _rounded(means[g, last]),
+                            'series': series, 'growth': growth, 'forecast': predicted})
+        
+        return {'scope': scope, 'periods': labels, 'forecast_periods': future, 'groups': results}
+    
+    def company_forecast(self):
+        """Company-wide history and next-period forecast, or None with fewer than two periods"""
+        history = self.trend('all', forecast=1)
+        if len(history['periods']) < 2 or not history['groups']:
+            return None
+        company = history['groups'][0]
+        return {'periods': history['periods'], 'series': company['series'], 'growth': company['growth'],
+                'forecast': company['forecast'][0] if company['forecast'] else None}
+
+
+period_store = PeriodStore(PERIOD_DB)
+
+
+def record_period(period, file_id, sheet):
+    """وسم ورقة محللة بفترة زمنية وحفظ إحصاءاتها المختصرة في سجل الاتجاهات"""
+    index = get_dataset_index(file_id, sheet)
+    if index is None:
+        raise ValueError('File not found')
+    return period_store.record(period, file_id, sheet, index)
+
+
+# ============= JOB SCHEDULER =============
+
+class JobScheduler:
+    """
+    Runs all background work (sheet analysis, async AI runs) on a fixed pool.
+
+    Jobs are queued per priority class and, inside a class, per session; the
+    dispatcher always serves the highest class and rotates between sessions,
+    so one user's 10-sheet upload cannot starve another's first sheet. Every
+    state change is written to SQLite; on startup queued jobs are re-queued and
+    jobs that were running are retried up to JOB_MAX_ATTEMPTS times. A job's
+    file is spooled to disk until no unfinished job needs it.
+    """
+    
+    def __init__(self, directory, workers):
+        self.directory = directory
+        self.spool_dir = os.path.join(directory, 'spool')
+        self.workers = workers
+        self.handlers = {}
+        self._cond = threading.Condition()
+        self._db_lock = threading.Lock()
+        self._queues = {priority: OrderedDict() for priority in JOB_PRIORITY_NAMES}  # session -> deque of ids
+        self._active = {}  # job id -> in-memory state of queued/running jobs
+        self._keys = {}    # dedupe key -> job id
+        self._running = 0
+        self._db = None
+        self._started = False
+    
+    def handler(self, kind):
+        """Register the function run for jobs of this kind: func(payload) -> JSON-able result"""
+        def decorator(func):
+            self.handlers[kind] = func
+            return func
+        return decorator
+    
+    # --- storage ---
+    
+    def _connect(self):
+        try:
+            os.makedirs(self.spool_dir, exist_ok=True)
+            db = sqlite3.connect(os.path.join(self.directory, 'jobs.sqlite3'), check_same_thread=False,
+                                 isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Job store unavailable ({e}); jobs will not survive a restart")
+            self.spool_dir = None
+            db = sqlite3.connect(':memory:', check_same_thread=False, isolation_level=None)
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY, kind TEXT NOT NULL, priority INTEGER NOT NULL, status TEXT NOT NULL,
+            owner TEXT, session TEXT, file_id TEXT, dedupe_key TEXT, payload TEXT NOT NULL,
+            result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL, started_at REAL, finished_at REAL)""")
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, created_at)')
+        return db
+    
+    def _sql(self, query, params=()):
+        with self._db_lock:
+            cursor = self._db.execute(query, params)
+            return cursor.fetchall() if cursor.description else cursor.rowcount
+    
+    def spool(self, file_id, source):
+        if self.spool_dir is None:
+            return
+        path = os.path.join(self.spool_dir, file_id)
+        if os.path.exists(path):
+            return
+        try:
+            if isinstance(source, SpooledFile):
+                link_or_copy(source.path, path)
+            else:
+                tmp_path = f'{path}.{secrets.token_hex(4)}.tmp'
+                with open(tmp_path, 'wb') as f:
+                    f.write(source)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not spool {file_id}: {e}")
+    
+    def spool_path(self, file_id):
+        if self.spool_dir is None:
+            return None
+        path = os.path.join(self.spool_dir, file_id)
+        return path if os.path.exists(path) else None
+    
+    def _release_spool(self, file_id):
+        if not file_id or self.spool_dir is None:
+            return
+        with self._cond:
+            if any(job['file_id'] == file_id for job in self._active.values()):
+                return
+        try:
+            os.remove(os.path.join(self.spool_dir, file_id))
+        except OSError:
+            pass
+    
+    # --- lifecycle ---
+    
+    def start(self):
+        """Open the store, recover unfinished jobs and start the workers (idempotent, post-fork safe)"""
+        if self._started:
+            return
+        with self._cond:
+            if self._started:
+                return
+            self._db = self._connect()
+            self._recover()
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f'job-worker-{i}', daemon=True).start()
+            self._started = True
+    
+    def _recover(self):
+        self._sql("DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND finished_at < ?",
+                  (time.time() - JOB_RETENTION.total_seconds(),))
+        rows = self._sql("SELECT id, kind, priority, session, file_id, dedupe_key, payload, attempts, status "
+                         "FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at")
+        recovered = 0
+        for job_id, kind, priority, session, file_id, key, payload, attempts, status in rows:
+            if kind not in self.handlers or attempts >= JOB_MAX_ATTEMPTS:
+                self._sql("UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+                          ('Interrupted by restart', time.time(), job_id))
+                continue
+            if status == 'running':
+                self._sql("UPDATE jobs SET status = 'queued' WHERE id = ?", (job_id,))
+            self._track(job_id, kind, priority, session, file_id, key, json.loads(payload), self.handlers[kind])
+            recovered += 1
+        
+        if self.spool_dir is not None:
+            needed = {job['file_id'] for job in self._active.values()}
+            for name in os.listdir(self.spool_dir):
+                if name not in needed:
+                    try:
+                        os.remove(os.path.join(self.spool_dir, name))
+                    except OSError:
+                        pass
+        if recovered:
+            logger.info(f"♻️ Re-queued {recovered} unfinished jobs")
+    
+    # --- queueing ---
+    
+    def _track(self, job_id, kind, priority, session, file_id, key, payload, runner):
+        # Caller holds self._cond
+        self._active[job_id] = {'kind': kind, 'priority': priority, 'session': session, 'file_id': file_id,
+                                'key': key, 'payload': payload, 'runner': runner, 'status': 'queued'}
+        if key is not None:
+            self._keys[key] = job_id
+        self._queues[priority].setdefault(session, deque()).append(job_id)
+    
+    def submit(self, kind, payload, priority=JOB_BATCH, owner=None, session=None, file_id=None, key=None,
+               source=None):
+        """
+        Queue a job and return its id. A job with the same dedupe key that is
+        still queued or running is reused (promoted if this call asks for a
+        higher priority, and given any payload values this call adds).
+        """
+        self.start()
+        if file_id and source is not None:
+            self.spool(file_id, source)
+        with self._cond:
+            if key is not None and key in self._keys:
+                job_id = self._keys[key]
+                self._merge(job_id, payload)
+                self._promote(job_id, priority)
+                return job_id
+            
+            job_id = secrets.token_hex(8)
+            self._sql("INSERT INTO jobs (id, kind, priority, status, owner, session, file_id, dedupe_key, payload, "
+                      "created_at) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?)",
+                      (job_id, kind, priority, owner, session, file_id, key, json.dumps(payload), time.time()))
+            # A profiled request keeps its profile open until the job has run
+            self._track(job_id, kind, priority, session, file_id, key, payload,
+                        profiler.wrap(self.handlers[kind], f'job.{kind}'))
+            self._cond.notify()
+        return job_id
+    
+    def _merge(self, job_id, payload):
+        # Caller holds self._cond. A running job may have read its payload
+        # already, so it runs once more with the merged one when it finishes.
+        job = self._active[job_id]
+        if all(job['payload'].get(name) == value for name, value in payload.items()):
+            return
+        job['payload'] = {**job['payload'], **payload}
+        if job['status'] == 'running':
+            job['rerun'] = True
+        self._sql("UPDATE jobs SET payload = ? WHERE id = ?", (json.dumps(job['payload']), job_id))
+    
+    def _promote(self, job_id, priority):
+        # Caller holds self._cond
+        job = self._active[job_id]
+        if job['status'] != 'queued' or priority >= job['priority']:
+            return
+        queue = self._queues[job['priority']].get(job['session'])
+        if queue is not None and job_id in queue:
+            queue.remove(job_id)
+            if not queue:
+                del self._queues[job['priority']][job['session']]
+        job['priority'] = priority
+        self._queues[priority].setdefault(job['session'], deque()).append(job_id)
+        self._sql("UPDATE jobs SET priority = ? WHERE id = ?", (priority, job_id))
+    
+    def promote(self, key, priority=JOB_INTERACTIVE):
+        """Move a queued job ahead, e.g. when a user starts waiting for its result"""
+        with self._cond:
+            if key in self._keys:
+                self._promote(self._keys[key], priority)
+    
+    def _next(self):
+        # Caller holds self._cond. Highest class first, round-robin between sessions
+        for priority in sorted(self._queues):
+            sessions_queued = self._queues[priority]
+            if sessions_queued:
+                session, queue = next(iter(sessions_queued.items()))
+                job_id = queue.popleft()
+                del sessions_queued[session]
+                if queue:
+                    sessions_queued[session] = queue
+                return job_id
+        return None
+    
+    def _work(self):
+        while True:
+            with self._cond:
+                job_id = self._next()
+                while job_id is None:
+                    self._cond.wait()
+                    job_id = self._next()
+                job = self._active[job_id]
+                job['status'] = 'running'
+                self._running += 1
+            
+            try:
+                claimed = self._sql("UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 "
+                                    "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+                if claimed:
+                    result = error = None
+                    status = 'done'
+                    try:
+                        result = job['runner'](job['payload'])
+                        while self._finish_or_rerun(job_id, job):
+                            result = self.handlers[job['kind']](job['payload'])
+                    except Exception as e:
+                        logger.error(f"Job {job_id} ({job['kind']}) failed: {e}")
+                        status, error = 'failed', str(e)
+                    self._sql("UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?",
+                              (status, app.json.dumps(result) if result is not None else None, error,
+                               time.time(), job_id))
+            except sqlite3.Error as e:
+                logger.error(f"Job store error for {job_id}: {e}")
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    del self._active[job_id]
+                    if job['key'] is not None and self._keys.get(job['key']) == job_id:
+                        del self._keys[job['key']]
+                self._release_spool(job['file_id'])
+    
+    def _finish_or_rerun(self, job_id, job):
+        # Checked and released in one step so a later submit either merges
+        # into this run or starts a new job, never neither
+        with self._cond:
+            if job.pop('rerun', False):
+                return True
+            if self._keys.get(job['key']) == job_id:
+                del self._keys[job['key']]
+            return False
+    
+    def cancel_queued(self):
+        """Drop every job that has not started yet (used by /clear)"""
+        with self._cond:
+            cancelled = {job_id: self._active.pop(job_id) for job_id, job in list(self._active.items())
+                         if job['status'] == 'queued'}
+            for job in cancelled.values():
+                if job['key'] is not None:
+                    self._keys.pop(job['key'], None)
+            for queues in self._queues.values():
+                queues.clear()
+        for job_id, job in cancelled.items():
+            getattr(job['runner'], 'cancel', lambda: None)()
+            self._sql("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'queued'",
+                      (time.time(), job_id))
+        for file_id in {job['file_id'] for job in cancelled.values()}:
+            self._release_spool(file_id)
+        return len(cancelled)
+    
+    # --- status ---
+    
+    @staticmethod
+    def _describe(row, with_result=False):
+        (job_id, kind, priority, status, owner, file_id, payload, result, error, attempts,
+         created_at, started_at, finished_at) = row
+        
+        def iso(ts):
+            return datetime.fromtimestamp(ts).isoformat(timespec='seconds') if ts else None
+        
+        job = {
+            'job_id': job_id,
+            'kind': kind,
+            'priority': JOB_PRIORITY_NAMES.get(priority, priority),
+            'status': status,
+            'file_id': file_id,
+            'sheet': json.loads(payload).get('sheet'),
+            'attempts': attempts,
+            'error': error,
+            'created_at': iso(created_at),
+            'started_at': iso(started_at),
+            'finished_at': iso(finished_at),
+            'wait_seconds': round((started_at or time.time()) - created_at, 3),
+            'run_seconds': round((finished_at or time.time()) - started_at, 3) if started_at else None
+        }
+        if with_result and result is not None:
+            job['result'] = app.json.loads(result)
+        return job
+    
+    _COLUMNS = ('id, kind, priority, status, owner, file_id, payload, result, error, attempts, '
+                'created_at, started_at, finished_at')
+    
+    def get(self, job_id):
+        self.start()
+        rows = self._sql(f"SELECT {self._COLUMNS} FROM jobs WHERE id = ?", (job_id,))
+        return (self._describe(rows[0], with_result=True), rows[0][4]) if rows else (None, None)
+    
+    def jobs_for(self, owner, limit=JOB_LIST_LIMIT):
+        self.start()
+        rows = self._sql(f"SELECT {self._COLUMNS} FROM jobs WHERE owner = ? ORDER BY created_at DESC LIMIT ?",
+                         (owner, limit))
+        return [self._describe(row) for row in rows]
+    
+    def latest(self, key):
+        """Most recent job for a dedupe key as (status, error), or None"""
+        with self._cond:
+            if key in self._keys:
+                return self._active[self._keys[key]]['status'], None
+        if self._db is None:
+            return None
+        rows = self._sql("SELECT status, error FROM jobs WHERE dedupe_key = ? ORDER BY created_at DESC LIMIT 1",
+                         (key,))
+        return rows[0] if rows else None
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.workers,
+                'running': self._running,
+                'queued': {JOB_PRIORITY_NAMES[p]: sum(len(q) for q in queues.values())
+                           for p, queues in self._queues.items()},
+                'sessions_waiting': len({s for queues in self._queues.values() for s in queues})
+            }
+
+
+job_scheduler = JobScheduler(JOB_DIR, JOB_WORKERS)
+
+
+def session_key(request):
+    """Stable, non-secret id of the caller's session (fair-queuing unit)"""
+    token = request.headers.get('X-Session-Token') or ''
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+def job_file(file_id):
+    """The uploaded file for a job, restored from the job spool after a restart"""
+    with lock:
+        source = files.get(file_id)
+    if source is None:
+        path = job_scheduler.spool_path(file_id)
+        if path is None:
+            if not file_available(file_id):
+                raise ValueError('File not found')
+            with lock:
+                return files[file_id]
+        restored = restore_upload(file_id, path)
+        with lock:
+            source = files.setdefault(file_id, restored)
+            lease_file(file_id, datetime.now() + SESSION_TIMEOUT)
+    return source
+
+
+@job_scheduler.handler('analyze_sheet')
+def analyze_sheet_job(payload):
+    file_id, sheet = payload['file_id'], payload['sheet']
+    if f"{file_id}_{sheet}" not in analytics_cache:
+        job_file(file_id)  # restores the file from the spool after a restart
+        analyze_background(file_id, sheet)
+    if payload.get('period'):
+        record_period(payload['period'], file_id, sheet)
+
+
+@app.before_request
+def start_job_scheduler():
+    job_scheduler.start()
+
+
+# ============= RESPONSE ENCODING =============
+
+class NumpyJSONProvider(DefaultJSONProvider):
+    """JSON provider that encodes NumPy scalars and arrays natively.
+
+    Uses orjson when it is installed and falls back to the standard library for
+    anything orjson rejects, so handlers can return NumPy values as they are.
+    """
+    
+    ORJSON_OPTIONS = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS) if orjson else 0
+    
+    @staticmethod
+    def default(o):
+        if isinstance(o, np.ndarray):
+            return o.tolist()
+        if isinstance(o, np.generic):
+            return o.item()
+        return DefaultJSONProvider.default(o)
+    
+    def dumps(self, obj, **kwargs):
+        if orjson is not None:
+            try:
+                return orjson.dumps(obj, default=self.default, option=self.ORJSON_OPTIONS).decode()
+            except TypeError:
+                pass
+        return super().dumps(obj, **kwargs)
+    
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            try:
+                return orjson.loads(s)
+            except ValueError:
+                pass
+        return super().loads(s, **kwargs)
+
+
+app.json = NumpyJSONProvider(app)
+
+
+def negotiate_encoding(accept_encodings):
+    """Pick the best content coding the client accepts (brotli only if installed)."""
+    offered = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return accept_encodings.best_match(offered)
+
+
+@app.after_request
+def compress_response(response):
+    """Compress text and JSON responses according to Accept-Encoding."""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < RESPONSE_COMPRESS_MIN_BYTES:
+        return response
+    
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding == 'br':
+        body = brotli.compress(body, quality=RESPONSE_BROTLI_QUALITY)
+    elif encoding == 'gzip':
+        body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL, mtime=0)
+    else:
+        return response
+    
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    # A strong ETag identifies one representation, so tag each encoding separately
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(f'{etag}-{encoding}')
+    return response
+
+
+def request_params(list_params=()):
+    """Parameters from the JSON body (POST) or the query string (GET)."""
+    if request.method in ('GET', 'HEAD'):
+        params = request.args.to_dict()
+        for name in list_params:
+            if name in request.args:
+                params[name] = request.args.getlist(name)
+        return params
+    return request.get_json(silent=True) or {}
+
+
+def result_etag(file_id, sheet, **params):
+    """Strong ETag from the dataset fingerprint (file_id) and the request parameters."""
+    key = json.dumps([RESULT_FORMAT_VERSION, request.path, file_id, sheet, params],
+                     sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+
+def not_modified(etag, cache_control=ANALYTICS_CACHE_CONTROL):
+    """304 response when If-None-Match matches `etag` or one of its encoded variants."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+    for variant in (etag, f'{etag}-br', f'{etag}-gzip'):
+        if request.if_none_match.contains_weak(variant):
+            response = app.response_class(status=304)
+            response.set_etag(variant)
+            response.headers['Cache-Control'] = cache_control
+            response.vary.add('Accept-Encoding')
+            return response
+    return None
+
+
+def cacheable_json(payload, etag):
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = ANALYTICS_CACHE_CONTROL
+    return response
+
+
+def encode_cursor(offset):
+    """Opaque paging cursor for position `offset` in an immutable result list."""
+    return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    if not cursor:
+        return 0
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        offset = int(payload['offset'])
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('Invalid cursor')
+    if offset < 0:
+        raise ValueError('Invalid cursor')
+    return offset
+
+
+def page_limit(value, default):
+    if value in (None, ''):
+        return default
+    return max(1, min(int(value), MAX_RESPONSE_PAGE_SIZE))
+
+
+def paginate(items, cursor=None, limit=DEPT_DETAILS_PAGE_SIZE):
+    """Slice one page out of `items`; returns (page, next_cursor or None)."""
+    start = decode_cursor(cursor)
+    end = start + limit
+    return items[start:end], (encode_cursor(end) if end < len(items) else None)
+
+
+def page_regional_data(regional_data, limit=DEPT_DETAILS_PAGE_SIZE):
+    """First page of dept_details per region; the rest via /regional-departments."""
+    paged = {}
+    for name, region in regional_data.items():
+        details, next_cursor = paginate(region.get('dept_details', []), None, limit)
+        paged[name] = dict(region, dept_details=details, dept_details_next=next_cursor)
+    return paged
+
+
+def page_chart(result, cursor=None, limit=CHART_LABELS_PAGE_SIZE):
+    """Page chart labels and slice every dataset's data to the same window."""
+    start = decode_cursor(cursor)
+    labels, next_cursor = paginate(result['labels'], cursor, limit)
+    end = start + len(labels)
+    paged = dict(result, labels=labels, total_labels=len(result['labels']), next_cursor=next_cursor)
+    paged['datasets'] = [dict(dataset, data=dataset['data'][start:end]) for dataset in result['datasets']]
+    return paged
+
+
+# ============= STATIC ASSETS =============
+
+class StaticAssetManifest:
+    """
+    In-memory manifest of the front-end files.
+
+    Every asset is read once at startup, fingerprinted by content hash and
+    precompressed with gzip (and brotli when installed). References to other
+    assets inside HTML are rewritten to the fingerprinted names, which are
+    served with immutable cache headers; the plain names stay available but
+    must be revalidated. Requests never touch the filesystem.
+    """
+    
+    def __init__(self, base_dir, names):
+        self.entries = {}
+        self.fingerprinted = {}
+        for name in sorted(names, key=lambda n: n.endswith('.html')):
+            path = os.path.join(base_dir, name)
+            if not os.path.isfile(path):
+                logger.warning(f"⚠️ Static asset missing: {name}")
+                continue
+            with open(path, 'rb') as f:
+                body = f.read()
+            if name.endswith('.html'):
+                body = self._rewrite_references(body)
+            self._add(name, body)
+        logger.info(f"✓ Static assets ready: {', '.join(self.fingerprinted.values())}")
+    
+    def _rewrite_references(self, body):
+        text = body.decode('utf-8')
+        for name, hashed in self.fingerprinted.items():
+            pattern = r'''((?:src|href)=["'])''' + re.escape(name) + r'''(["'])'''
+            text = re.sub(pattern, lambda m: f'{m.group(1)}{hashed}{m.group(2)}', text)
+        return text.encode('utf-8')
+    
+    def _add(self, name, body):
+        digest = hashlib.sha256(body).hexdigest()[:12]
+        stem, ext = os.path.splitext(name)
+        hashed = f'{stem}.{digest}{ext}'
+        
+        variants = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            variants['br'] = brotli.compress(body, quality=11)
+        entry = {
+            'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'etag': digest,
+            'variants': variants
+        }
+        self.entries[name] = dict(entry, cache_control=STATIC_REVALIDATE_CACHE_CONTROL)
+        self.entries[hashed] = dict(entry, cache_control=STATIC_IMMUTABLE_CACHE_CONTROL)
+        self.fingerprinted[name] = hashed
+    
+    def response(self, name):
+        entry = self.entries.get(name)
+        if entry is None:
+            return None
+        
+        cached = not_modified(entry['etag'], entry['cache_control'])
+        if cached is not None:
+            return cached
+        
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding not in entry['variants']:
+            encoding = 'identity'
+        response = app.response_class(entry['variants'][encoding], mimetype=entry['mimetype'])
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+        response.set_etag(entry['etag'] if encoding == 'identity' else f"{entry['etag']}-{encoding}")
+        response.headers['Cache-Control'] = entry['cache_control']
+        response.vary.add('Accept-Encoding')
+        return response
+
+
+_assets_started = time.perf_counter()
+static_assets = StaticAssetManifest(BASE_DIR, STATIC_ASSETS)
+startup_timings['static_assets'] = time.perf_counter() - _assets_started
+
+
+def serve_static_asset(name):
+    return static_assets.response(name)
+
+
+@app.route('/')
+def index():
+    return serve_static_asset('index.html')
+
+
+# One explicit rule per asset: unknown paths reach the 404 handler below
+# instead of being swallowed by a catch-all route
+for _asset_name in static_assets.entries:
+    app.add_url_rule(f'/{_asset_name}', endpoint=f'asset:{_asset_name}', view_func=serve_static_asset,
+                     defaults={'name': _asset_name})
+
+
+@app.errorhandler(404)
+def not_found(e):
+    return jsonify({'error': 'Not found'}), 404
+
+
+# ============= AUTHENTICATION ENDPOINTS =============
+
+@app.route('/login', methods=['POST'])
+def login():
+    """تسجيل دخول المستخدم"""
+    try:
+        data = request.get_json()
+        username = data.get('username', '').strip()
+        password = data.get('password', '').strip()
+        client_ip = request.remote_addr
+        
+        if not username or not password:
+            return jsonify({'error': 'Username and password required'}), 400
+        
         # Rate limiting: Check failed attempts
         with lock:
             if client_ip in login_attempts:
@@ -645,27 +3389,25 @@ def login():
         # Verify credentials
         if username != DEFAULT_USERNAME:
             with lock:
-                if client_ip not in login_attempts:
-                    login_attempts[client_ip] = (1, datetime.now())
-                else:
-                    attempts, _ = login_attempts[client_ip]
-                    login_attempts[client_ip] = (attempts + 1, datetime.now())
+                note_failed_login(client_ip)
             return jsonify({'error': 'Invalid username or password'}), 401
         
-        # Verify password using bcrypt
+        # Verify password using bcrypt, on the bounded hashing pool
+        if not login_slots.acquire(blocking=False):
+            return jsonify({'error': 'Too many logins in progress. Try again shortly.'}), 503, {'Retry-After': '1'}
         try:
-            is_valid = bcrypt.checkpw(password.encode(), DEFAULT_PASSWORD_HASH.encode())
-        except:
-            # Fallback to simple comparison if bcrypt fails
-            is_valid = (password == 'admin123456')
+            is_valid = login_hash_executor.submit(bcrypt.checkpw, password.encode(),
+                                                  DEFAULT_PASSWORD_HASH.encode()).result()
+        except Exception as e:
+            # Never fall back to a plaintext comparison: a hashing failure is a failed login
+            logger.error(f"Password check failed: {e}")
+            is_valid = False
+        finally:
+            login_slots.release()
         
         if not is_valid:
             with lock:
-                if client_ip not in login_attempts:
-                    login_attempts[client_ip] = (1, datetime.now())
-                else:
-                    attempts, _ = login_attempts[client_ip]
-                    login_attempts[client_ip] = (attempts + 1, datetime.now())
+                note_failed_login(client_ip)
             return jsonify({'error': 'Invalid username or password'}), 401
         
         # Reset failed attempts
@@ -673,17 +3415,15 @@ def login():
             if client_ip in login_attempts:
                 del login_attempts[client_ip]
         
-        # Create authenticated session
-        session_token = secrets.token_urlsafe(32)
+        # Create authenticated session: a signed token, plus a registry entry for the per-IP cap
+        session_token, claims = issue_session_token(username, client_ip)
+        session_data = session_from_claims(claims)
         with lock:
-            sessions[session_token] = {
-                'username': username,
-                'ip': client_ip,
-                'login_time': datetime.now(),
-                'expires': datetime.now() + SESSION_TIMEOUT,
-                'authenticated': True,
-                'file_id': None
-            }
+            if sessions_per_ip.get(client_ip, 0) >= MAX_SESSIONS_PER_IP:
+                return jsonify({'error': 'Too many active sessions from this address. Log out elsewhere first.'}), 429
+            sessions[claims['jti']] = session_data
+            sessions_per_ip[client_ip] = sessions_per_ip.get(client_ip, 0) + 1
+            reaper.schedule('session', claims['jti'], session_data['expires'])
         
         logger.info(f'✓ User "{username}" logged in from IP: {client_ip}')
         return jsonify({
@@ -703,16 +3443,14 @@ def logout():
     """تسجيل خروج المستخدم"""
     try:
         token = request.headers.get('X-Session-Token')
+        claims, error = verify_session_token(token, request.remote_addr)
+        if error:
+            return jsonify({'error': 'Invalid session'}), 401
         
         with lock:
-            if token in sessions:
-                username = sessions[token].get('username', 'unknown')
-                client_ip = sessions[token].get('ip', 'unknown')
-                del sessions[token]
-                logger.info(f'✓ User "{username}" logged out from IP: {client_ip}')
-                return jsonify({'success': True, 'message': 'Logged out successfully'}), 200
-        
-        return jsonify({'error': 'Invalid session'}), 401
+            revoke_session_token(claims)
+        logger.info(f'✓ User "{claims["u"]}" logged out from IP: {claims["ip"]}')
+        return jsonify({'success': True, 'message': 'Logged out successfully'}), 200
         
     except Exception as e:
         logger.error(f"Logout error: {e}")
@@ -724,21 +3462,16 @@ def auth_check():
     """التحقق من حالة المستخدم الحالي"""
     try:
         token = request.headers.get('X-Session-Token')
+        claims, error = verify_session_token(token, request.remote_addr)
+        if error:
+            return jsonify({'authenticated': False}), 401
         
-        with lock:
-            if not token or token not in sessions:
-                return jsonify({'authenticated': False}), 401
-            
-            session_data = sessions[token]
-            if session_data['expires'] < datetime.now():
-                del sessions[token]
-                return jsonify({'authenticated': False}), 401
-            
-            return jsonify({
-                'authenticated': True,
-                'username': session_data['username'],
-                'login_time': session_data['login_time'].isoformat()
-            }), 200
+        session_data = session_from_claims(claims)
+        return jsonify({
+            'authenticated': True,
+            'username': session_data['username'],
+            'login_time': session_data['login_time'].isoformat()
+        }), 200
         
     except Exception as e:
         logger.error(f"Auth check error: {e}")
@@ -748,34 +3481,12 @@ def auth_check():
 # ============= PROTECTED ENDPOINTS =============
 
 def check_auth(request):
-    """Helper function to check authentication"""
-    token = request.headers.get('X-Session-Token')
-    
-    with lock:
-        if token not in sessions:
-            return None, 'Invalid session', 401
-        
-        session_data = sessions[token]
-        if session_data['expires'] < datetime.now():
-            del sessions[token]
-            return None, 'Session expired', 401
-        
-        # Update last activity time
-        session_data['last_activity'] = datetime.now()
-        
-        return session_data, None, None
-
+    """Helper function to check authentication: verifies the signed token, no session table lookup"""
+    claims, error = verify_session_token(request.headers.get('X-Session-Token'), request.remote_addr)
+    if error:
+        return None, error, 401
+    return session_from_claims(claims), None, None
 
-@app.route('/')
-def index():
-    return send_from_directory(BASE_DIR, 'index.html')
-
-@app.route('/<path:path>')
-def serve_static(path):
-    file_path = os.path.join(BASE_DIR, path)
-    if os.path.exists(file_path):
-        return send_from_directory(BASE_DIR, path)
-    return jsonify({'error': 'Not found'}), 404
 
 @app.route('/init-session', methods=['GET'])
 def init_session():
@@ -788,54 +3499,39 @@ def init_session():
         
         logger.info(f"✓ Session initialized for user: {session_data['username']}")
         return jsonify({
-            'success': True,
-            'session_token': request.headers.get('X-Session-Token'),
-            'username': session_data['username']
-        }), 200
-        
-    except Exception as e:
-        logger.error(f"Session init error: {e}")
-        return jsonify({'error': str(e)}), 500
-
-@app.route('/upload', methods=['POST'])
-def upload():
-    """Upload file for authenticated user"""
-    try:
-        # Check authentication
-        session_data, error, status = check_auth(request)
-        if error:
-            logger.error(f"Auth error on upload: {error}")
-            return jsonify({'error': error}), status
-        
-        if 'file' not in request.files:
-            logger.error("No file in request")
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        if not file.filename:
-            logger.error("Empty filename")
-            return jsonify({'error': 'No filename'}), 400
-        
-        if not file.filename.lower().endswith(('.xlsx', '.xls', '.csv')):
-            logger.error(f"Invalid file type: {file.filename}")
-            return jsonify({'error': 'Only Excel/CSV files allowed'}), 400
-        
-        file_bytes = file.read()
-        if not file_bytes:
-            logger.error("Empty file content")
-            return jsonify({'error': 'Empty file'}), 400
-        
-        file_id = hashlib.sha256(file_bytes).hexdigest()[:16]
-        
-        with lock:
-            files[file_id] = file_bytes
-            progress[file_id] = {'status': '✓ تم التحميل', 'progress': 0}
-            session_data['file_id'] = file_id
-        
-        logger.info(f"File: {file.filename} ({len(file_bytes)} bytes)")
+            'success': True,
+            'session_token': request.headers.get('X-Session-Token'),
+            'username': session_data['username']
+        }), 200
         
+    except Exception as e:
+        logger.error(f"Session init error: {e}")
+        return jsonify({'error': str(e)}), 500
+
+def accept_upload(file_id, source, filename, session_data, period=None):
+    """
+    تسجيل ملف مرفوع، قراءة أعمدته وجدولة تحليل أوراقه؛ مشتركة بين /upload والرفع المجزأ
+    مع period تُحفظ إحصاءات الورقة الأولى في سجل الاتجاهات بعد تحليلها
+    """
+    # Seen before, possibly by an earlier process: sheets, columns and results come from the snapshot
+    manifest = snapshots.manifest(file_id)
+    with lock:
+        files[file_id] = source
+        # A re-upload of an analysed file queues no jobs, so keep its finished progress
+        if manifest is not None and snapshots.has_result(file_id, manifest['sheets'][0]):
+            progress.setdefault(file_id, {'status': '✅ اكتمل!', 'progress': 100})
+        progress.setdefault(file_id, {'status': '✓ تم التحميل', 'progress': 0})
+        lease_file(file_id, session_data['expires'])
+    
+    logger.info(f"File: {filename} ({len(source)} bytes)")
+    
+    if manifest is not None:
+        sheets, enhanced_columns = manifest['sheets'], manifest['columns']
+        logger.info(f"♻️ Snapshot hit for {file_id}: {len(sheets)} sheets")
+    else:
         try:
-            df_first, sheets = load_dataframe(file_bytes)
+            df_first, sheets = load_dataframe(source)
+            remember_frame(file_id, sheets[0], None, df_first)
             columns_list = [col for col in df_first.columns.tolist()]
             
             # Analyze each column for numeric data
@@ -863,34 +3559,187 @@ def upload():
         except Exception as e:
             logger.error(f"Data load error: {str(e)}")
             return jsonify({'error': f'Failed to read file: {str(e)}'}), 400
+        snapshots.save_file(file_id, source, sheets, enhanced_columns)
+    
+    # The first sheet is what the dashboard opens, so it goes ahead of the rest
+    jobs = {}
+    for i, sheet in enumerate(sheets):
+        if f"{file_id}_{sheet}" in analytics_cache or snapshots.has_result(file_id, sheet):
+            continue
+        payload = {'file_id': file_id, 'sheet': sheet}
+        if period and i == 0:
+            payload['period'] = period
+        jobs[sheet] = job_scheduler.submit(
+            'analyze_sheet', payload,
+            priority=JOB_INTERACTIVE if i == 0 else JOB_BATCH,
+            owner=session_data['username'], session=session_key(request),
+            file_id=file_id, key=f'analyze:{file_id}:{sheet}', source=source
+        )
+    
+    # Already analysed: the first sheet can go into the history right away
+    if period and sheets[0] not in jobs:
+        record_period(period, file_id, sheets[0])
+    
+    logger.info(f"✓ Upload successful: file_id={file_id}, columns={len(enhanced_columns)}")
+    return jsonify({'success': True, 'sheets': sheets, 'file_id': file_id, 'columns': enhanced_columns,
+                    'jobs': jobs, 'period': period}), 200
+
+
+@app.route('/upload', methods=['POST'])
+def upload():
+    """Upload file for authenticated user"""
+    try:
+        # Check authentication
+        session_data, error, status = check_auth(request)
+        if error:
+            logger.error(f"Auth error on upload: {error}")
+            return jsonify({'error': error}), status
+        
+        if 'file' not in request.files:
+            logger.error("No file in request")
+            return jsonify({'error': 'No file provided'}), 400
         
-        for sheet in sheets:
-            thread = threading.Thread(
-                target=analyze_background,
-                args=(file_id, sheet, file_bytes),
-                daemon=True
-            )
-            thread.start()
+        file = request.files['file']
+        if not file.filename:
+            logger.error("Empty filename")
+            return jsonify({'error': 'No filename'}), 400
+        
+        if not file.filename.lower().endswith(('.xlsx', '.xls', '.csv')):
+            logger.error(f"Invalid file type: {file.filename}")
+            return jsonify({'error': 'Only Excel/CSV files allowed'}), 400
         
-        logger.info(f"✓ Upload successful: file_id={file_id}, columns={len(columns_list)}")
-        return jsonify({'success': True, 'sheets': sheets, 'file_id': file_id, 'columns': enhanced_columns}), 200
+        period = request.form.get('period') or None
+        try:
+            if period:
+                period, _ = parse_period(period)
+            file_id, source = spool_upload(file.stream)
+        except ValueError as e:
+            logger.error(f"Rejected upload {file.filename}: {e}")
+            return jsonify({'error': str(e)}), 400
+        
+        return accept_upload(file_id, source, file.filename, session_data, period)
         
     except Exception as e:
         logger.error(f"Upload error: {str(e)}", exc_info=True)
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
-@app.route('/progress', methods=['GET'])
-def get_progress():
-    token = request.headers.get('X-Session-Token')
+@app.route('/upload/chunked', methods=['POST'])
+def start_chunked_upload():
+    """بدء رفع مجزأ قابل للاستئناف: يعيد upload_id وحجم الجزء المقترح"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
     
+    data = request.get_json(silent=True) or {}
+    filename = str(data.get('filename') or '')
+    if not filename.lower().endswith(('.xlsx', '.xls', '.csv')):
+        return jsonify({'error': 'Only Excel/CSV files allowed'}), 400
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid size'}), 400
+    if size <= 0:
+        return jsonify({'error': 'Empty file'}), 400
+    if size > app.config['MAX_CONTENT_LENGTH']:
+        return jsonify({'error': 'File too large'}), 413
+    
+    upload = ChunkedUpload(secrets.token_hex(8), session_data['username'], filename, size,
+                           session_data['expires'], data.get('sha256'))
     with lock:
-        if token not in sessions:
-            return jsonify({'error': 'Invalid session'}), 401
-        
-        session_data = sessions[token]
-        if session_data['expires'] < datetime.now():
-            del sessions[token]
-            return jsonify({'error': 'Session expired'}), 401
+        chunked_uploads[upload.upload_id] = upload
+        reaper.schedule('chunked_upload', upload.upload_id, upload.expires)
+    
+    logger.info(f"Chunked upload {upload.upload_id} started: {filename} ({size} bytes)")
+    return jsonify({'success': True, **upload.describe()}), 200
+
+
+def get_chunked_upload(upload_id, session_data):
+    """الرفع المجزأ الخاص بالمستخدم، مع تمديد صلاحيته حتى نهاية جلسته الحالية"""
+    with lock:
+        upload = chunked_uploads.get(upload_id)
+        if upload is None or upload.owner != session_data['username']:
+            return None
+        if upload.expires < session_data['expires']:
+            upload.expires = session_data['expires']
+            reaper.schedule('chunked_upload', upload_id, upload.expires)
+    return upload
+
+
+@app.route('/upload/chunked/<upload_id>', methods=['GET', 'PUT'])
+def chunked_upload_part(upload_id):
+    """GET: الموضع الذي يُستأنف منه الرفع. PUT: إضافة جزء عند ?offset= مع ترويسة X-Chunk-SHA256"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    upload = get_chunked_upload(upload_id, session_data)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    if request.method == 'GET':
+        return jsonify(upload.describe()), 200
+    
+    checksum = request.headers.get('X-Chunk-SHA256')
+    if not checksum:
+        return jsonify({'error': 'Missing X-Chunk-SHA256', 'offset': upload.received}), 400
+    try:
+        offset = int(request.args.get('offset', ''))
+    except ValueError:
+        return jsonify({'error': 'Invalid offset', 'offset': upload.received}), 400
+    
+    if not upload.busy.acquire(blocking=False):
+        return jsonify({'error': 'Another chunk is being written', 'offset': upload.received}), 409
+    try:
+        if offset != upload.received:
+            return jsonify({'error': 'Unexpected offset', 'offset': upload.received}), 409
+        upload.write_chunk(request.stream, checksum)
+    except ValueError as e:
+        logger.warning(f"Chunk rejected for upload {upload_id} at {offset}: {e}")
+        return jsonify({'error': str(e), 'offset': upload.received}), 400
+    finally:
+        upload.busy.release()
+    
+    return jsonify({'success': True, 'offset': upload.received,
+                    'complete': upload.received == upload.size}), 200
+
+
+@app.route('/upload/chunked/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """إنهاء الرفع المجزأ: التحقق من الملف كاملاً ثم قراءته وجدولة تحليله كما في /upload"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    upload = get_chunked_upload(upload_id, session_data)
+    if upload is None:
+        return jsonify({'error': 'Upload not found'}), 404
+    period = (request.get_json(silent=True) or {}).get('period') or None
+    if period:
+        try:
+            period, _ = parse_period(period)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    if not upload.busy.acquire(blocking=False):
+        return jsonify({'error': 'Another chunk is being written', 'offset': upload.received}), 409
+    try:
+        file_id, source = upload.complete()
+    except ValueError as e:
+        return jsonify({'error': str(e), 'offset': upload.received}), 400
+    finally:
+        upload.busy.release()
+    with lock:
+        chunked_uploads.pop(upload_id, None)
+    
+    try:
+        return accept_upload(file_id, source, upload.filename, session_data, period)
+    except Exception as e:
+        logger.error(f"Upload error: {str(e)}", exc_info=True)
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+@app.route('/progress', methods=['GET'])
+def get_progress():
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
     
     file_id = request.args.get('file_id')
     if not file_id:
@@ -902,63 +3751,120 @@ def get_progress():
     
     return jsonify({'progress': 0, 'status': 'Processing'}), 200
 
-@app.route('/analytics', methods=['POST'])
+@app.route('/analytics', methods=['GET', 'POST'])
 def analytics():
-    token = request.headers.get('X-Session-Token')
-    
-    with lock:
-        if token not in sessions:
-            return jsonify({'error': 'Invalid session'}), 401
-        
-        session_data = sessions[token]
-        if session_data['expires'] < datetime.now():
-            del sessions[token]
-            return jsonify({'error': 'Session expired'}), 401
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
     
-    data = request.get_json()
+    data = request_params()
     file_id = data.get('file_id')
     sheet = data.get('sheet')
     
     if not file_id or not sheet:
         return jsonify({'error': 'Missing params'}), 400
     
+    try:
+        dept_limit = page_limit(data.get('dept_details_limit'), DEPT_DETAILS_PAGE_SIZE)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid dept_details_limit'}), 400
+    
     cache_key = f"{file_id}_{sheet}"
+    etag = result_etag(file_id, sheet, dept_details_limit=dept_limit)
+    if file_available(file_id):
+        cached = not_modified(etag)
+        if cached is not None:
+            return cached
+        restore_result(file_id, sheet)
+    
+    # Someone is waiting for this sheet now: move its analysis ahead of batch work
+    job_key = f'analyze:{file_id}:{sheet}'
+    job_scheduler.promote(job_key)
     
     for i in range(600):
         if cache_key in analytics_cache:
             with lock:
                 result = analytics_cache[cache_key].copy()
-            return jsonify(result), 200
+            # Long department lists are paged; the rest comes from /regional-departments
+            result['regional_data'] = page_regional_data(result.get('regional_data', {}), dept_limit)
+            return cacheable_json(result, etag), 200
+        
+        if i % 10 == 0:
+            job = job_scheduler.latest(job_key)
+            if cache_key in analytics_cache:
+                continue
+            if job is None:
+                return jsonify({'error': 'No analysis for this file/sheet'}), 404
+            if job[0] in ('failed', 'cancelled'):
+                return jsonify({'error': job[1] or 'Analysis cancelled', 'status': job[0]}), 500
         
-        import time
         time.sleep(0.1)
     
     return jsonify({'error': 'Timeout'}), 202
 
 
-@app.route('/get-columns', methods=['POST'])
-def get_columns():
-    """إرجاع قائمة الأعمدة في الملف مع نوع البيانات"""
-    token = request.headers.get('X-Session-Token')
+@app.route('/regional-departments', methods=['POST'])
+def regional_departments():
+    """
+    الصفحات التالية من أقسام منطقة واحدة (dept_details) باستخدام المؤشر
+    """
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    data = request.get_json() or {}
+    file_id = data.get('file_id')
+    sheet = data.get('sheet')
+    region = data.get('region')
     
+    if not file_id or not sheet or not region:
+        return jsonify({'error': 'Missing params (file_id, sheet, region)'}), 400
+    
+    restore_result(file_id, sheet)
     with lock:
-        if token not in sessions:
-            return jsonify({'error': 'Invalid session'}), 401
-        
-        session_data = sessions[token]
-        if session_data['expires'] < datetime.now():
-            del sessions[token]
-            return jsonify({'error': 'Session expired'}), 401
+        result = analytics_cache.get(f"{file_id}_{sheet}")
+    if result is None:
+        return jsonify({'error': 'Analysis not ready'}), 404
     
-    data = request.get_json()
+    region_data = result.get('regional_data', {}).get(region)
+    if region_data is None:
+        return jsonify({'error': f'Region "{region}" not found'}), 404
+    
+    try:
+        limit = page_limit(data.get('limit'), DEPT_DETAILS_PAGE_SIZE)
+        details, next_cursor = paginate(region_data['dept_details'], data.get('cursor'), limit)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'region': region,
+        'dept_details': details,
+        'total': len(region_data['dept_details']),
+        'next_cursor': next_cursor
+    }), 200
+
+
+@app.route('/get-columns', methods=['GET', 'POST'])
+def get_columns():
+    """إرجاع قائمة الأعمدة في الملف مع نوع البيانات"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    data = request_params()
     file_id = data.get('file_id')
     sheet = data.get('sheet', 'Sheet1')
     
-    if not file_id or file_id not in files:
+    if not file_available(file_id):
         return jsonify({'error': 'File not found'}), 404
     
+    etag = result_etag(file_id, sheet)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    
     try:
-        df, _ = load_dataframe(files[file_id], sheet)
+        df = load_columns(file_id, sheet)
         
         # Analyze each column for numeric capability
         columns_info = []
@@ -977,30 +3883,23 @@ def get_columns():
             
             logger.info(f"  Column '{col}': {numeric_count}/{total_count} numeric ({column_info['numeric_percentage']}%)")
         
-        return jsonify({
+        return cacheable_json({
             'columns': columns_info,
             'total_rows': len(df)
-        }), 200
+        }, etag), 200
     except Exception as e:
         logger.error(f"get_columns error: {str(e)}")
         return jsonify({'error': str(e)}), 400
 
 
-@app.route('/analyze-custom', methods=['POST'])
+@app.route('/analyze-custom', methods=['GET', 'POST'])
 def analyze_custom():
     """تحليل مخصص بأعمدة محددة - يدعم أعمدة تقييم متعددة"""
-    token = request.headers.get('X-Session-Token')
-    
-    with lock:
-        if token not in sessions:
-            return jsonify({'error': 'Invalid session'}), 401
-        
-        session_data = sessions[token]
-        if session_data['expires'] < datetime.now():
-            del sessions[token]
-            return jsonify({'error': 'Session expired'}), 401
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
     
-    data = request.get_json()
+    data = request_params(list_params=('rating_columns',))
     file_id = data.get('file_id')
     sheet = data.get('sheet', 'Sheet1')
     dept_col = data.get('dept_column')
@@ -1009,15 +3908,20 @@ def analyze_custom():
     if not file_id or not dept_col or not rating_cols:
         return jsonify({'error': 'Missing columns'}), 400
     
-    if file_id not in files:
+    if not file_available(file_id):
         return jsonify({'error': 'File not found'}), 404
     
     # Convert single column to list
     if isinstance(rating_cols, str):
         rating_cols = [rating_cols]
     
+    etag = result_etag(file_id, sheet, dept_column=dept_col, rating_columns=rating_cols)
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    
     try:
-        df, _ = load_dataframe(files[file_id], sheet)
+        df = load_columns(file_id, sheet, [dept_col] + list(rating_cols))
         df = df.dropna(how='all')
         
         # Validate columns exist
@@ -1028,39 +3932,33 @@ def analyze_custom():
             if rating_col not in df.columns:
                 return jsonify({'error': f'Column "{rating_col}" not found'}), 400
         
-        all_ratings = []
         column_results = {}
+        total_valid = 0
+        total_sum = 0.0
         
-        # تحليل كل عمود تقييم
-        for rating_col in rating_cols:
-            ratings = []
-            for val in df[rating_col]:
-                r = _convert_rating(val)
-                if r:
-                    ratings.append(r)
-                    all_ratings.append({'col': rating_col, 'rating': r})
+        with metrics.stage('groupby.custom'):
+            dept_codes, dept_names = _factorize_sorted(df[dept_col])
+            dept_rows = np.bincount(dept_codes[dept_codes >= 0], minlength=len(dept_names))
             
-            depts = {}
-            for dept, group in df.groupby(dept_col, observed=True):
-                dept_ratings = []
-                for val in group[rating_col]:
-                    r = _convert_rating(val)
-                    if r:
-                        dept_ratings.append(r)
+            # تحليل كل عمود تقييم
+            for rating_col in rating_cols:
+                ratings = _convert_ratings(df[rating_col])
+                valid = ~np.isnan(ratings)
+                total_valid += int(valid.sum())
+                total_sum += float(ratings[valid].sum())
                 
-                if dept_ratings:
-                    depts[str(dept)] = {
-                        'count': len(group),
-                        'avg': round(np.mean(dept_ratings), 2)
-                    }
-            
-            top_depts = sorted(depts.items(), key=lambda x: x[1]['avg'], reverse=True)[:10]
-            
-            column_results[rating_col] = {
-                'valid_ratings': len(ratings),
-                'avg': round(np.mean(ratings), 2) if ratings else 0,
-                'top_departments': [{'name': d[0], 'rating': d[1]['avg'], 'employees': d[1]['count']} for d in top_depts]
-            }
+                rated = valid & (dept_codes >= 0)
+                dept_counts = np.bincount(dept_codes[rated], minlength=len(dept_names))
+                dept_sums = np.bincount(dept_codes[rated], weights=ratings[rated], minlength=len(dept_names))
+                dept_means = _group_means(dept_sums, dept_counts)
+                top_codes, _ = rank_extremes(dept_means, 10)
+                
+                column_results[rating_col] = {
+                    'valid_ratings': int(valid.sum()),
+                    'avg': round(float(ratings[valid].mean()), 2) if valid.any() else 0,
+                    'top_departments': [{'name': str(dept_names[c]), 'rating': float(dept_means[c]),
+                                         'employees': int(dept_rows[c])} for c in top_codes]
+                }
         
         # دمج نتائج كل الأعمدة
         combined_top_depts = {}
@@ -1086,8 +3984,8 @@ def analyze_custom():
         
         result = {
             'total_records': len(df),
-            'valid_ratings': len(all_ratings),
-            'avg_rating': round(np.mean([r['rating'] for r in all_ratings]), 2) if all_ratings else 0,
+            'valid_ratings': total_valid,
+            'avg_rating': round(total_sum / total_valid, 2) if total_valid else 0,
             'top_departments': final_top_depts[:10],
             'column_details': column_results,
             'columns_used': {
@@ -1096,13 +3994,68 @@ def analyze_custom():
             }
         }
         
-        return jsonify(result), 200
+        return cacheable_json(result, etag), 200
         
     except Exception as e:
         logger.error(f"Custom analysis error: {e}", exc_info=True)
         return jsonify({'error': str(e)}), 400
 
 
+def parse_query_paging(top_n, offset):
+    """(top_n, offset) for /query; ValueError for the caller's 400 instead of a silently wrong page"""
+    try:
+        top_n, offset = int(top_n), int(offset)
+    except (TypeError, ValueError):
+        raise ValueError('top_n and offset must be integers')
+    if not 1 <= top_n <= QUERY_MAX_TOP_N or offset < 0:
+        raise ValueError(f'top_n must be between 1 and {QUERY_MAX_TOP_N} and offset must be >= 0')
+    return top_n, offset
+
+
+@app.route('/query', methods=['POST'])
+def query():
+    """فلترة لوحة المعلومات على الخادم (المنطقة، الإدارة، نطاق التقييم) باستخدام الفهارس"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    data = request.get_json(silent=True) or {}
+    file_id = data.get('file_id')
+    sheet = data.get('sheet', 'Sheet1')
+    try:
+        top_n, offset = parse_query_paging(data.get('top_n', QUERY_DEFAULT_TOP_N), data.get('offset', 0))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not file_available(file_id):
+        return jsonify({'error': 'File not found'}), 404
+    
+    def as_list(value):
+        if not value:
+            return None
+        return value if isinstance(value, list) else [value]
+    
+    try:
+        started = time.perf_counter()
+        index = get_dataset_index(file_id, sheet)
+        result = index.query(
+            regions=as_list(data.get('region')),
+            departments=as_list(data.get('department')),
+            rating_min=data.get('rating_min'),
+            rating_max=data.get('rating_max'),
+            top_n=top_n,
+            offset=offset,
+            include_ranks=bool(data.get('include_ranks'))
+        )
+        if data.get('include_facets'):
+            result['facets'] = index.facets()
+        result['query_time_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        return jsonify(result), 200
+    except Exception as e:
+        logger.error(f"Query error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+
+
 def _convert_rating(val):
     """تحويل التقييم لرقم"""
     try:
@@ -1145,6 +4098,16 @@ def _convert_rating(val):
         return None
 
 
+@instrumented('rating_normalization')
+def _convert_ratings(series):
+    """تحويل عمود كامل: كل قيمة مميزة تُحوّل مرة واحدة، والقيم غير الصالحة NaN"""
+    codes, values = pd.factorize(series)
+    if not len(values):
+        return np.full(len(series), np.nan)
+    converted = np.array([_convert_rating(v) or np.nan for v in values], dtype=float)
+    return np.where(codes >= 0, converted[codes], np.nan)
+
+
 @app.route('/dynamic-analysis', methods=['POST'])
 def dynamic_analysis():
     """
@@ -1165,28 +4128,44 @@ def dynamic_analysis():
         group_by = data.get('group_by')
         chart_type = data.get('chart_type', 'bar')
         aggregation = data.get('aggregation', 'avg')
+        cursor = data.get('cursor')
+        
+        try:
+            limit = page_limit(data.get('limit'), CHART_LABELS_PAGE_SIZE)
+            decode_cursor(cursor)
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
         
         logger.info(f"📊 Dynamic analysis requested: X={x_column}, Y={y_column}")
         
         if not file_id or not x_column or not y_column:
             return jsonify({'error': 'Missing required columns (file_id, x_column, y_column)'}), 400
         
-        if file_id not in files:
+        if not file_available(file_id):
             return jsonify({'error': 'File not found'}), 404
         
+        # Department / region axes over the rating column are rolled up from the cube
+        with lock:
+            index = dataset_indexes.get(f"{file_id}_{sheet_name}")
+        if index is not None:
+            result_data = cube_dynamic_chart(index, x_column, y_column, group_by, aggregation, chart_type)
+            if result_data is not None:
+                logger.info(f"✅ Dynamic analysis served from cube: {x_column} vs {y_column}")
+                return jsonify(page_chart(result_data, cursor, limit)), 200
+        
         try:
-            df, _ = load_dataframe(files[file_id], sheet_name)
+            df = load_columns(file_id, sheet_name, [c for c in (x_column, y_column, group_by) if c])
         except Exception as e:
             logger.error(f"Failed to load file: {str(e)}")
             return jsonify({'error': f'Failed to load file: {str(e)}'}), 400
         
         # Validate columns exist
         if x_column not in df.columns:
-            available = list(df.columns)
+            available = sheet_header(files[file_id], sheet_name)
             return jsonify({'error': f'Column "{x_column}" not found. Available: {available}'}), 400
             
         if y_column not in df.columns:
-            available = list(df.columns)
+            available = sheet_header(files[file_id], sheet_name)
             return jsonify({'error': f'Column "{y_column}" not found. Available: {available}'}), 400
         
         if group_by and group_by not in df.columns:
@@ -1196,7 +4175,7 @@ def dynamic_analysis():
         result_data = process_dynamic_chart(df, x_column, y_column, group_by, aggregation, chart_type)
         
         logger.info(f"✅ Dynamic analysis complete: {x_column} vs {y_column}")
-        return jsonify(result_data), 200
+        return jsonify(page_chart(result_data, cursor, limit)), 200
         
     except Exception as e:
         logger.error(f"❌ Dynamic analysis error: {e}", exc_info=True)
@@ -1204,6 +4183,90 @@ def dynamic_analysis():
         return jsonify({'error': f'Analysis error: {str(e)}'}), 500
 
 
+@instrumented('groupby.dynamic_chart_cube')
+def cube_dynamic_chart(index, x_column, y_column, group_by, aggregation, chart_type):
+    """
+    نفس مخرجات process_dynamic_chart لكن من المكعب المجمّع مسبقاً.
+    يرجع None إذا لم تكن المحاور من أبعاد المكعب أو التجميع غير مدعوم.
+    """
+    columns = index.columns_used
+    axes = {columns['dept']: 'dept'}
+    # Raw region cells are grouped as written, so the canonical region axis only stands in for them 1:1
+    if columns['region'] and index.regions_verbatim:
+        axes[columns['region']] = 'region'
+    
+    if y_column != columns['rating'] or x_column not in axes or aggregation not in ('avg', 'sum', 'count'):
+        return None
+    if group_by and (group_by not in axes or axes[group_by] == axes[x_column]):
+        return None
+    
+    cube = index.cube
+    names = {'dept': cube.departments, 'region': cube.regions}
+    sizes = {'dept': cube.n_depts, 'region': cube.n_regions}
+    
+    def aggregate(valid, sums):
+        if aggregation == 'count':
+            return valid.astype(float)
+        if aggregation == 'sum':
+            return sums
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / valid
+    
+    x_axis = axes[x_column]
+    if not group_by:
+        _, valid, sums, _ = cube.rollup(x_axis)
+        codes = sorted(np.flatnonzero(valid[:sizes[x_axis]]), key=lambda c: names[x_axis][c])
+        values = aggregate(valid, sums)
+        return {
+            'chart_type': chart_type,
+            'x_column': x_column,
+            'y_column': y_column,
+            'aggregation': aggregation,
+            'labels': [names[x_axis][c] for c in codes],
+            'datasets': [{
+                'label': f'{aggregation.upper()} {y_column}',
+                'data': values[np.asarray(codes, dtype=np.intp)],
+                'backgroundColor': 'rgba(0, 133, 93, 0.8)',
+                'borderColor': '#00855D',
+                'borderWidth': 2
+            }],
+            'source': 'cube'
+        }
+    
+    group_axis = axes[group_by]
+    _, valid, sums, _ = cube.rollup('region_dept')
+    if x_axis == 'dept':
+        valid, sums = valid.T, sums.T
+    valid = valid[:sizes[x_axis], :sizes[group_axis]]
+    sums = sums[:sizes[x_axis], :sizes[group_axis]]
+    values = aggregate(valid, sums)
+    
+    x_codes = np.asarray(sorted(np.flatnonzero(valid.sum(axis=1)), key=lambda c: names[x_axis][c]), dtype=np.intp)
+    colors = ['#00855D', '#43a047', '#ffc107', '#ff9800', '#e53935', '#9c27b0']
+    datasets = []
+    for g in np.flatnonzero(valid.sum(axis=0)):
+        label = names[group_axis][g]
+        color = colors[hash(str(label)) % len(colors)]
+        datasets.append({
+            'label': label,
+            'data': np.where(valid[x_codes, g] > 0, values[x_codes, g], 0.0),
+            'backgroundColor': color,
+            'borderColor': color,
+            'borderWidth': 2
+        })
+    
+    return {
+        'chart_type': chart_type,
+        'x_column': x_column,
+        'y_column': y_column,
+        'aggregation': aggregation,
+        'labels': [names[x_axis][c] for c in x_codes],
+        'datasets': datasets,
+        'source': 'cube'
+    }
+
+
+@instrumented('groupby.dynamic_chart')
 def process_dynamic_chart(df, x_column, y_column, group_by, aggregation, chart_type):
     """معالجة البيانات للرسوم البيانية الديناميكية"""
     
@@ -1296,7 +4359,7 @@ def process_dynamic_chart(df, x_column, y_column, group_by, aggregation, chart_t
                 
                 result['datasets'].append({
                     'label': str(group_val),
-                    'data': subset.set_index(x_column).loc[labels, y_column].fillna(0).tolist(),
+                    'data': subset.set_index(subset[x_column].astype(str))[y_column].reindex(labels).fillna(0).tolist(),
                     'backgroundColor': color,
                     'borderColor': color,
                     'borderWidth': 2
@@ -1329,29 +4392,530 @@ def process_dynamic_chart(df, x_column, y_column, group_by, aggregation, chart_t
         raise
 
 
-@app.route('/clear', methods=['POST'])
-def clear():
-    token = request.headers.get('X-Session-Token')
+@app.route('/periods', methods=['GET', 'POST'])
+def periods():
+    """
+    GET: الفترات المسجلة في سجل الاتجاهات
+    POST: وسم ورقة مرفوعة بفترة (مثل 2025-H1) وحفظ إحصاءاتها؛ إعادة الوسم تستبدل الفترة
+    """
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    if request.method == 'GET':
+        return jsonify({'periods': period_store.periods()}), 200
+    
+    data = request.get_json() or {}
+    file_id = data.get('file_id')
+    sheet = data.get('sheet')
+    period = data.get('period')
+    
+    if not file_id or not sheet or not period:
+        return jsonify({'error': 'Missing params (file_id, sheet, period)'}), 400
+    if not file_available(file_id):
+        return jsonify({'error': 'File not found'}), 404
+    
+    try:
+        recorded = record_period(period, file_id, sheet)
+    except Exception as e:
+        logger.error(f"Period tagging error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'success': True, **recorded}), 200
+
+
+@app.route('/periods/<period>', methods=['DELETE'])
+def delete_period(period):
+    """حذف فترة من سجل الاتجاهات"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    try:
+        removed = period_store.remove(period)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not removed:
+        return jsonify({'error': 'Period not found'}), 404
+    return jsonify({'success': True}), 200
+
+
+@app.route('/trends', methods=['GET', 'POST'])
+def trends():
+    """
+    الاتجاه والنمو والتوقع عبر الفترات من سجل الاتجاهات دون إعادة قراءة الملفات القديمة
+    scope: all | region | dept، ويمكن تحديد groups والمدى from/to وعدد فترات التوقع forecast
+    """
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    data = request_params(list_params=('groups',))
+    scope = data.get('scope', 'all')
+    order = data.get('order', 'growth')
+    groups = data.get('groups') or None
+    if isinstance(groups, str):
+        groups = [groups]
+    
+    if scope not in ('all', 'region', 'dept'):
+        return jsonify({'error': 'Invalid scope. Available: all, region, dept'}), 400
+    if order not in PERIOD_TREND_ORDERS:
+        return jsonify({'error': f'Invalid order. Available: {list(PERIOD_TREND_ORDERS)}'}), 400
+    
+    try:
+        limit = page_limit(data.get('limit'), DEPT_DETAILS_PAGE_SIZE)
+        result = period_store.trend(scope, groups, data.get('from'), data.get('to'), data.get('forecast', 0))
+        
+        # Groups without a fitted line (a single period) go last in the growth orders
+        if order == 'name':
+            result['groups'].sort(key=lambda group: group['name'])
+        elif order == 'latest':
+            result['groups'].sort(key=lambda group: -(group['latest_avg_rating'] or 0))
+        else:
+            sign = -1 if order == 'growth' else 1
+            result['groups'].sort(key=lambda group: (group['growth']['slope_per_year'] is None,
+                                                     sign * (group['growth']['slope_per_year'] or 0)))
+        total = len(result['groups'])
+        result['groups'], result['next_cursor'] = paginate(result['groups'], data.get('cursor'), limit)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    result['total_groups'] = total
+    return jsonify(result), 200
+
+
+def _welch_test(mean_a, var_a, n_a, mean_b, var_b, n_b):
+    """Welch t statistic and two-sided p-value per element; NaN where a side has fewer than 2 ratings"""
+    from scipy.special import stdtr
+    
+    with np.errstate(invalid='ignore', divide='ignore'):
+        se_a, se_b = var_a / n_a, var_b / n_b
+        se = np.sqrt(se_a + se_b)
+        t = (mean_b - mean_a) / se
+        df = (se_a + se_b) ** 2 / (se_a ** 2 / (n_a - 1) + se_b ** 2 / (n_b - 1))
+        p_value = 2 * stdtr(df, -np.abs(t))
+    # No spread on either side: any difference is certain
+    p_value = np.where(se == 0, np.where(mean_a == mean_b, 1.0, 0.0), p_value)
+    testable = (n_a >= 2) & (n_b >= 2)
+    return np.where(testable & (se > 0), t, np.nan), np.where(testable, p_value, np.nan)
+
+
+def _moments(rating_sum, rating_sumsq, count):
+    """Mean and sample variance from sums, NaN where undefined"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = rating_sum / count
+        variance = np.maximum(rating_sumsq - count * mean * mean, 0) / (count - 1)
+    return mean, variance
+
+
+def compare_datasets(base, current, scope):
+    """
+    مقارنة ملفين لكل منطقة أو إدارة: الفرق في المتوسط، تغير الترتيب واختبار Welch للدلالة
+    المجاميع محسوبة مسبقاً في فهرس كل ملف، والمقارنة ربط واحد على المفتاح الموحد
+    """
+    joined = base.group_totals(scope).join(current.group_totals(scope), how='outer',
+                                           lsuffix='_base', rsuffix='_current')
+    present = {side: joined[f'employees_{side}'].notna().to_numpy() for side in ('base', 'current')}
+    counts = {side: joined[f'valid_ratings_{side}'].fillna(0).to_numpy() for side in ('base', 'current')}
+    means, variances, ranks = {}, {}, {}
+    for side in ('base', 'current'):
+        means[side], variances[side] = _moments(joined[f'rating_sum_{side}'].to_numpy(),
+                                                joined[f'rating_sumsq_{side}'].to_numpy(), counts[side])
+        ranks[side] = rank_positions(_group_means(np.nan_to_num(joined[f'rating_sum_{side}'].to_numpy()),
+                                                  counts[side]))
+    
+    delta = means['current'] - means['base']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        delta_pct = delta / means['base'] * 100
+    t, p_value = _welch_test(means['base'], variances['base'], counts['base'],
+                             means['current'], variances['current'], counts['current'])
+    rank_change = np.where((ranks['base'] > 0) & (ranks['current'] > 0), ranks['base'] - ranks['current'], 0)
+    status = np.where(~present['base'], 'new', np.where(~present['current'], 'removed', 'matched'))
+    
+    def side(i, name):
+        if not present[name][i]:
+            return None
+        return {'employees': int(joined[f'employees_{name}'].iat[i]), 'avg_rating': _rounded(means[name][i]),
+                'std': _rounded(np.sqrt(variances[name][i])), 'rank': int(ranks[name][i]) or None}
+    
+    groups = []
+    for i, key in enumerate(joined.index):
+        name = joined['name_current'].iat[i]
+        groups.append({
+            'name': joined['name_base'].iat[i] if pd.isna(name) else name,
+            'key': key,
+            'status': str(status[i]),
+            'base': side(i, 'base'),
+            'current': side(i, 'current'),
+            'delta': _rounded(delta[i]),
+            'delta_pct': _rounded(delta_pct[i], 1),
+            'rank_change': int(rank_change[i]),
+            't_statistic': _rounded(t[i], 3),
+            'p_value': _rounded(p_value[i], 4),
+            'significant': bool(p_value[i] < COMPARE_ALPHA)
+        })
+    
+    overall = {}
+    for name, index in (('base', base), ('current', current)):
+        rows, valid, rating_sum, rating_sumsq = index.cube.rollup(None)
+        mean, variance = _moments(np.float64(rating_sum), np.float64(rating_sumsq), np.float64(valid))
+        overall[name] = (rows, valid, mean, variance)
+    t_all, p_all = _welch_test(overall['base'][2], overall['base'][3], overall['base'][1],
+                               overall['current'][2], overall['current'][3], overall['current'][1])
+    delta_all = overall['current'][2] - overall['base'][2]
+    
+    return {
+        'scope': scope,
+        'overall': {
+            'base': {'employees': overall['base'][0], 'avg_rating': _rounded(overall['base'][2])},
+            'current': {'employees': overall['current'][0], 'avg_rating': _rounded(overall['current'][2])},
+            'delta': _rounded(delta_all),
+            't_statistic': _rounded(t_all, 3),
+            'p_value': _rounded(p_all, 4),
+            'significant': bool(p_all < COMPARE_ALPHA)
+        },
+        'summary': {
+            'matched': int((status == 'matched').sum()),
+            'new': int((status == 'new').sum()),
+            'removed': int((status == 'removed').sum()),
+            'improved': int(((p_value < COMPARE_ALPHA) & (delta > 0)).sum()),
+            'declined': int(((p_value < COMPARE_ALPHA) & (delta < 0)).sum())
+        },
+        'groups': groups
+    }
+
+
+@app.route('/compare', methods=['GET', 'POST'])
+def compare():
+    """
+    مقارنة ملف الدورة الحالية (file_id, sheet) بملف سابق (base_file_id, base_sheet)
+    حسب المنطقة أو الإدارة (scope)، مع ترتيب order وصفحات cursor/limit
+    """
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    data = request_params()
+    base_file_id = data.get('base_file_id')
+    base_sheet = data.get('base_sheet')
+    file_id = data.get('file_id')
+    sheet = data.get('sheet')
+    scope = data.get('scope', 'dept')
+    order = data.get('order', 'delta')
+    
+    if not base_file_id or not base_sheet or not file_id or not sheet:
+        return jsonify({'error': 'Missing params (base_file_id, base_sheet, file_id, sheet)'}), 400
+    if scope not in ('region', 'dept'):
+        return jsonify({'error': 'Invalid scope. Available: region, dept'}), 400
+    if order not in COMPARE_ORDERS:
+        return jsonify({'error': f'Invalid order. Available: {list(COMPARE_ORDERS)}'}), 400
+    if not file_available(base_file_id) or not file_available(file_id):
+        return jsonify({'error': 'File not found'}), 404
+    
+    etag = result_etag(file_id, sheet, base_file_id=base_file_id, base_sheet=base_sheet, scope=scope,
+                       order=order, limit=data.get('limit'), cursor=data.get('cursor'))
+    cached = not_modified(etag)
+    if cached is not None:
+        return cached
+    
+    try:
+        limit = page_limit(data.get('limit'), DEPT_DETAILS_PAGE_SIZE)
+        base = get_dataset_index(base_file_id, base_sheet)
+        current = get_dataset_index(file_id, sheet)
+        if base is None or current is None:
+            return jsonify({'error': 'File not found'}), 404
+        result = compare_datasets(base, current, scope)
+        
+        # Groups missing a value for the sort key (new, removed or unrated) go last
+        sort_keys = {
+            'delta': lambda group: -abs(group['delta']),
+            'improved': lambda group: -group['delta'],
+            'declined': lambda group: group['delta'],
+            'rank_change': lambda group: -group['rank_change'],
+            'p_value': lambda group: group['p_value'],
+        }
+        if order == 'name':
+            result['groups'].sort(key=lambda group: group['name'])
+        else:
+            field = 'p_value' if order == 'p_value' else 'delta'
+            result['groups'].sort(key=lambda group: (group[field] is None,
+                                                     0 if group[field] is None else sort_keys[order](group)))
+        result['total_groups'] = len(result['groups'])
+        result['groups'], result['next_cursor'] = paginate(result['groups'], data.get('cursor'), limit)
+    except Exception as e:
+        logger.error(f"Compare error: {str(e)}")
+        return jsonify({'error': str(e)}), 400
+    
+    result['base'] = {'file_id': base_file_id, 'sheet': base_sheet}
+    result['current'] = {'file_id': file_id, 'sheet': sheet}
+    return cacheable_json(result, etag), 200
+
+
+@app.route('/clear', methods=['POST'])
+def clear():
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    with lock:
+        for source in files.values():
+            discard_upload(source)
+        files.clear()
+        forget_frames()
+        for upload in chunked_uploads.values():
+            upload.discard()
+        chunked_uploads.clear()
+        analytics_cache.clear()
+        dataset_indexes.clear()
+        progress.clear()
+        file_leases.clear()
+        file_cache_keys.clear()
+    job_scheduler.cancel_queued()
+    snapshots.discard()
+    
+    logger.info(f'Data cleared securely for IP: {request.remote_addr}')
+    return jsonify({'success': True}), 200
+
+@app.route('/status', methods=['GET'])
+def status():
+    return jsonify({'status': 'running', 'fast': True}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus scrape endpoint: the METRICS_TOKEN bearer token or an admin
+    session; open to anyone only with METRICS_PUBLIC=1
+    """
+    token_ok = METRICS_TOKEN and hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                     f'Bearer {METRICS_TOKEN}')
+    if not token_ok and not METRICS_PUBLIC:
+        session_data, error, status = check_admin(request)
+        if error:
+            return jsonify({'error': error}), status
+    return app.response_class(metrics.render(lock.stats()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """مهام المستخدم الخلفية (الأحدث أولاً) وحالة الطابور"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    return jsonify({
+        'success': True,
+        'jobs': job_scheduler.jobs_for(session_data['username']),
+        'queue': job_scheduler.stats()
+    }), 200
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """حالة مهمة خلفية ونتيجتها عند الانتهاء"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    job, owner = job_scheduler.get(job_id)
+    if job is None or owner != session_data['username']:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(dict(job, success=True)), 200
+
+def check_admin(request):
+    """check_auth() restricted to the administrator account"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return None, error, status
+    if session_data['username'] != DEFAULT_USERNAME:
+        return None, 'Admin only', 403
+    return session_data, None, None
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+def profiler_settings():
+    """تشغيل/إيقاف التحليل الزمني لجميع الطلبات المؤهلة وتحديد عتبة البطء"""
+    session_data, error, status = check_admin(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if 'enabled' in data:
+            profiler.enabled = bool(data['enabled'])
+        if 'slow_ms' in data:
+            try:
+                slow_ms = float(data['slow_ms'] or 0)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'slow_ms must be a number'}), 400
+            if slow_ms < 0:
+                return jsonify({'error': 'slow_ms must be >= 0'}), 400
+            profiler.slow_seconds = slow_ms / 1000
+        logger.info(f"🔬 Profiler: enabled={profiler.enabled}, slow_ms={profiler.slow_seconds * 1000:.0f}")
+    
+    return jsonify({
+        'success': True,
+        'enabled': profiler.enabled,
+        'slow_ms': profiler.slow_seconds * 1000,
+        'interval_ms': profiler.interval * 1000,
+        'routes': list(PROFILE_ROUTES),
+        'capacity': profiler.ring.maxlen
+    }), 200
+
+@app.route('/admin/profiles', methods=['GET'])
+def list_profiles():
+    """قائمة الملفات الزمنية المحفوظة (الأحدث أولاً)"""
+    session_data, error, status = check_admin(request)
+    if error:
+        return jsonify({'error': error}), status
+    return jsonify({'success': True, 'profiles': profiler.profiles()}), 200
+
+@app.route('/admin/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """تنزيل ملف زمني بصيغة folded stacks لرسم flamegraph"""
+    session_data, error, status = check_admin(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    profile = profiler.get(profile_id)
+    if profile is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    response = app.response_class(profile.folded(), content_type='text/plain; charset=utf-8')
+    response.headers['Content-Disposition'] = f'attachment; filename=profile-{profile.id}.folded'
+    return response
+
+def run_ai_analysis(params):
+    """
+    التحليل الذكي لملف واحد: يعيد (النتائج، None) أو (None، رسالة الخطأ)
+    يُستدعى من /ai-analyze مباشرة أو من مهمة خلفية
+    """
+    file_id = params.get('file_id')
+    sheet = params.get('sheet')
+    dept_column = params.get('dept_column')
+    rating_columns = params.get('rating_columns', [])
+    anomaly_method = params.get('anomaly_method', 'zscore')
+    anomaly_page = params.get('anomaly_page', 1)
+    anomaly_page_size = params.get('anomaly_page_size', ANOMALY_PAGE_SIZE)
+    large_data = params.get('large_data')
+    try:
+        sample_size = min(max(int(params.get('sample_size', AI_SAMPLE_ROWS)), 1), AI_SAMPLE_MAX_ROWS)
+    except (TypeError, ValueError):
+        return None, 'sample_size must be an integer'
     
+    file_available(file_id)
     with lock:
-        if token not in sessions:
-            return jsonify({'error': 'Invalid session'}), 401
-        
-        session_data = sessions[token]
-        if session_data['expires'] < datetime.now():
-            del sessions[token]
-            return jsonify({'error': 'Session expired'}), 401
-        
-        files.clear()
-        analytics_cache.clear()
-        progress.clear()
+        file_size = len(files[file_id]) if file_id in files else None
+    if file_size is None:
+        return None, 'Invalid file ID'
+    if large_data is None:
+        large_data = file_size >= AI_LARGE_DATA_BYTES
     
-    logger.info(f'Data cleared securely for IP: {request.remote_addr}')
-    return jsonify({'success': True}), 200
+    if anomaly_method not in ANOMALY_METHODS:
+        return None, f'Unknown anomaly_method. Available: {list(ANOMALY_METHODS)}'
+    try:
+        anomaly_page, anomaly_page_size = parse_anomaly_paging(anomaly_page, anomaly_page_size)
+    except ValueError as e:
+        return None, str(e)
+    
+    # الملفات الضخمة: إحصاءات دقيقة بالتمرير على الملف، والنماذج تتدرب على عينة
+    if large_data:
+        df_clean, aggregates, error = _stream_ai_frame(file_id, sheet, dept_column, rating_columns, sample_size)
+        fingerprint = f"{file_id}:{sheet or ''}:sample{sample_size}"
+    else:
+        df_clean, error = _prepare_ai_frame(file_id, sheet, rating_columns, dept_column)
+        aggregates = None
+        fingerprint = f"{file_id}:{sheet or ''}"
+    error = error or anomaly_dept_error(anomaly_method, dept_column, df_clean)
+    if error:
+        return None, error
+    
+    # النماذج المدربة مسبقاً لنفس الملف ونفس الأعمدة
+    model_key = model_registry.make_key(fingerprint, rating_columns)
+    models = model_registry.get(model_key)
+    models_cached = models is not None
+    if not models_cached:
+        models = {}
+    
+    # الاتجاه الفعلي عبر الفترات المسجلة، إن وُجدت فترتان على الأقل
+    history = period_store.company_forecast()
+    
+    # المراحل المستقلة تعمل بالتوازي، والتوصيات تنتظر الأنماط والتصنيف
+    stages = {
+        'rating_summary': ([], lambda r: _apply_exact_moments(get_rating_summary(model_key, df_clean, rating_columns),
+                                                              aggregates)),
+        'predictions': ([], lambda r: _predict_future_performance(df_clean, rating_columns, models, history)),
+        'employee_clusters': ([], lambda r: _perform_employee_clustering(df_clean, rating_columns, models)),
+        'patterns': (['rating_summary'],
+                     lambda r: _discover_patterns(df_clean, dept_column, rating_columns, r['rating_summary'],
+                                                  aggregates)),
+        'correlations': (['rating_summary'],
+                         lambda r: _analyze_correlations(df_clean, rating_columns, r['rating_summary'])),
+        'anomalies': (['rating_summary'],
+                      lambda r: _detect_anomalies(df_clean, rating_columns, r['rating_summary'], anomaly_method,
+                                                  dept_column, anomaly_page, anomaly_page_size)),
+        'statistical_analysis': (['rating_summary'],
+                                 lambda r: _perform_statistical_analysis(df_clean, rating_columns, r['rating_summary'])),
+        'recommendations': (['patterns', 'employee_clusters', 'rating_summary'],
+                            lambda r: _generate_smart_recommendations(df_clean, r['patterns'], r['employee_clusters'],
+                                                                      r['rating_summary'])),
+    }
+    stage_results, stage_timings = run_stage_graph(stages)
+    summary = stage_results['rating_summary']
+    
+    if not models_cached and models:
+        model_registry.put(model_key, models)
+    
+    if aggregates is not None:
+        total_records = aggregates.n_rows
+        levels = aggregates.level_counts
+    else:
+        total_records = len(df_clean)
+        levels = {
+            'high': int((df_clean['avg_rating'] >= 4.0).sum()),
+            'average': int(((df_clean['avg_rating'] >= 3.0) & (df_clean['avg_rating'] < 4.0)).sum()),
+            'low': int((df_clean['avg_rating'] < 3.0).sum())
+        }
+    
+    ai_results = {
+        'success': True,
+        'total_records': total_records,
+        'models_cached': models_cached,
+        'stage_timings': stage_timings,
+        'ai_insights': {
+            'predictions': stage_results['predictions'],
+            'employee_clusters': stage_results['employee_clusters'],
+            'patterns': stage_results['patterns'],
+            'recommendations': stage_results['recommendations'],
+            'correlations': stage_results['correlations'],
+            'anomalies': stage_results['anomalies'],
+            'statistical_analysis': stage_results['statistical_analysis']
+        },
+        'summary': {
+            'high_performers': levels['high'],
+            'average_performers': levels['average'],
+            'low_performers': levels['low'],
+            'avg_overall_rating': float(summary['mean']['avg_rating']),
+            'std_overall_rating': float(summary['std']['avg_rating'])
+        }
+    }
+    
+    if aggregates is not None:
+        ai_results['large_data'] = {
+            'enabled': True,
+            'total_rows': aggregates.total_rows,
+            'valid_rows': aggregates.n_rows,
+            'sample_size': len(df_clean),
+            'sampled_figures': LARGE_DATA_SAMPLED_FIGURES,
+            'exact_figures': LARGE_DATA_EXACT_FIGURES
+        }
+    
+    logger.info(f"✅ AI Analysis completed: {total_records} records analyzed in {stage_timings['total']:.2f}s")
+    return ai_results, None
+
+
+@job_scheduler.handler('ai_analyze')
+def ai_analyze_job(payload):
+    job_file(payload.get('file_id'))  # restores the file from the spool after a restart
+    ai_results, error = run_ai_analysis(payload)
+    if error:
+        raise ValueError(error)
+    return ai_results
 
-@app.route('/status', methods=['GET'])
-def status():
-    return jsonify({'status': 'running', 'fast': True}), 200
 
 @app.route('/ai-analyze', methods=['POST'])
 def ai_analyze():
@@ -1364,110 +4928,476 @@ def ai_analyze():
     - تقديم توصيات ذكية
     - تحليل الاتجاهات
     """
-    auth_result = check_auth()
-    if auth_result:
-        return auth_result
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
     
     data = request.json
     file_id = data.get('file_id')
-    dept_column = data.get('dept_column')
-    rating_columns = data.get('rating_columns', [])
-    
-    if not file_id or file_id not in files:
+    if not file_available(file_id):
         return jsonify({'error': 'Invalid file ID'}), 400
     
-    try:
+    # async: التحليل يعمل كمهمة في الخلفية، والنتيجة من /jobs/<job_id>
+    if data.get('async'):
         with lock:
-            df = load_dataframe(file_id)
-            
-            if df is None or df.empty:
-                return jsonify({'error': 'Failed to load data'}), 400
-            
-            # تحويل التقييمات إلى أرقام
-            for col in rating_columns:
-                if col in df.columns:
-                    df[col] = df[col].apply(_convert_rating)
-            
-            # حساب متوسط الأداء
-            df['avg_rating'] = df[rating_columns].mean(axis=1)
-            
-            # إزالة القيم المفقودة
-            df_clean = df.dropna(subset=['avg_rating'])
-            
-            if len(df_clean) < 10:
-                return jsonify({'error': 'Not enough data for AI analysis'}), 400
-            
-            # ========== 1. التنبؤ بالأداء المستقبلي ==========
-            predictions = _predict_future_performance(df_clean, rating_columns)
-            
-            # ========== 2. تصنيف الموظفين (Clustering) ==========
-            clusters = _perform_employee_clustering(df_clean, rating_columns)
-            
-            # ========== 3. اكتشاف الأنماط والاتجاهات ==========
-            patterns = _discover_patterns(df_clean, dept_column, rating_columns)
-            
-            # ========== 4. التوصيات الذكية ==========
-            recommendations = _generate_smart_recommendations(df_clean, patterns, clusters)
-            
-            # ========== 5. تحليل الانحدار والارتباط ==========
-            correlations = _analyze_correlations(df_clean, rating_columns)
-            
-            # ========== 6. كشف الشذوذ (Anomaly Detection) ==========
-            anomalies = _detect_anomalies(df_clean, rating_columns)
-            
-            # ========== 7. تحليل التوزيع الإحصائي ==========
-            statistical_analysis = _perform_statistical_analysis(df_clean, rating_columns)
-            
-            ai_results = {
-                'success': True,
-                'total_records': len(df_clean),
-                'ai_insights': {
-                    'predictions': predictions,
-                    'employee_clusters': clusters,
-                    'patterns': patterns,
-                    'recommendations': recommendations,
-                    'correlations': correlations,
-                    'anomalies': anomalies,
-                    'statistical_analysis': statistical_analysis
-                },
-                'summary': {
-                    'high_performers': int((df_clean['avg_rating'] >= 4.0).sum()),
-                    'average_performers': int(((df_clean['avg_rating'] >= 3.0) & (df_clean['avg_rating'] < 4.0)).sum()),
-                    'low_performers': int((df_clean['avg_rating'] < 3.0).sum()),
-                    'avg_overall_rating': float(df_clean['avg_rating'].mean()),
-                    'std_overall_rating': float(df_clean['avg_rating'].std())
-                }
-            }
-            
-            logger.info(f"✅ AI Analysis completed: {len(df_clean)} records analyzed")
-            return jsonify(ai_results), 200
-            
+            source = files.get(file_id)
+        payload = {k: v for k, v in data.items() if k != 'async'}
+        job_id = job_scheduler.submit('ai_analyze', payload, priority=JOB_INTERACTIVE,
+                                      owner=session_data['username'], session=session_key(request),
+                                      file_id=file_id, source=source)
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
+    
+    try:
+        ai_results, error = run_ai_analysis(data)
+        if error:
+            return jsonify({'error': error}), 400
+        return jsonify(ai_results), 200
+    
     except Exception as e:
         logger.error(f"AI Analysis error: {str(e)}")
         return jsonify({'error': f'AI analysis failed: {str(e)}'}), 500
 
 
-def _predict_future_performance(df, rating_columns):
-    """التنبؤ بالأداء المستقبلي باستخدام Gradient Boosting"""
+# ============= LARGE DATA MODE =============
+
+RATING_BUCKET_BINS = [0, 2, 3, 4, 5]
+RATING_BUCKET_LABELS = ['ضعيف', 'مقبول', 'جيد', 'ممتاز']
+
+
+class StreamingAggregates:
+    """
+    Exact figures accumulated chunk by chunk: per-criterion power sums
+    (for mean/std/skew/kurtosis), min/max, department totals, rating
+    distribution buckets and performance level counts.
+    """
+    def __init__(self, rating_columns, dept_column=None):
+        self.columns = list(rating_columns) + ['avg_rating']
+        self.dept_column = dept_column
+        self.total_rows = 0
+        self.n_rows = 0
+        width = len(self.columns)
+        self.count = np.zeros(width)
+        self.power_sums = np.zeros((4, width))
+        self.min = np.full(width, np.inf)
+        self.max = np.full(width, -np.inf)
+        self.dept_totals = None
+        self.buckets = pd.Series(0, index=RATING_BUCKET_LABELS, dtype='int64')
+        self.level_counts = {'high': 0, 'average': 0, 'low': 0, 'excellent': 0}
+    
+    def add(self, chunk):
+        if chunk.empty:
+            return
+        self.n_rows += len(chunk)
+        
+        X = chunk[self.columns].to_numpy(dtype=float)
+        valid = ~np.isnan(X)
+        X0 = np.where(valid, X, 0.0)
+        self.count += valid.sum(axis=0)
+        power = X0.copy()
+        for p in range(4):
+            self.power_sums[p] += power.sum(axis=0)
+            power *= X0
+        self.min = np.fmin(self.min, np.nanmin(np.where(valid, X, np.inf), axis=0))
+        self.max = np.fmax(self.max, np.nanmax(np.where(valid, X, -np.inf), axis=0))
+        
+        ratings = chunk['avg_rating']
+        self.level_counts['high'] += int((ratings >= 4.0).sum())
+        self.level_counts['average'] += int(((ratings >= 3.0) & (ratings < 4.0)).sum())
+        self.level_counts['low'] += int((ratings < 3.0).sum())
+        self.level_counts['excellent'] += int((ratings >= 4.5).sum())
+        
+        buckets = pd.cut(ratings, bins=RATING_BUCKET_BINS, labels=RATING_BUCKET_LABELS).value_counts()
+        self.buckets = self.buckets.add(buckets, fill_value=0).astype('int64')
+        
+        if self.dept_column and self.dept_column in chunk.columns:
+            totals = ratings.groupby(chunk[self.dept_column], observed=True).agg(['count', 'sum'])
+            self.dept_totals = totals if self.dept_totals is None else self.dept_totals.add(totals, fill_value=0)
+    
+    def moments(self):
+        """Exact moments as Series keyed like summarize_rating_matrix"""
+        n = np.maximum(self.count, 1)
+        s1, s2, s3, s4 = (self.power_sums[p] / n for p in range(4))
+        mean = s1
+        m2 = np.maximum(s2 - mean ** 2, 0.0)
+        m3 = s3 - 3 * mean * s2 + 2 * mean ** 3
+        m4 = s4 - 4 * mean * s3 + 6 * mean ** 2 * s2 - 3 * mean ** 4
+        var = m2 * self.count / np.maximum(self.count - 1, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            skewness = m3 / m2 ** 1.5
+            kurtosis = m4 / m2 ** 2 - 3
+        
+        def col_series(values):
+            return pd.Series(values, index=self.columns)
+        
+        return {
+            'count': col_series(self.count),
+            'mean': col_series(mean),
+            'std': col_series(np.sqrt(var)),
+            'var': col_series(var),
+            'min': col_series(self.min),
+            'max': col_series(self.max),
+            'skewness': col_series(skewness),
+            'kurtosis': col_series(kurtosis),
+            'z_mean': col_series(mean),
+            'z_std': col_series(np.sqrt(m2)),
+        }
+    
+    def dept_stats(self):
+        if self.dept_totals is None:
+            return None
+        stats_df = pd.DataFrame({
+            'mean': self.dept_totals['sum'] / self.dept_totals['count'],
+            'count': self.dept_totals['count'].astype('int64')
+        })
+        return stats_df.sort_values('mean', ascending=False)
+    
+    def distribution(self):
+        return self.buckets[self.buckets > 0].sort_values(ascending=False)
+
+
+class ReservoirSample:
+    """Uniform fixed-size sample of rows seen in chunks (Algorithm R, vectorised per chunk)"""
+    def __init__(self, size, seed=42):
+        self.size = max(int(size), 1)
+        self.seen = 0
+        self.rng = np.random.default_rng(seed)
+        self.columns = None
+        self.data = {}
+        self.index = np.empty(self.size, dtype=object)
+    
+    def add(self, chunk):
+        m = len(chunk)
+        if m == 0:
+            return
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+            for col in self.columns:
+                self.data[col] = np.empty(self.size, dtype=chunk[col].to_numpy().dtype)
+        
+        positions = self.seen + np.arange(m)
+        slots = np.where(positions < self.size, positions, self.rng.integers(0, positions + 1))
+        keep = np.flatnonzero(slots < self.size)
+        if len(keep):
+            # Later rows overwrite earlier ones for the same slot, as in the sequential algorithm
+            slots_kept = slots[keep]
+            _, last = np.unique(slots_kept[::-1], return_index=True)
+            keep = keep[len(keep) - 1 - last]
+            for col in self.columns:
+                self.data[col][slots[keep]] = chunk[col].to_numpy()[keep]
+            self.index[slots[keep]] = chunk.index.to_numpy()[keep]
+        self.seen += m
+    
+    def to_frame(self):
+        filled = min(self.seen, self.size)
+        frame = pd.DataFrame({col: values[:filled] for col, values in self.data.items()},
+                             index=self.index[:filled], columns=self.columns)
+        return frame.sort_index()
+
+
+@instrumented('ai.stream_aggregate')
+def _stream_ai_frame(file_id, sheet, dept_column, rating_columns, sample_size):
+    """
+    Large-data variant of _prepare_ai_frame: streams the sheet once, keeping
+    exact aggregates and a reservoir sample. Returns (sample_df, aggregates, error)
+    """
+    with lock:
+        source = files[file_id]
+    
+    columns = list(dict.fromkeys(([dept_column] if dept_column else []) + list(rating_columns)))
+    aggregates = StreamingAggregates(rating_columns, dept_column)
+    reservoir = ReservoirSample(sample_size)
+    
+    for chunk in iter_dataframe_chunks(source, sheet, columns):
+        aggregates.total_rows += len(chunk)
+        for col in rating_columns:
+            if col in chunk.columns:
+                chunk[col] = pd.to_numeric(chunk[col].apply(_convert_rating), errors='coerce')
+        chunk['avg_rating'] = chunk[rating_columns].mean(axis=1)
+        chunk = chunk.dropna(subset=['avg_rating'])
+        aggregates.add(chunk)
+        reservoir.add(chunk)
+    
+    if aggregates.n_rows < 10:
+        return None, None, 'Not enough data for AI analysis'
+    
+    return reservoir.to_frame(), aggregates, None
+
+
+def _apply_exact_moments(summary, aggregates):
+    """استبدال العزوم المحسوبة من العينة بالقيم الدقيقة المحسوبة من كامل الملف"""
+    if aggregates is None:
+        return summary
+    exact = dict(summary)
+    exact.update(aggregates.moments())
+    exact['n_rows'] = aggregates.n_rows
+    exact['excellent_count'] = aggregates.level_counts['excellent']
+    return exact
+
+
+LARGE_DATA_SAMPLED_FIGURES = [
+    'predictions', 'employee_clusters', 'correlations', 'anomalies', 'recommendations',
+    'statistical_analysis.overall.median', 'statistical_analysis.criteria_analysis.median'
+]
+LARGE_DATA_EXACT_FIGURES = [
+    'summary', 'patterns.department_variance', 'patterns.skewed_distribution',
+    'statistical_analysis.overall.mean', 'statistical_analysis.overall.std',
+    'statistical_analysis.overall.min', 'statistical_analysis.overall.max',
+    'statistical_analysis.overall.skewness', 'statistical_analysis.overall.kurtosis'
+]
+
+
+def _prepare_ai_frame(file_id, sheet, rating_columns, dept_column=None):
+    """تحميل عمود الإدارة وأعمدة التقييم فقط وتحويل التقييمات وحساب avg_rating. يرجع (df_clean, error)"""
+    df = load_columns(file_id, sheet, ([dept_column] if dept_column else []) + list(rating_columns))
+    
+    if df is None or df.empty:
+        return None, 'Failed to load data'
+    
+    # تحويل التقييمات إلى أرقام
+    with metrics.stage('rating_normalization'):
+        for col in rating_columns:
+            if col in df.columns:
+                df[col] = df[col].apply(_convert_rating)
+    
+    # حساب متوسط الأداء
+    df['avg_rating'] = df[rating_columns].mean(axis=1)
+    
+    # إزالة القيم المفقودة
+    df_clean = df.dropna(subset=['avg_rating'])
+    
+    if len(df_clean) < 10:
+        return None, 'Not enough data for AI analysis'
+    
+    return df_clean, None
+
+
+@app.route('/anomalies', methods=['POST'])
+def anomalies_page():
+    """صفحات الصفوف الشاذة دون إعادة تشغيل التحليل الذكي كاملاً"""
+    session_data, error, status = check_auth(request)
+    if error:
+        return jsonify({'error': error}), status
+    
+    data = request.get_json()
+    file_id = data.get('file_id')
+    sheet = data.get('sheet')
+    dept_column = data.get('dept_column')
+    rating_columns = data.get('rating_columns', [])
+    method = data.get('method', 'zscore')
+    
+    if not file_available(file_id):
+        return jsonify({'error': 'Invalid file ID'}), 400
+    
+    if method not in ANOMALY_METHODS:
+        return jsonify({'error': f'Unknown method. Available: {list(ANOMALY_METHODS)}'}), 400
     try:
-        X = df[rating_columns].values
-        y = df['avg_rating'].values
+        page, page_size = parse_anomaly_paging(data.get('page', 1), data.get('page_size', ANOMALY_PAGE_SIZE))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        df_clean, error = _prepare_ai_frame(file_id, sheet, rating_columns, dept_column)
+        error = error or anomaly_dept_error(method, dept_column, df_clean)
+        if error:
+            return jsonify({'error': error}), 400
+        
+        cache_key = model_registry.make_key(f"{file_id}:{sheet or ''}", rating_columns)
+        summary = get_rating_summary(cache_key, df_clean, rating_columns)
+        result = _detect_anomalies(df_clean, rating_columns, summary, method, dept_column, page, page_size)
+        
+        return jsonify({'method': method, 'anomalies': result}), 200
+    except Exception as e:
+        logger.error(f"Anomalies error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+
+# ============= AI STAGE EXECUTOR =============
+
+def run_stage_graph(stages, executor=None):
+    """
+    Run a dict of {name: (dependencies, func)} on a worker pool.
+    Each func receives the results of finished stages; a stage is submitted
+    as soon as all of its dependencies are done. Returns (results, timings)
+    with per-stage wall time in seconds plus the end-to-end 'total'.
+    """
+    executor = executor or ai_stage_executor
+    results = {}
+    timings = {}
+    pending = dict(stages)
+    running = {}
+    started = time.perf_counter()
+    
+    def timed(name, func, done_results):
+        t0 = time.perf_counter()
+        try:
+            with metrics.stage(f'ai.stage.{name}'):
+                return func(done_results)
+        finally:
+            timings[name] = round(time.perf_counter() - t0, 4)
+    
+    while pending or running:
+        ready = [name for name, (deps, _) in pending.items() if all(d in results for d in deps)]
+        for name in ready:
+            deps, func = pending.pop(name)
+            running[executor.submit(profiler.wrap(timed, f'ai.stage.{name}'), name, func, dict(results))] = name
+        
+        if not running:
+            raise ValueError(f"Unresolvable stage dependencies: {list(pending)}")
+        
+        done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+        for future in done:
+            name = running.pop(future)
+            results[name] = future.result()
+    
+    timings['total'] = round(time.perf_counter() - started, 4)
+    return results, timings
+
+
+# ============= AI MODEL REGISTRY =============
+
+class ModelRegistry:
+    """
+    Persists fitted AI models (GBR, scaler, KMeans) on disk with joblib.
+    Keyed by dataset fingerprint + rating columns, evicts oldest entries
+    when the directory grows beyond max_bytes. joblib files are pickles:
+    anyone who can write to cache_dir can run code in this process, so the
+    directory is created private to the service user and must stay that way.
+    """
+    def __init__(self, cache_dir, max_bytes, memory_entries=MODEL_CACHE_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def make_key(self, fingerprint, rating_columns):
+        # Include sklearn version so pickles from an older install are never loaded
+        load_ml()
+        raw = '|'.join([sklearn.__version__, str(fingerprint)] + [str(c) for c in rating_columns])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+    
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.joblib")
+    
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return dict(self._memory[key])
+        
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        
+        try:
+            load_ml()
+            models = joblib.load(path)
+            os.utime(path, None)  # mark as recently used for eviction
+        except Exception as e:
+            logger.warning(f"Model cache entry unreadable, discarding: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
         
-        # تقسيم البيانات
-        split = int(len(df) * 0.8)
-        X_train, X_test = X[:split], X[split:]
-        y_train, y_test = y[:split], y[split:]
+        self._remember(key, models)
+        return dict(models)
+    
+    def put(self, key, models):
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            path = self._path(key)
+            tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+            load_ml()
+            joblib.dump(models, tmp_path, compress=3)
+            os.replace(tmp_path, path)
+            self._remember(key, models)
+            self._evict()
+        except Exception as e:
+            logger.warning(f"Could not persist AI models: {e}")
+    
+    def _remember(self, key, models):
+        with self._lock:
+            self._memory[key] = dict(models)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+    
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.joblib'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
         
-        # تدريب النموذج
-        model = GradientBoostingRegressor(n_estimators=100, random_state=42)
-        model.fit(X_train, y_train)
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"🧹 Evicted cached model: {os.path.basename(path)}")
+            except OSError:
+                continue
+
+
+model_registry = ModelRegistry(MODEL_CACHE_DIR, MODEL_CACHE_MAX_BYTES)
+
+
+def _rating_matrix(df, rating_columns):
+    """مصفوفة التقييمات للنماذج: الخلية الفارغة تُعوَّض بمتوسط عمودها كما في Isolation Forest"""
+    X = df[rating_columns].to_numpy(dtype=float)
+    fill_values = pd.DataFrame(X).mean().fillna(df['avg_rating'].mean()).to_numpy()
+    return np.where(np.isnan(X), fill_values, X)
+
+
+@instrumented('ai.model.prediction')
+def _fit_prediction_model(df, rating_columns):
+    """تدريب نموذج Gradient Boosting وحساب دقته"""
+    load_ml()
+    X = _rating_matrix(df, rating_columns)
+    y = df['avg_rating'].values
+    
+    # تقسيم البيانات
+    split = int(len(df) * 0.8)
+    X_train, X_test = X[:split], X[split:]
+    y_train, y_test = y[:split], y[split:]
+    
+    # تدريب النموذج
+    model = GradientBoostingRegressor(n_estimators=100, random_state=42)
+    model.fit(X_train, y_train)
+    
+    # حساب دقة النموذج
+    predictions = model.predict(X_test)
+    mse = np.mean((predictions - y_test) ** 2)
+    r2 = 1 - (mse / np.var(y_test))
+    
+    return {'model': model, 'r2': float(r2)}
+
+
+def _predict_future_performance(df, rating_columns, models=None, history=None):
+    """
+    التنبؤ بالأداء المستقبلي باستخدام Gradient Boosting
+    مع history (سجل الفترات) يُضاف اتجاه الشركة عبر الفترات وتوقع الفترة التالية
+    """
+    try:
+        if models is None:
+            models = {}
+        if 'prediction' not in models:
+            models['prediction'] = _fit_prediction_model(df, rating_columns)
         
-        # التنبؤ
-        predictions = model.predict(X_test)
+        model = models['prediction']['model']
+        r2 = models['prediction']['r2']
         
-        # حساب دقة النموذج
-        mse = np.mean((predictions - y_test) ** 2)
-        r2 = 1 - (mse / np.var(y_test))
+        X = _rating_matrix(df, rating_columns)
+        y = df['avg_rating'].values
         
         # التنبؤ لجميع الموظفين
         all_predictions = model.predict(X)
@@ -1483,38 +5413,57 @@ def _predict_future_performance(df, rating_columns):
             'rising_stars_count': int((performance_change > 0.5).sum()),
             'feature_importance': {
                 col: float(imp) for col, imp in zip(rating_columns, model.feature_importances_)
-            }
+            },
+            'history': history
         }
     except Exception as e:
         logger.error(f"Prediction error: {str(e)}")
         return {'error': str(e)}
 
 
-def _perform_employee_clustering(df, rating_columns):
+@instrumented('ai.model.clustering')
+def _fit_clustering_model(df, rating_columns):
+    """تطبيع البيانات واختيار أفضل عدد مجموعات وتدريب K-Means"""
+    load_ml()
+    X = _rating_matrix(df, rating_columns)
+    
+    # تطبيع البيانات
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(X)
+    
+    # تحديد العدد الأمثل للمجموعات (2-5)
+    best_k = 3
+    best_score = -1
+    
+    for k in range(2, min(6, len(df) // 10)):
+        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
+        labels = kmeans.fit_predict(X_scaled)
+        if len(set(labels)) > 1:
+            score = silhouette_score(X_scaled, labels)
+            if score > best_score:
+                best_score = score
+                best_k = k
+    
+    # التصنيف النهائي
+    kmeans = KMeans(n_clusters=best_k, random_state=42, n_init=10)
+    kmeans.fit(X_scaled)
+    
+    return {'scaler': scaler, 'kmeans': kmeans, 'best_k': best_k, 'silhouette_score': float(best_score)}
+
+
+def _perform_employee_clustering(df, rating_columns, models=None):
     """تصنيف الموظفين إلى مجموعات باستخدام K-Means"""
     try:
-        X = df[rating_columns].values
-        
-        # تطبيع البيانات
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
-        
-        # تحديد العدد الأمثل للمجموعات (2-5)
-        best_k = 3
-        best_score = -1
-        
-        for k in range(2, min(6, len(df) // 10)):
-            kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-            labels = kmeans.fit_predict(X_scaled)
-            if len(set(labels)) > 1:
-                score = silhouette_score(X_scaled, labels)
-                if score > best_score:
-                    best_score = score
-                    best_k = k
-        
-        # التصنيف النهائي
-        kmeans = KMeans(n_clusters=best_k, random_state=42, n_init=10)
-        labels = kmeans.fit_predict(X_scaled)
+        if models is None:
+            models = {}
+        if 'clustering' not in models:
+            models['clustering'] = _fit_clustering_model(df, rating_columns)
+        
+        fitted = models['clustering']
+        best_k = fitted['best_k']
+        
+        X_scaled = fitted['scaler'].transform(_rating_matrix(df, rating_columns))
+        labels = fitted['kmeans'].predict(X_scaled)
         
         # تحليل كل مجموعة
         clusters_info = []
@@ -1532,7 +5481,7 @@ def _perform_employee_clustering(df, rating_columns):
         
         return {
             'num_clusters': best_k,
-            'silhouette_score': float(best_score),
+            'silhouette_score': fitted['silhouette_score'],
             'clusters': clusters_info
         }
     except Exception as e:
@@ -1554,17 +5503,105 @@ def _get_cluster_description(avg_rating):
         return "أداء ضعيف - يحتاج تطوير عاجل"
 
 
-def _discover_patterns(df, dept_column, rating_columns):
+# ============= RATING MATRIX SUMMARY =============
+
+@instrumented('ai.rating_summary')
+def summarize_rating_matrix(df, rating_columns):
+    """
+    ملخص مصفوفة التقييمات محسوب مرة واحدة لكل ملف:
+    العزوم، التغاير والارتباط، الربيعيات ومعاملات Z-Score.
+    تستهلكه جميع مراحل التحليل الذكي بدلاً من إعادة الحساب.
+    """
+    columns = list(rating_columns) + ['avg_rating']
+    X = df[columns].to_numpy(dtype=float)
+    valid = ~np.isnan(X)
+    count = valid.sum(axis=0)
+    n = np.maximum(count, 1)
+    
+    mean = np.where(valid, X, 0.0).sum(axis=0) / n
+    centered = np.where(valid, X - mean, 0.0)
+    sq = centered * centered
+    m2 = sq.sum(axis=0) / n
+    m3 = (sq * centered).sum(axis=0) / n
+    m4 = (sq * sq).sum(axis=0) / n
+    var = m2 * count / np.maximum(count - 1, 1)
+    std = np.sqrt(var)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        skewness = m3 / m2 ** 1.5
+        kurtosis = m4 / m2 ** 2 - 3
+        if valid.all():
+            cov = centered.T @ centered / max(len(X) - 1, 1)
+            corr = cov / np.outer(std, std)
+        else:
+            # Pairwise-complete statistics when some criteria are missing
+            frame = df[columns].astype(float)
+            cov = frame.cov().to_numpy()
+            corr = frame.corr().to_numpy()
+    
+    quantiles = np.nanquantile(X, [0.0, 0.25, 0.5, 0.75, 1.0], axis=0)
+    
+    def col_series(values):
+        return pd.Series(values, index=columns)
+    
+    return {
+        'n_rows': len(df),
+        'columns': columns,
+        'count': col_series(count),
+        'mean': col_series(mean),
+        'std': col_series(std),
+        'var': col_series(var),
+        'min': col_series(quantiles[0]),
+        'q1': col_series(quantiles[1]),
+        'median': col_series(quantiles[2]),
+        'q3': col_series(quantiles[3]),
+        'max': col_series(quantiles[4]),
+        'skewness': col_series(skewness),
+        'kurtosis': col_series(kurtosis),
+        'cov': pd.DataFrame(cov, index=columns, columns=columns),
+        'corr': pd.DataFrame(corr, index=columns, columns=columns),
+        # Population parameters (ddof=0), same convention as scipy.stats.zscore
+        'z_mean': col_series(mean),
+        'z_std': col_series(np.sqrt(m2)),
+    }
+
+
+rating_summary_cache = OrderedDict()
+RATING_SUMMARY_CACHE_ENTRIES = 32
+
+
+def get_rating_summary(cache_key, df, rating_columns):
+    """إرجاع ملخص المصفوفة من الذاكرة أو حسابه وتخزينه"""
+    with lock:
+        if cache_key in rating_summary_cache:
+            rating_summary_cache.move_to_end(cache_key)
+            return rating_summary_cache[cache_key]
+    
+    summary = summarize_rating_matrix(df, rating_columns)
+    
+    with lock:
+        rating_summary_cache[cache_key] = summary
+        while len(rating_summary_cache) > RATING_SUMMARY_CACHE_ENTRIES:
+            rating_summary_cache.popitem(last=False)
+    return summary
+
+
+def _discover_patterns(df, dept_column, rating_columns, summary=None, aggregates=None):
     """اكتشاف الأنماط المخفية في البيانات"""
     try:
         patterns = []
+        if summary is None:
+            summary = summarize_rating_matrix(df, rating_columns)
         
         # 1. تحليل التباين بين الإدارات
         if dept_column and dept_column in df.columns:
-            dept_stats = df.groupby(dept_column)['avg_rating'].agg(['mean', 'std', 'count'])
-            dept_stats = dept_stats.sort_values('mean', ascending=False)
+            if aggregates is not None:
+                dept_stats = aggregates.dept_stats()
+            else:
+                dept_stats = df.groupby(dept_column)['avg_rating'].agg(['mean', 'std', 'count'])
+                dept_stats = dept_stats.sort_values('mean', ascending=False)
             
-            if len(dept_stats) > 1:
+            if dept_stats is not None and len(dept_stats) > 1:
                 best_dept = dept_stats.index[0]
                 worst_dept = dept_stats.index[-1]
                 gap = float(dept_stats.loc[best_dept, 'mean'] - dept_stats.loc[worst_dept, 'mean'])
@@ -1579,7 +5616,7 @@ def _discover_patterns(df, dept_column, rating_columns):
                 })
         
         # 2. اكتشاف الاتجاهات في معايير التقييم
-        correlation_matrix = df[rating_columns].corr()
+        correlation_matrix = summary['corr'].loc[rating_columns, rating_columns]
         high_correlations = []
         
         for i in range(len(rating_columns)):
@@ -1601,12 +5638,15 @@ def _discover_patterns(df, dept_column, rating_columns):
             })
         
         # 3. كشف التوزيع غير المتوازن
-        rating_dist = pd.cut(df['avg_rating'], bins=[0, 2, 3, 4, 5], labels=['ضعيف', 'مقبول', 'جيد', 'ممتاز'])
-        dist_counts = rating_dist.value_counts()
+        if aggregates is not None:
+            dist_counts = aggregates.distribution()
+        else:
+            rating_dist = pd.cut(df['avg_rating'], bins=RATING_BUCKET_BINS, labels=RATING_BUCKET_LABELS)
+            dist_counts = rating_dist.value_counts()
         
         if len(dist_counts) > 0:
             dominant_category = dist_counts.index[0]
-            dominance_pct = float((dist_counts.iloc[0] / len(df)) * 100)
+            dominance_pct = float((dist_counts.iloc[0] / summary['n_rows']) * 100)
             
             if dominance_pct > 60:
                 patterns.append({
@@ -1624,13 +5664,16 @@ def _discover_patterns(df, dept_column, rating_columns):
         return []
 
 
-def _generate_smart_recommendations(df, patterns, clusters):
+def _generate_smart_recommendations(df, patterns, clusters, summary=None):
     """توليد توصيات ذكية بناءً على التحليل"""
     recommendations = []
     
     try:
         # 1. توصيات بناءً على الأداء العام
-        avg_rating = df['avg_rating'].mean()
+        if summary is not None:
+            avg_rating = summary['mean']['avg_rating']
+        else:
+            avg_rating = df['avg_rating'].mean()
         
         if avg_rating < 3.5:
             recommendations.append({
@@ -1668,7 +5711,10 @@ def _generate_smart_recommendations(df, patterns, clusters):
                 })
         
         # 4. توصية عامة للتميز
-        high_performers = int((df['avg_rating'] >= 4.5).sum())
+        if summary is not None and 'excellent_count' in summary:
+            high_performers = int(summary['excellent_count'])
+        else:
+            high_performers = int((df['avg_rating'] >= 4.5).sum())
         if high_performers > 0:
             recommendations.append({
                 'priority': 'منخفضة',
@@ -1685,10 +5731,12 @@ def _generate_smart_recommendations(df, patterns, clusters):
         return []
 
 
-def _analyze_correlations(df, rating_columns):
+def _analyze_correlations(df, rating_columns, summary=None):
     """تحليل الارتباطات بين المعايير"""
     try:
-        corr_matrix = df[rating_columns].corr()
+        if summary is None:
+            summary = summarize_rating_matrix(df, rating_columns)
+        corr_matrix = summary['corr'].loc[rating_columns, rating_columns]
         
         correlations = []
         for i in range(len(rating_columns)):
@@ -1725,47 +5773,169 @@ def _get_correlation_strength(corr):
         return "ضعيف جداً"
 
 
-def _detect_anomalies(df, rating_columns):
-    """كشف القيم الشاذة باستخدام Z-Score"""
+def _iter_row_chunks(df, columns, fill_values=None):
+    """قراءة مصفوفة الأعمدة على دفعات لتبقى الذاكرة محدودة مع الملفات الضخمة"""
+    positions = df.columns.get_indexer(columns)  # sliced per chunk, never copied whole
+    for start in range(0, len(df), ANOMALY_CHUNK_ROWS):
+        chunk = df.iloc[start:start + ANOMALY_CHUNK_ROWS, positions].to_numpy(dtype=float)
+        if fill_values is not None:
+            chunk = np.where(np.isnan(chunk), fill_values, chunk)
+        yield start, chunk
+
+
+def _anomaly_mask_zscore(df, rating_columns, summary):
+    """|z| > 3 لأي معيار، باستخدام معاملات الملخص المشترك"""
+    z_mean = summary['z_mean'][rating_columns].to_numpy()
+    z_std = summary['z_std'][rating_columns].to_numpy()
+    mask = np.zeros(len(df), dtype=bool)
+    for start, chunk in _iter_row_chunks(df, rating_columns):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.abs((chunk - z_mean) / z_std)
+        mask[start:start + len(chunk)] = (z > ANOMALY_Z_THRESHOLD).any(axis=1)
+    return mask
+
+
+def _robust_z(deviation, mad, mean_abs_dev):
+    """
+    |x - median| / MAD مقاس على الانحراف المعياري (0.6745). مع تقييمات 1-5 يقع أكثر من
+    نصف الصفوف غالباً على الوسيط فيصبح MAD صفراً؛ عندها يُستخدم 1.2533 × متوسط الانحراف
+    المطلق، وما لا تباين فيه إطلاقاً لا يُعد شاذاً
+    """
+    scale = np.where(mad > 0, mad / 0.6745, 1.2533 * mean_abs_dev)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        robust_z = np.abs(deviation) / scale
+    return np.nan_to_num(robust_z, nan=0.0, posinf=0.0)
+
+
+def _anomaly_mask_mad(df, rating_columns, summary):
+    """Z-Score مقاوم (الوسيط والانحراف المطلق الوسيط) لا يتأثر بالقيم المتطرفة نفسها"""
+    median = summary['median'][rating_columns].to_numpy()
+    deviations = [np.abs(df[col].to_numpy(dtype=float) - median[i]) for i, col in enumerate(rating_columns)]
+    mad = np.array([np.nanmedian(deviation) for deviation in deviations])
+    mean_abs_dev = np.array([np.nanmean(deviation) for deviation in deviations])
+    mask = np.zeros(len(df), dtype=bool)
+    for start, chunk in _iter_row_chunks(df, rating_columns):
+        robust_z = _robust_z(chunk - median, mad, mean_abs_dev)
+        mask[start:start + len(chunk)] = (robust_z > ANOMALY_MAD_THRESHOLD).any(axis=1)
+    return mask
+
+
+@instrumented('ai.model.isolation_forest')
+def _anomaly_mask_isolation_forest(df, rating_columns, summary):
+    """Isolation Forest مدرب على عينة فرعية ثم تقييم جميع الصفوف على دفعات"""
+    load_ml()
+    fill_values = summary['mean'][rating_columns].to_numpy()
+    sample_size = min(len(df), ANOMALY_IFOREST_SAMPLE_ROWS)
+    sample_positions = np.sort(np.random.default_rng(42).choice(len(df), sample_size, replace=False))
+    sample = df[rating_columns].iloc[sample_positions].to_numpy(dtype=float)
+    sample = np.where(np.isnan(sample), fill_values, sample)
+    
+    model = IsolationForest(n_estimators=100, max_samples=min(256, sample_size),
+                            contamination=ANOMALY_IFOREST_CONTAMINATION, random_state=42)
+    model.fit(sample)
+    
+    mask = np.zeros(len(df), dtype=bool)
+    for start, chunk in _iter_row_chunks(df, rating_columns, fill_values):
+        mask[start:start + len(chunk)] = model.predict(chunk) == -1
+    return mask
+
+
+def _anomaly_mask_department(df, rating_columns, summary, dept_column):
+    """قيم شاذة داخل كل إدارة: الموظف مقارنة بزملائه وليس بكامل الجهة"""
+    if not dept_column or dept_column not in df.columns:
+        raise ValueError('department anomaly detection requires a valid dept_column')
+    
+    ratings = df['avg_rating']
+    groups = df[dept_column]
+    dept_median = ratings.groupby(groups, observed=True).transform('median')
+    deviation = (ratings - dept_median).abs()
+    dept_mad = deviation.groupby(groups, observed=True).transform('median')
+    dept_mean_abs_dev = deviation.groupby(groups, observed=True).transform('mean')
+    robust_z = _robust_z(deviation.to_numpy(), dept_mad.to_numpy(), dept_mean_abs_dev.to_numpy())
+    return robust_z > ANOMALY_MAD_THRESHOLD
+
+
+ANOMALY_METHODS = {
+    'zscore': _anomaly_mask_zscore,
+    'mad': _anomaly_mask_mad,
+    'isolation_forest': _anomaly_mask_isolation_forest,
+    'department': _anomaly_mask_department,
+}
+
+
+def parse_anomaly_paging(page, page_size):
+    """(page, page_size) as bounded integers; ValueError for the caller's 400"""
     try:
-        anomalies = []
-        
-        z_scores = np.abs(stats.zscore(df[rating_columns]))
-        
-        # القيم التي تتجاوز 3 انحرافات معيارية
-        anomaly_mask = (z_scores > 3).any(axis=1)
-        anomaly_count = int(anomaly_mask.sum())
-        
-        if anomaly_count > 0:
-            anomaly_data = df[anomaly_mask]
-            
-            anomalies.append({
-                'type': 'outliers',
-                'count': anomaly_count,
-                'percentage': float((anomaly_count / len(df)) * 100),
-                'description': f'تم اكتشاف {anomaly_count} حالة شاذة تحتاج مراجعة',
-                'avg_rating_outliers': float(anomaly_data['avg_rating'].mean())
-            })
-        
-        return anomalies
-        
-    except Exception as e:
-        logger.error(f"Anomaly detection error: {str(e)}")
-        return []
+        page, page_size = int(page), int(page_size)
+    except (TypeError, ValueError):
+        raise ValueError('page and page_size must be integers')
+    return max(page, 1), min(max(page_size, 1), ANOMALY_MAX_PAGE_SIZE)
+
+
+def anomaly_dept_error(method, dept_column, df):
+    """رسالة خطأ إذا طُلب كشف الشواذ داخل الإدارات دون عمود إدارة صالح، وإلا None"""
+    if method == 'department' and (not dept_column or dept_column not in df.columns):
+        return 'department anomaly detection requires a valid dept_column'
+    return None
+
+
+def _detect_anomalies(df, rating_columns, summary=None, method='zscore', dept_column=None,
+                      page=1, page_size=ANOMALY_PAGE_SIZE):
+    """
+    كشف القيم الشاذة (Z-Score، MAD، Isolation Forest أو داخل الإدارات) مع صفحات للصفوف
+    المعاملات يتحقق منها المستدعي؛ أي خطأ هنا يُرفع ولا يُعرض كـ"لا توجد حالات شاذة"
+    """
+    anomalies = []
+    if summary is None:
+        summary = summarize_rating_matrix(df, rating_columns)
+    
+    if method not in ANOMALY_METHODS:
+        raise ValueError(f'Unknown anomaly method: {method}')
+    
+    if method == 'department':
+        anomaly_mask = _anomaly_mask_department(df, rating_columns, summary, dept_column)
+    else:
+        anomaly_mask = ANOMALY_METHODS[method](df, rating_columns, summary)
+    anomaly_count = int(anomaly_mask.sum())
+    
+    if anomaly_count > 0:
+        positions = np.flatnonzero(anomaly_mask)
+        page, page_size = parse_anomaly_paging(page, page_size)
+        page_positions = positions[(page - 1) * page_size:page * page_size]
+        
+        anomalies.append({
+            'type': 'outliers',
+            'method': method,
+            'count': anomaly_count,
+            'percentage': float((anomaly_count / len(df)) * 100),
+            'description': f'تم اكتشاف {anomaly_count} حالة شاذة تحتاج مراجعة',
+            'avg_rating_outliers': float(df['avg_rating'].to_numpy()[anomaly_mask].mean()),
+            'rows': {
+                'page': page,
+                'page_size': page_size,
+                'total_pages': int(-(-anomaly_count // page_size)),
+                'indices': df.index[page_positions].tolist()
+            }
+        })
+    
+    return anomalies
 
 
-def _perform_statistical_analysis(df, rating_columns):
+def _perform_statistical_analysis(df, rating_columns, summary=None):
     """تحليل إحصائي شامل"""
     try:
+        if summary is None:
+            summary = summarize_rating_matrix(df, rating_columns)
+        
         analysis = {
             'overall': {
-                'mean': float(df['avg_rating'].mean()),
-                'median': float(df['avg_rating'].median()),
-                'std': float(df['avg_rating'].std()),
-                'min': float(df['avg_rating'].min()),
-                'max': float(df['avg_rating'].max()),
-                'skewness': float(stats.skew(df['avg_rating'])),
-                'kurtosis': float(stats.kurtosis(df['avg_rating']))
+                'mean': float(summary['mean']['avg_rating']),
+                'median': float(summary['median']['avg_rating']),
+                'std': float(summary['std']['avg_rating']),
+                'min': float(summary['min']['avg_rating']),
+                'max': float(summary['max']['avg_rating']),
+                'skewness': float(summary['skewness']['avg_rating']),
+                'kurtosis': float(summary['kurtosis']['avg_rating'])
             },
             'criteria_analysis': []
         }
@@ -1774,9 +5944,9 @@ def _perform_statistical_analysis(df, rating_columns):
         for col in rating_columns:
             analysis['criteria_analysis'].append({
                 'criterion': col,
-                'mean': float(df[col].mean()),
-                'std': float(df[col].std()),
-                'median': float(df[col].median())
+                'mean': float(summary['mean'][col]),
+                'std': float(summary['std'][col]),
+                'median': float(summary['median'][col])
             })
         
         # تفسير النتائج
@@ -1795,7 +5965,26 @@ def _perform_statistical_analysis(df, rating_columns):
         return {}
 
 
+if PRELOAD_ML:
+    load_ml()
+startup_timings['app_ready'] = time.perf_counter() - STARTUP_BEGAN
+logger.info(f"⏱️ App loaded in {startup_timings['app_ready']:.2f}s "
+            f"(imports {startup_timings['imports']:.2f}s, static assets {startup_timings['static_assets']:.2f}s, "
+            f"ML {'preloaded' if PRELOAD_ML else 'deferred'})")
+
+
 if __name__ == '__main__':
+    if '--hash-password' in sys.argv:
+        # توليد قيمة ADMIN_PASSWORD_HASH مرة واحدة بدلاً من حسابها عند كل تشغيل
+        import getpass
+        password = getpass.getpass('Admin password: ')
+        print(bcrypt.hashpw(password.encode(), bcrypt.gensalt()).decode())
+        sys.exit(0)
+    if '--startup-report' in sys.argv:
+        load_ml()
+        print(json.dumps(startup_report(), indent=2))
+        sys.exit(0)
+    
     PORT = int(os.environ.get('PORT', 5000))
     print("\n🔒 Secure HR Analytics System")
     print("=" * 50)
@@ -0,0 +1,364 @@
+"""
+Benchmark harness for the HR analytics service.
+
+Generates a synthetic appraisal workbook that follows the column conventions
+app.py detects (Arabic department / region names built from SAUDI_REGIONS and
+their spelling variants, a current-performance column and extra rating columns
+in mixed formats: 1-5 scores, percent strings, 0-1 fractions, 1-10 scores and
+Arabic grades), runs it through the service in-process and times every stage:
+
+    upload, upload -> analytics ready, load_dataframe, FastAnalyzer.analyze,
+    /analyze-custom, process_dynamic_chart, /ai-analyze and each of its stages
+
+Results are written as JSON (stdout or --output) and can be compared against a
+previous run with --compare to make regressions visible.
+
+Usage:
+    python benchmark.py --rows 50000 --sheets 2 --rating-columns 4 --repeat 3 --output bench.json
+    python benchmark.py --rows 50000 --compare bench.json --threshold 1.25
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Cold /ai-analyze runs must not reuse models trained by an earlier benchmark
+os.environ.setdefault('MODEL_CACHE_DIR', tempfile.mkdtemp(prefix='hr-bench-models-'))
+
+import app as service  # noqa: E402
+
+DEPT_COLUMN = 'الإدارة'
+REGION_COLUMN = 'المنطقة'
+CURRENT_RATING_COLUMN = 'درجة الاداء الحالية'
+EXTRA_RATING_COLUMNS = ['نسبة الإنجاز', 'تقييم الكفاءات', 'تقييم المدير', 'التقدير العام', 'تقييم السلوك']
+EXTRA_RATING_FORMATS = ['percent', 'fraction', 'scale10', 'grade', 'mixed']
+
+DEPT_PREFIXES = ['إدارة', 'قسم', 'فرع', 'وحدة']
+DEPT_FUNCTIONS = ['الموارد البشرية', 'المالية', 'تقنية المعلومات', 'المشتريات', 'خدمة العملاء',
+                  'الشؤون القانونية', 'التدريب والتطوير', 'العمليات', 'التسويق', 'المراجعة الداخلية']
+GRADES = ['ضعيف', 'متوسط', 'جيد', 'جيد جداً', 'ممتاز']
+
+
+def region_variants():
+    """Spellings of every SAUDI_REGIONS key that match_region resolves back to it."""
+    variants = {}
+    for region in service.SAUDI_REGIONS:
+        candidates = [region, f'منطقة {region}', f'{region} ', f'المنطقة {region}']
+        variants[region] = [v for v in candidates if service.match_region(v) == region] or [region]
+    return variants
+
+
+def format_ratings(quality, fmt, rng):
+    """Render latent quality in [0, 1] in one of the rating formats _convert_rating accepts."""
+    if fmt == 'scale5':
+        return np.round(1 + 4 * quality, 2)
+    if fmt == 'percent':
+        return np.char.add(np.round(40 + 60 * quality).astype(int).astype(str), '%').astype(object)
+    if fmt == 'fraction':
+        return np.round(quality, 3)
+    if fmt == 'scale10':
+        return np.round(1 + 9 * quality).astype(int)
+    if fmt == 'grade':
+        return np.array(GRADES, dtype=object)[np.minimum((quality * len(GRADES)).astype(int), len(GRADES) - 1)]
+    if fmt == 'mixed':
+        choice = rng.integers(0, 4, len(quality))
+        out = np.empty(len(quality), dtype=object)
+        for i, sub_fmt in enumerate(['scale5', 'percent', 'fraction', 'grade']):
+            mask = choice == i
+            out[mask] = format_ratings(quality[mask], sub_fmt, rng)
+        return out
+    raise ValueError(f'Unknown rating format: {fmt}')
+
+
+def generate_sheet(rows, rating_columns, departments, missing, with_region, rng):
+    variants = region_variants()
+    regions = list(variants)
+
+    dept_region = rng.integers(0, len(regions), departments)
+    dept_names = []
+    for d in range(departments):
+        region = regions[dept_region[d]]
+        prefix = DEPT_PREFIXES[d % len(DEPT_PREFIXES)]
+        function = DEPT_FUNCTIONS[(d // len(DEPT_PREFIXES)) % len(DEPT_FUNCTIONS)]
+        variant = variants[region][d % len(variants[region])].strip()
+        dept_names.append(f'{prefix} {function} - {variant} {d + 1}')
+    dept_names = np.array(dept_names, dtype=object)
+
+    # Department effect + employee effect, so criteria are correlated like real appraisals
+    dept = rng.integers(0, departments, rows)
+    dept_effect = rng.normal(0, 0.12, departments)
+    employee = np.clip(0.6 + dept_effect[dept] + rng.normal(0, 0.15, rows), 0, 1)
+
+    data = {
+        'الرقم الوظيفي': np.arange(100000, 100000 + rows),
+        DEPT_COLUMN: dept_names[dept],
+    }
+    if with_region:
+        region_names = np.array([rng.choice(variants[r]) for r in regions], dtype=object)
+        data[REGION_COLUMN] = region_names[dept_region[dept]]
+
+    data[CURRENT_RATING_COLUMN] = format_ratings(employee, 'scale5', rng)
+    for i in range(rating_columns - 1):
+        name = EXTRA_RATING_COLUMNS[i % len(EXTRA_RATING_COLUMNS)]
+        if i >= len(EXTRA_RATING_COLUMNS):
+            name = f'{name} {i // len(EXTRA_RATING_COLUMNS) + 1}'
+        quality = np.clip(employee + rng.normal(0, 0.08, rows), 0, 1)
+        data[name] = format_ratings(quality, EXTRA_RATING_FORMATS[i % len(EXTRA_RATING_FORMATS)], rng)
+
+    df = pd.DataFrame(data)
+    rating_cols = [c for c in df.columns if c not in ('الرقم الوظيفي', DEPT_COLUMN, REGION_COLUMN)]
+    if missing > 0:
+        for col in rating_cols:
+            df.loc[rng.random(rows) < missing, col] = np.nan
+    return df, rating_cols
+
+
+def generate_workbook(config):
+    """Returns (file_bytes, filename, {sheet: rating_columns})."""
+    rng = np.random.default_rng(config.seed)
+    sheets = {}
+    frames = {}
+    for s in range(config.sheets):
+        name = f'الربع {s + 1}'
+        frames[name], sheets[name] = generate_sheet(config.rows, config.rating_columns, config.departments,
+                                                    config.missing, not config.no_region_column, rng)
+
+    buf = io.BytesIO()
+    if config.file_format == 'csv':
+        next(iter(frames.values())).to_csv(buf, index=False)
+        sheets = {None: next(iter(sheets.values()))}
+        return buf.getvalue(), 'benchmark.csv', sheets
+
+    with pd.ExcelWriter(buf, engine='openpyxl') as writer:
+        for name, df in frames.items():
+            df.to_excel(writer, sheet_name=name, index=False)
+    return buf.getvalue(), 'benchmark.xlsx', sheets
+
+
+class Recorder:
+    """Collects wall-clock samples per (sheet, stage)."""
+
+    def __init__(self):
+        self.samples = {}
+
+    def add(self, sheet, stage, seconds, **extra):
+        entry = self.samples.setdefault((sheet, stage), {'runs': [], 'extra': {}})
+        entry['runs'].append(round(seconds, 6))
+        entry['extra'].update(extra)
+
+    def time(self, sheet, stage, func, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            self.add(sheet, stage, time.perf_counter() - started, error=f'{type(e).__name__}: {e}')
+            return None
+        self.add(sheet, stage, time.perf_counter() - started)
+        return result
+
+    def results(self):
+        out = []
+        for (sheet, stage), entry in self.samples.items():
+            runs = entry['runs']
+            out.append(dict({
+                'sheet': sheet,
+                'stage': stage,
+                'runs': runs,
+                'min': min(runs),
+                'median': statistics.median(runs),
+                'mean': round(statistics.fmean(runs), 6),
+                'max': max(runs)
+            }, **entry['extra']))
+        return out
+
+
+def check_response(response, stage):
+    if response.status_code != 200:
+        raise RuntimeError(f'{stage} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response.get_json()
+
+
+def run_benchmark(config):
+    recorder = Recorder()
+
+    started = time.perf_counter()
+    file_bytes, filename, sheets = generate_workbook(config)
+    generate_seconds = time.perf_counter() - started
+
+    client = service.app.test_client()
+    login = check_response(client.post('/login', json={'username': config.username, 'password': config.password}), 'login')
+    headers = {'X-Session-Token': login['token']}
+
+    started = time.perf_counter()
+    upload = check_response(client.post('/upload', data={'file': (io.BytesIO(file_bytes), filename)},
+                                        headers=headers, content_type='multipart/form-data'), 'upload')
+    recorder.add(None, 'upload', time.perf_counter() - started)
+    file_id = upload['file_id']
+    uploaded_sheets = upload['sheets']
+    if config.file_format == 'csv':
+        sheets = {uploaded_sheets[0]: sheets[None]}
+
+    # Background analysis of every sheet starts with the upload; wait for all of them
+    for sheet in uploaded_sheets:
+        check_response(client.get('/analytics', query_string={'file_id': file_id, 'sheet': sheet}, headers=headers),
+                       'analytics')
+    recorder.add(None, 'upload_to_analytics_ready', time.perf_counter() - started)
+
+    for sheet, rating_cols in sheets.items():
+        for run in range(config.repeat):
+            df = recorder.time(sheet, 'load_dataframe', lambda: service.load_dataframe(file_bytes, sheet)[0])
+            if df is None:
+                break
+
+            recorder.time(sheet, 'FastAnalyzer.analyze', lambda: service.FastAnalyzer(df.copy(), file_id).analyze())
+
+            recorder.time(sheet, 'analyze_custom', lambda: check_response(client.post(
+                '/analyze-custom', headers=headers,
+                json={'file_id': file_id, 'sheet': sheet, 'dept_column': DEPT_COLUMN, 'rating_columns': rating_cols}),
+                'analyze_custom'))
+
+            recorder.time(sheet, 'process_dynamic_chart', service.process_dynamic_chart,
+                          df, DEPT_COLUMN, CURRENT_RATING_COLUMN, None, 'avg', 'bar')
+            if not config.no_region_column:
+                recorder.time(sheet, 'process_dynamic_chart[group_by=region]', service.process_dynamic_chart,
+                              df, DEPT_COLUMN, CURRENT_RATING_COLUMN, REGION_COLUMN, 'avg', 'bar')
+
+            body = {'file_id': file_id, 'sheet': sheet, 'dept_column': DEPT_COLUMN, 'rating_columns': rating_cols}
+            if config.ai_large_data != 'auto':
+                body['large_data'] = config.ai_large_data == 'on'
+            variant = 'cold' if run == 0 else 'warm'
+            started = time.perf_counter()
+            ai = recorder.time(sheet, f'ai_analyze[{variant}]',
+                               lambda: check_response(client.post('/ai-analyze', json=body, headers=headers), 'ai_analyze'))
+            if ai:
+                insights = ai.get('ai_insights', {})
+                for stage, seconds in ai.get('stage_timings', {}).items():
+                    # A stage that catches its own exception still answers 200, with {'error': ...} as its payload
+                    payload = insights.get(stage)
+                    if isinstance(payload, dict) and 'error' in payload:
+                        recorder.add(sheet, f'ai.{stage}[{variant}]', seconds, error=payload['error'])
+                    else:
+                        recorder.add(sheet, f'ai.{stage}[{variant}]', seconds)
+                # Loading, rating conversion and response encoding around the stage graph
+                recorder.add(sheet, f'ai.prepare_and_encode[{variant}]',
+                             max(0.0, time.perf_counter() - started - ai.get('stage_timings', {}).get('total', 0)))
+
+    return {
+        'benchmark': 'hr-analytics',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'sklearn': service.sklearn.__version__
+        },
+        'config': {
+            'rows': config.rows,
+            'sheets': config.sheets,
+            'rating_columns': config.rating_columns,
+            'departments': config.departments,
+            'missing': config.missing,
+            'region_column': not config.no_region_column,
+            'file_format': config.file_format,
+            'repeat': config.repeat,
+            'seed': config.seed
+        },
+        'workbook': {'bytes': len(file_bytes), 'generate_seconds': round(generate_seconds, 4)},
+        'results': recorder.results()
+    }
+
+
+def compare(report, baseline, threshold):
+    """Median ratio per (sheet, stage) against a previous report; returns regressed rows."""
+    previous = {(r['sheet'], r['stage']): r for r in baseline.get('results', [])}
+    rows = []
+    for r in report['results']:
+        old = previous.get((r['sheet'], r['stage']))
+        # Timings of a failed stage measure the error path, not the stage
+        if not old or not old['median'] or 'error' in r or 'error' in old:
+            continue
+        ratio = r['median'] / old['median']
+        rows.append({'sheet': r['sheet'], 'stage': r['stage'], 'baseline': old['median'],
+                     'current': r['median'], 'ratio': round(ratio, 3), 'regressed': ratio > threshold})
+    return rows
+
+
+def print_table(report, comparison, stream):
+    ratios = {(c['sheet'], c['stage']): c for c in comparison}
+    print(f"{'sheet':<12} {'stage':<48} {'median s':>10} {'min s':>10} {'vs base':>9}", file=stream)
+    for r in report['results']:
+        c = ratios.get((r['sheet'], r['stage']))
+        mark = f"{c['ratio']:.2f}x{' !' if c['regressed'] else ''}" if c else ''
+        error = f"  ERROR {r['error']}" if 'error' in r else ''
+        print(f"{str(r['sheet'] or '-'):<12} {r['stage']:<48} {r['median']:>10.4f} {r['min']:>10.4f} {mark:>9}{error}",
+              file=stream)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the HR analytics pipeline on a synthetic workbook.')
+    parser.add_argument('--rows', type=int, default=10000, help='rows per sheet')
+    parser.add_argument('--sheets', type=int, default=1, help='number of sheets (xlsx only)')
+    parser.add_argument('--rating-columns', type=int, default=3, help='rating columns including the current score')
+    parser.add_argument('--departments', type=int, default=60, help='distinct departments')
+    parser.add_argument('--missing', type=float, default=0.02, help='fraction of missing rating cells')
+    parser.add_argument('--no-region-column', action='store_true', help='derive regions from department names only')
+    parser.add_argument('--file-format', choices=['xlsx', 'csv'], default='xlsx')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage (first /ai-analyze run is cold)')
+    parser.add_argument('--ai-large-data', choices=['auto', 'on', 'off'], default='auto')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--username', default=os.environ.get('ADMIN_USERNAME', 'admin'))
+    parser.add_argument('--password', default=os.environ.get('BENCH_PASSWORD', 'admin123456'))
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='previous JSON report to compare medians against')
+    parser.add_argument('--threshold', type=float, default=1.25, help='median ratio that counts as a regression')
+    parser.add_argument('--verbose', action='store_true', help='keep the service INFO logs')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    config = parse_args(argv)
+    if config.rating_columns < 1 or config.rows < 10 or config.sheets < 1 or config.repeat < 1:
+        raise SystemExit('rows >= 10, sheets >= 1, rating-columns >= 1 and repeat >= 1 are required')
+    if not config.verbose:
+        service.logger.setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    report = run_benchmark(config)
+
+    comparison = []
+    if config.compare:
+        with open(config.compare, encoding='utf-8') as f:
+            comparison = compare(report, json.load(f), config.threshold)
+        report['comparison'] = {'baseline': config.compare, 'threshold': config.threshold, 'stages': comparison}
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if config.output:
+        with open(config.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    print_table(report, comparison, sys.stderr)
+    regressed = [c for c in comparison if c['regressed']]
+    errors = [r for r in report['results'] if 'error' in r]
+    if regressed:
+        print(f"⚠️ {len(regressed)} stage(s) slower than {config.threshold}x baseline", file=sys.stderr)
+    if errors:
+        print(f"❌ {len(errors)} stage(s) failed", file=sys.stderr)
+    return 1 if regressed or errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
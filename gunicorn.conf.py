@@ -0,0 +1,19 @@
+"""
+gunicorn settings for the HR analytics app: gunicorn app:app
+
+Sessions, uploads and the job queue live in process memory, so keep one worker
+and scale with threads. With preload the app (and scikit-learn, see PRELOAD_ML)
+is imported once in the master and forked workers share those pages
+copy-on-write; background threads start lazily on the first request, after fork.
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+# Only worth importing the ML stack up front when the master shares it
+os.environ.setdefault('PRELOAD_ML', '1' if preload_app else '0')
@@ -0,0 +1,441 @@
+"""
+Load-test runner for the HR analytics service.
+
+Replays concurrent analyst sessions against the whole request path:
+
+    /login (bcrypt) -> /upload -> poll /progress -> /analytics per sheet
+    -> /dynamic-analysis -> /ai-analyze
+
+Workbooks come from the benchmark.py generator. The app runs either
+in-process behind the Flask test client (default, one client per virtual
+user) or as a local gunicorn started by this script (--gunicorn), or any
+already running instance (--url). Everything works offline.
+
+Reports throughput and p50/p95/p99 latency per endpoint, plus global-lock
+wait/hold time: read from app.lock in-process, or scraped from the server's
+/metrics endpoint otherwise (with METRICS_TOKEN when set, else as the admin
+user). Output is JSON, with a summary table on stderr.
+
+Usage:
+    python loadtest.py --users 8 --iterations 3 --rows 5000 --output load.json
+    python loadtest.py --gunicorn --threads 8 --users 8 --duration 60
+    python loadtest.py --url http://127.0.0.1:8080 --users 4
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from datetime import datetime
+
+import numpy as np
+
+import benchmark
+from benchmark import CURRENT_RATING_COLUMN, DEPT_COLUMN, REGION_COLUMN, service
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TestClientTransport:
+    """Requests through the Flask test client of the imported app, one client address per user."""
+
+    def __init__(self, user=0):
+        self.client = service.app.test_client()
+        self.client.environ_base['REMOTE_ADDR'] = f'10.0.{user // 256}.{user % 256}'
+
+    def request(self, method, path, headers=None, json_body=None, query=None, upload=None):
+        kwargs = {'headers': headers or {}, 'query_string': query}
+        if json_body is not None:
+            kwargs['json'] = json_body
+        if upload is not None:
+            filename, data = upload
+            kwargs['data'] = {'file': (io.BytesIO(data), filename)}
+            kwargs['content_type'] = 'multipart/form-data'
+        response = self.client.open(path, method=method, **kwargs)
+        return response.status_code, response.get_json(silent=True)
+
+
+class HttpTransport:
+    """Plain urllib requests against a running server."""
+
+    def __init__(self, base_url, timeout=300):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def request(self, method, path, headers=None, json_body=None, query=None, upload=None):
+        url = self.base_url + path
+        if query:
+            url += '?' + urllib.parse.urlencode(query, doseq=True)
+        headers = dict(headers or {})
+        body = None
+        if json_body is not None:
+            body = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif upload is not None:
+            filename, data = upload
+            boundary = uuid.uuid4().hex
+            body = (f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+                    f'Content-Type: application/octet-stream\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+            headers['Content-Type'] = f'multipart/form-data; boundary={boundary}'
+
+        req = urllib.request.Request(url, data=body, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                status, payload = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, payload = e.code, e.read()
+        try:
+            return status, json.loads(payload) if payload else None
+        except ValueError:
+            return status, None
+
+
+class Recorder:
+    """Thread-safe per-endpoint latency samples."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+        self.sessions_completed = 0
+        self.session_errors = []
+
+    def call(self, transport, endpoint, method, path, **kwargs):
+        started = time.perf_counter()
+        status, payload = transport.request(method, path, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples.append((endpoint, elapsed, status))
+        return status, payload
+
+    def session_done(self, error=None):
+        with self._lock:
+            if error:
+                self.session_errors.append(error)
+            else:
+                self.sessions_completed += 1
+
+    def summary(self, wall_seconds):
+        endpoints = {}
+        for endpoint, elapsed, status in self.samples:
+            entry = endpoints.setdefault(endpoint, {'latencies': [], 'errors': 0, 'statuses': {}})
+            entry['latencies'].append(elapsed)
+            entry['statuses'][str(status)] = entry['statuses'].get(str(status), 0) + 1
+            if status >= 400:
+                entry['errors'] += 1
+
+        out = {}
+        for endpoint, entry in endpoints.items():
+            latencies = np.array(entry['latencies'])
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            out[endpoint] = {
+                'requests': len(latencies),
+                'errors': entry['errors'],
+                'statuses': entry['statuses'],
+                'throughput_rps': round(len(latencies) / wall_seconds, 3),
+                'mean_ms': round(latencies.mean() * 1000, 2),
+                'p50_ms': round(p50 * 1000, 2),
+                'p95_ms': round(p95 * 1000, 2),
+                'p99_ms': round(p99 * 1000, 2),
+                'max_ms': round(latencies.max() * 1000, 2)
+            }
+        return out
+
+
+def analyst_session(transport, recorder, workbook, config):
+    """One analyst: log in, upload, wait for the dashboard, then chart and AI analysis."""
+    file_bytes, filename, sheets = workbook
+
+    status, login = recorder.call(transport, 'login', 'POST', '/login',
+                                  json_body={'username': config.username, 'password': config.password})
+    if status != 200:
+        raise RuntimeError(f'login returned {status}')
+    headers = {'X-Session-Token': login['token']}
+
+    status, upload = recorder.call(transport, 'upload', 'POST', '/upload', headers=headers,
+                                   upload=(filename, file_bytes))
+    if status != 200:
+        raise RuntimeError(f'upload returned {status}')
+    file_id = upload['file_id']
+
+    deadline = time.monotonic() + config.poll_timeout
+    while time.monotonic() < deadline:
+        status, state = recorder.call(transport, 'progress', 'GET', '/progress', headers=headers,
+                                      query={'file_id': file_id})
+        if status != 200 or (state or {}).get('progress', 0) >= 100:
+            break
+        time.sleep(config.poll_interval)
+
+    for sheet in upload['sheets']:
+        status, _ = recorder.call(transport, 'analytics', 'GET', '/analytics', headers=headers,
+                                  query={'file_id': file_id, 'sheet': sheet})
+        if status != 200:
+            raise RuntimeError(f'analytics returned {status}')
+    time.sleep(config.think)
+
+    sheet = upload['sheets'][0]
+    rating_columns = sheets.get(sheet) or next(iter(sheets.values()))
+    chart = {'file_id': file_id, 'sheet': sheet, 'x_column': DEPT_COLUMN, 'y_column': CURRENT_RATING_COLUMN,
+             'aggregation': 'avg', 'chart_type': 'bar'}
+    if not config.no_region_column:
+        chart['group_by'] = REGION_COLUMN
+    recorder.call(transport, 'dynamic-analysis', 'POST', '/dynamic-analysis', headers=headers, json_body=chart)
+    time.sleep(config.think)
+
+    status, _ = recorder.call(transport, 'ai-analyze', 'POST', '/ai-analyze', headers=headers, json_body={
+        'file_id': file_id, 'sheet': sheet, 'dept_column': DEPT_COLUMN, 'rating_columns': rating_columns})
+    if status != 200:
+        raise RuntimeError(f'ai-analyze returned {status}')
+
+    recorder.call(transport, 'logout', 'POST', '/logout', headers=headers)
+
+
+def run_user(make_transport, recorder, workbooks, config, user, stop_at):
+    transport = make_transport(user)
+    iteration = 0
+    while (time.monotonic() < stop_at) if stop_at else (iteration < config.iterations):
+        try:
+            analyst_session(transport, recorder, workbooks[(user + iteration) % len(workbooks)], config)
+            recorder.session_done()
+        except Exception as e:
+            recorder.session_done(f'user {user}: {type(e).__name__}: {e}')
+        iteration += 1
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_gunicorn(config):
+    """Local gunicorn with one worker: sessions and uploads live in process memory."""
+    port = free_port()
+    cmd = [sys.executable, '-m', 'gunicorn', '--workers', '1', '--threads', str(config.threads),
+           '--bind', f'127.0.0.1:{port}', '--timeout', '600', '--log-level', 'warning', 'app:app']
+    # Every virtual user logs in from 127.0.0.1
+    env = dict(os.environ, MAX_SESSIONS_PER_IP=str(max(config.users, 5)))
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env)
+    url = f'http://127.0.0.1:{port}'
+    transport = HttpTransport(url, timeout=2)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            if transport.request('GET', '/status')[0] == 200:
+                return proc, url
+        except OSError:
+            pass
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with {proc.returncode}')
+        time.sleep(0.25)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not start within 60s')
+
+
+def scrape_lock_stats(transport, config):
+    """Rebuild InstrumentedLock.stats() from the hr_lock_* series of /metrics."""
+    url = transport.base_url + '/metrics'
+    headers = {}
+    if os.environ.get('METRICS_TOKEN'):
+        headers['Authorization'] = f"Bearer {os.environ['METRICS_TOKEN']}"
+    else:
+        # Without a scrape token /metrics wants an admin session
+        status, login = transport.request('POST', '/login',
+                                          json_body={'username': config.username, 'password': config.password})
+        if status == 200:
+            headers['X-Session-Token'] = login['token']
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers), timeout=30) as response:
+            text = response.read().decode()
+    except (urllib.error.URLError, OSError):
+        return None
+    finally:
+        if 'X-Session-Token' in headers:
+            transport.request('POST', '/logout', headers=headers)
+
+    values, buckets = {}, {'wait': [], 'hold': []}
+    for line in text.splitlines():
+        if not line.startswith('hr_lock_'):
+            continue
+        series, value = line.rsplit(' ', 1)
+        for kind in buckets:
+            prefix = f'hr_lock_{kind}_seconds_bucket{{le="'
+            if series.startswith(prefix):
+                le = series[len(prefix):-2]
+                buckets[kind].append((float('inf') if le == '+Inf' else float(le), int(float(value))))
+                break
+        else:
+            values[series] = float(value)
+    if 'hr_lock_wait_seconds_count' not in values:
+        return None
+
+    def per_bucket(cumulative):
+        return [(le, n - prev) for (le, n), prev in zip(cumulative, [0] + [n for _, n in cumulative])]
+
+    return {
+        'acquisitions': int(values['hr_lock_wait_seconds_count']),
+        'wait_seconds': values['hr_lock_wait_seconds_sum'],
+        'max_wait_seconds': values['hr_lock_max_wait_seconds'],
+        'hold_seconds': values['hr_lock_hold_seconds_sum'],
+        'max_hold_seconds': values['hr_lock_max_hold_seconds'],
+        'wait_buckets': per_bucket(buckets['wait']),
+        'hold_buckets': per_bucket(buckets['hold'])
+    }
+
+
+def lock_delta(before, after):
+    if before is None or after is None:
+        return None
+    acquisitions = after['acquisitions'] - before['acquisitions']
+    wait = after['wait_seconds'] - before['wait_seconds']
+    counts = [(le, a - b) for (le, a), (_, b) in zip(after['wait_buckets'], before['wait_buckets'])]
+    return {
+        'acquisitions': acquisitions,
+        'total_wait_ms': round(wait * 1000, 3),
+        'mean_wait_us': round(wait / acquisitions * 1e6, 2) if acquisitions else 0,
+        'max_wait_ms': round(after['max_wait_seconds'] * 1000, 3),
+        'total_hold_ms': round((after['hold_seconds'] - before['hold_seconds']) * 1000, 3),
+        'max_hold_ms': round(after['max_hold_seconds'] * 1000, 3),
+        'wait_buckets': [{'le': le if le != float('inf') else '+Inf', 'count': c} for le, c in counts]
+    }
+
+
+def run_load(config):
+    rows_args = ['--rows', str(config.rows), '--sheets', str(config.sheets),
+                 '--rating-columns', str(config.rating_columns), '--missing', str(config.missing),
+                 '--file-format', 'xlsx']
+    if config.no_region_column:
+        rows_args.append('--no-region-column')
+    workbooks = [benchmark.generate_workbook(benchmark.parse_args(rows_args + ['--seed', str(config.seed + i)]))
+                 for i in range(config.workbooks)]
+
+    proc = None
+    url = config.url
+    if config.gunicorn:
+        proc, url = start_gunicorn(config)
+
+    if url:
+        def make_transport(user):
+            return HttpTransport(url)
+        target = url
+    else:
+        make_transport = TestClientTransport
+        target = 'in-process test client'
+
+    def lock_stats():
+        return scrape_lock_stats(HttpTransport(url), config) if url else service.lock.stats()
+
+    recorder = Recorder()
+    lock_before = lock_stats()
+    stop_at = time.monotonic() + config.duration if config.duration else None
+    started = time.perf_counter()
+    try:
+        threads = [threading.Thread(target=run_user, args=(make_transport, recorder, workbooks, config, u, stop_at))
+                   for u in range(config.users)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        wall = time.perf_counter() - started
+        lock_after = lock_stats()
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+
+    return {
+        'loadtest': 'hr-analytics',
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'target': target,
+        'config': {
+            'users': config.users,
+            'iterations': config.iterations,
+            'duration': config.duration,
+            'rows': config.rows,
+            'sheets': config.sheets,
+            'rating_columns': config.rating_columns,
+            'missing': config.missing,
+            'workbooks': config.workbooks,
+            'think': config.think,
+            'threads': config.threads if config.gunicorn else None
+        },
+        'wall_seconds': round(wall, 3),
+        'sessions_completed': recorder.sessions_completed,
+        'session_errors': recorder.session_errors,
+        'throughput_rps': round(len(recorder.samples) / wall, 3),
+        'endpoints': recorder.summary(wall),
+        # Per-process: with several gunicorn workers this is whichever one served /metrics
+        'lock': lock_delta(lock_before, lock_after)
+    }
+
+
+def print_table(report, stream):
+    print(f"{'endpoint':<18} {'reqs':>6} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}", file=stream)
+    for endpoint, s in report['endpoints'].items():
+        print(f"{endpoint:<18} {s['requests']:>6} {s['errors']:>5} {s['throughput_rps']:>8.2f} "
+              f"{s['p50_ms']:>9.1f} {s['p95_ms']:>9.1f} {s['p99_ms']:>9.1f}", file=stream)
+    print(f"sessions: {report['sessions_completed']} ok, {len(report['session_errors'])} failed; "
+          f"{report['throughput_rps']:.2f} req/s over {report['wall_seconds']:.1f}s", file=stream)
+    if report['lock']:
+        lock = report['lock']
+        print(f"lock: {lock['acquisitions']} acquisitions, wait total {lock['total_wait_ms']:.1f} ms "
+              f"(max {lock['max_wait_ms']:.2f} ms), hold total {lock['total_hold_ms']:.1f} ms", file=stream)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Replay concurrent analyst sessions against the HR analytics app.')
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--url', help='run against an already running server instead of in-process '
+                        '(start it with MAX_SESSIONS_PER_IP >= --users)')
+    target.add_argument('--gunicorn', action='store_true', help='start a local gunicorn (1 worker) for the run')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn worker threads')
+    parser.add_argument('--users', type=int, default=4, help='concurrent virtual analysts')
+    parser.add_argument('--iterations', type=int, default=2, help='sessions per user')
+    parser.add_argument('--duration', type=float, default=0, help='keep replaying sessions for N seconds')
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--sheets', type=int, default=1)
+    parser.add_argument('--rating-columns', type=int, default=3)
+    parser.add_argument('--missing', type=float, default=0.02, help='fraction of missing rating cells')
+    parser.add_argument('--no-region-column', action='store_true')
+    parser.add_argument('--workbooks', type=int, default=2, help='distinct workbooks shared by the users')
+    parser.add_argument('--think', type=float, default=0.0, help='pause between dashboard steps (seconds)')
+    parser.add_argument('--poll-interval', type=float, default=0.2)
+    parser.add_argument('--poll-timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--username', default=os.environ.get('ADMIN_USERNAME', 'admin'))
+    parser.add_argument('--password', default=os.environ.get('BENCH_PASSWORD', 'admin123456'))
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--verbose', action='store_true', help='keep the service INFO logs')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    config = parse_args(argv)
+    if config.users < 1 or config.workbooks < 1 or (config.iterations < 1 and not config.duration):
+        raise SystemExit('users >= 1, workbooks >= 1 and iterations >= 1 (or --duration) are required')
+    if not config.verbose:
+        service.logger.setLevel(logging.WARNING)
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    report = run_load(config)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if config.output:
+        with open(config.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    print_table(report, sys.stderr)
+    return 1 if report['session_errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -13,6 +13,10 @@ const API_BASE = window.location.hostname === '127.0.0.1' || window.location.hos
     ? '' 
     : window.location.origin;
 
+// Files above this size are uploaded in checksummed chunks that can be resent after a dropped connection
+const CHUNKED_UPLOAD_THRESHOLD = 8 * 1024 * 1024;
+const CHUNK_RETRIES = 5;
+
 // Loading screen
 function showLoadingScreen(text, subtext) {
     const screen = document.getElementById('loadingScreen');
@@ -379,7 +383,8 @@ function attachEventListeners() {
                 return;
             }
             
-            const response = await fetch(`${API_BASE}/upload`, { 
+            const useChunks = file.size > CHUNKED_UPLOAD_THRESHOLD && window.crypto && window.crypto.subtle;
+            const response = useChunks ? await uploadInChunks(file) : await fetch(`${API_BASE}/upload`, { 
                 method: 'POST', 
                 body: formData, 
                 headers: { 'X-Session-Token': sessionToken } 
@@ -461,6 +466,62 @@ function attachEventListeners() {
     }
 }
 
+// Chunked upload
+async function sha256Hex(buffer) {
+    const digest = await crypto.subtle.digest('SHA-256', buffer);
+    return Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// رفع مجزأ قابل للاستئناف: عند فشل جزء يُسأل الخادم عن آخر موضع مستلم ويُكمل منه
+async function uploadInChunks(file) {
+    const headers = { 'X-Session-Token': sessionToken };
+    const init = await fetch(`${API_BASE}/upload/chunked`, {
+        method: 'POST',
+        headers: { ...headers, 'Content-Type': 'application/json' },
+        body: JSON.stringify({ filename: file.name, size: file.size })
+    });
+    if (!init.ok) return init;
+    const { upload_id: uploadId, chunk_size: chunkSize } = await init.json();
+    
+    let offset = 0;
+    let failures = 0;
+    while (offset < file.size) {
+        const chunk = await file.slice(offset, offset + chunkSize).arrayBuffer();
+        let response = null;
+        try {
+            response = await fetch(`${API_BASE}/upload/chunked/${uploadId}?offset=${offset}`, {
+                method: 'PUT',
+                headers: { ...headers, 'Content-Type': 'application/octet-stream', 'X-Chunk-SHA256': await sha256Hex(chunk) },
+                body: chunk
+            });
+        } catch (networkError) {
+            console.warn('Chunk upload failed:', networkError);
+        }
+        
+        if (response && response.ok) {
+            offset = (await response.json()).offset;
+            failures = 0;
+            showLoadingScreen('جاري رفع الملف...', `${file.name} (${Math.round(offset * 100 / file.size)}%)`);
+            continue;
+        }
+        if (response && (response.status === 401 || response.status === 404)) return response;
+        if (++failures > CHUNK_RETRIES) {
+            if (response) return response;
+            throw new Error('انقطع الاتصال أثناء رفع الملف');
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, 1000 * failures));
+        try {
+            const status = await fetch(`${API_BASE}/upload/chunked/${uploadId}`, { headers });
+            if (status.ok) offset = (await status.json()).offset;
+        } catch (networkError) {
+            console.warn('Upload status check failed:', networkError);
+        }
+    }
+    
+    return fetch(`${API_BASE}/upload/chunked/${uploadId}/complete`, { method: 'POST', headers });
+}
+
 // Load analytics
 async function loadAnalyticsForSheet(sheetName) {
     showLoadingScreen('جاري تحميل النتائج...', 'الرجاء الانتظار');
@@ -472,16 +533,9 @@ async function loadAnalyticsForSheet(sheetName) {
             const controller = new AbortController();
             const timeout = setTimeout(() => controller.abort(), 120000);
             
-            const response = await fetch(`${API_BASE}/analytics`, {
-                method: 'POST',
-                headers: { 
-                    'X-Session-Token': sessionToken, 
-                    'Content-Type': 'application/json' 
-                },
-                body: JSON.stringify({ 
-                    file_id: currentFileId, 
-                    sheet: sheetName 
-                }),
+            const params = new URLSearchParams({ file_id: currentFileId, sheet: sheetName });
+            const response = await fetch(`${API_BASE}/analytics?${params}`, {
+                headers: { 'X-Session-Token': sessionToken },
                 signal: controller.signal
             });
             
@@ -931,43 +985,58 @@ async function clearData() {
 }
 
 // Populate filters
-function populateFilters(data) {
+async function populateFilters(data) {
     const deptSelect = document.getElementById('filter-department');
     const regionSelect = document.getElementById('filter-region-main');
     
+    // All departments/regions come from the server index, not only the top 10
+    let facets = null;
+    try {
+        const response = await fetch(`${API_BASE}/query`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Session-Token': sessionToken
+            },
+            body: JSON.stringify({
+                file_id: currentFileId,
+                sheet: currentSheetName,
+                include_facets: true,
+                top_n: 0
+            })
+        });
+        if (response.ok) {
+            facets = (await response.json()).facets;
+        }
+    } catch (error) {
+        console.warn('Could not load filter options:', error);
+    }
+    
     if (deptSelect) {
         deptSelect.innerHTML = '<option value="">الكل</option>';
-        if (data.top_departments) {
-            data.top_departments.forEach(dept => {
-                const option = document.createElement('option');
-                option.value = dept.name;
-                option.textContent = dept.name;
-                deptSelect.appendChild(option);
-            });
-        }
+        const deptNames = facets ? facets.departments : (data.top_departments || []).map(d => d.name);
+        deptNames.forEach(name => {
+            const option = document.createElement('option');
+            option.value = name;
+            option.textContent = name;
+            deptSelect.appendChild(option);
+        });
     }
     
     if (regionSelect) {
         regionSelect.innerHTML = '<option value="">جميع المناطق</option>';
-        // Add unique regions from department names
-        const cities = new Set();
-        if (data.top_departments) {
-            data.top_departments.forEach(dept => {
-                const city = extractCityFromName(dept.name);
-                if (city) cities.add(city);
-            });
-        }
-        Array.from(cities).sort().forEach(city => {
+        const regionNames = facets ? facets.regions : Object.keys(data.regional_data || {});
+        regionNames.forEach(name => {
             const option = document.createElement('option');
-            option.value = city;
-            option.textContent = city;
+            option.value = name;
+            option.textContent = name;
             regionSelect.appendChild(option);
         });
     }
 }
 
-// Apply filters
-function applyFilters() {
+// Apply filters (server-side over the whole dataset)
+async function applyFilters() {
     if (!rawAnalyticsData) { 
         showError('لا توجد بيانات', 3000); 
         return; 
@@ -975,39 +1044,48 @@ function applyFilters() {
     
     const regionMain = document.getElementById('filter-region-main').value;
     const department = document.getElementById('filter-department').value;
-    const ratingMin = parseFloat(document.getElementById('filter-rating-min').value) || 0;
-    const ratingMax = parseFloat(document.getElementById('filter-rating-max').value) || 5;
+    const ratingMinValue = document.getElementById('filter-rating-min').value;
+    const ratingMaxValue = document.getElementById('filter-rating-max').value;
     
-    let filteredDepts = rawAnalyticsData.top_departments || [];
-    
-    // Apply region filter
-    if (regionMain) {
-        filteredDepts = filteredDepts.filter(d => extractCityFromName(d.name) === regionMain);
-    }
-    
-    // Apply department filter
-    if (department) {
-        filteredDepts = filteredDepts.filter(d => d.name === department);
+    try {
+        const response = await fetch(`${API_BASE}/query`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+                'X-Session-Token': sessionToken
+            },
+            body: JSON.stringify({
+                file_id: currentFileId,
+                sheet: currentSheetName,
+                region: regionMain || null,
+                department: department || null,
+                rating_min: ratingMinValue === '' ? null : parseFloat(ratingMinValue),
+                rating_max: ratingMaxValue === '' ? null : parseFloat(ratingMaxValue)
+            })
+        });
+        
+        const result = await response.json();
+        if (!response.ok) {
+            throw new Error(result.error || 'Query failed');
+        }
+        
+        const filteredDepts = result.top_departments || [];
+        
+        document.getElementById('total-records').textContent = result.total_records.toLocaleString();
+        document.getElementById('valid-ratings').textContent = result.valid_ratings.toLocaleString();
+        document.getElementById('avg-rating').textContent = parseFloat(result.avg_rating || 0).toFixed(2);
+        
+        renderDepartmentsChart(filteredDepts);
+        renderRatingsDistribution(filteredDepts);
+        renderEmployeesByDept(filteredDepts);
+        renderPerformanceComparison(filteredDepts);
+        renderCitiesChart(filteredDepts);
+        
+        showError('✓ تم تطبيق الفلاتر', 2000);
+    } catch (error) {
+        console.error('Filter error:', error);
+        showError('خطأ في تطبيق الفلاتر: ' + error.message);
     }
-    
-    // Apply rating filter
-    filteredDepts = filteredDepts.filter(d => d.rating >= ratingMin && d.rating <= ratingMax);
-    
-    // Calculate stats
-    const totalEmployees = filteredDepts.reduce((sum, d) => sum + d.employees, 0);
-    const avgRating = filteredDepts.length > 0 ? filteredDepts.reduce((sum, d) => sum + (d.rating * d.employees), 0) / totalEmployees : 0;
-    
-    document.getElementById('total-records').textContent = totalEmployees.toLocaleString();
-    document.getElementById('valid-ratings').textContent = totalEmployees.toLocaleString();
-    document.getElementById('avg-rating').textContent = avgRating.toFixed(2);
-    
-    renderDepartmentsChart(filteredDepts);
-    renderRatingsDistribution(filteredDepts);
-    renderEmployeesByDept(filteredDepts);
-    renderPerformanceComparison(filteredDepts);
-    renderCitiesChart(filteredDepts);
-    
-    showError('✓ تم تطبيق الفلاتر', 2000);
 }
 
 // Reset filters
@@ -1036,16 +1114,9 @@ async function showColumnSelectionModal(sheetName) {
     try {
         showLoadingScreen('جاري جلب الأعمدة...', '');
         
-        const response = await fetch(`${API_BASE}/get-columns`, {
-            method: 'POST',
-            headers: {
-                'X-Session-Token': sessionToken,
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                file_id: currentFileId,
-                sheet: sheetName
-            })
+        const params = new URLSearchParams({ file_id: currentFileId, sheet: sheetName });
+        const response = await fetch(`${API_BASE}/get-columns?${params}`, {
+            headers: { 'X-Session-Token': sessionToken }
         });
         
         hideLoadingScreen();
@@ -1234,18 +1305,10 @@ async function runCustomAnalysis(deptCol, ratingCols) {
     showLoadingScreen('جاري التحليل...', 'الرجاء الانتظار');
     
     try {
-        const response = await fetch(`${API_BASE}/analyze-custom`, {
-            method: 'POST',
-            headers: {
-                'X-Session-Token': sessionToken,
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                file_id: currentFileId,
-                sheet: currentSheetName,
-                dept_column: deptCol,
-                rating_columns: ratingCols
-            })
+        const params = new URLSearchParams({ file_id: currentFileId, sheet: currentSheetName, dept_column: deptCol });
+        ratingCols.forEach(col => params.append('rating_columns', col));
+        const response = await fetch(`${API_BASE}/analyze-custom?${params}`, {
+            headers: { 'X-Session-Token': sessionToken }
         });
         
         const rawText = await response.text();
@@ -1289,16 +1352,9 @@ async function runAIAnalysis() {
     
     try {
         // جلب الأعمدة أولاً
-        const columnsResponse = await fetch(`${API_BASE}/get-columns`, {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json',
-                'X-Session-Token': sessionToken
-            },
-            body: JSON.stringify({
-                file_id: currentFileId,
-                sheet: currentSheetName
-            })
+        const columnsParams = new URLSearchParams({ file_id: currentFileId, sheet: currentSheetName });
+        const columnsResponse = await fetch(`${API_BASE}/get-columns?${columnsParams}`, {
+            headers: { 'X-Session-Token': sessionToken }
         });
         
         const columnsData = await columnsResponse.json();
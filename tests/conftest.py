@@ -0,0 +1,57 @@
+import io
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+# app.py reads its configuration at import time: point every store at a scratch directory first
+_STATE_DIR = tempfile.mkdtemp(prefix='hr-analytics-tests-')
+os.environ.setdefault('JOB_DIR', os.path.join(_STATE_DIR, 'jobs'))
+os.environ.setdefault('MODEL_CACHE_DIR', os.path.join(_STATE_DIR, 'models'))
+os.environ.setdefault('SESSION_SECRET', 'test-secret')
+os.environ.setdefault('MAX_SESSIONS_PER_IP', '1000')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as app_module  # noqa: E402
+
+ADMIN_PASSWORD = 'admin123456'
+
+
+@pytest.fixture(scope='session')
+def hr_app():
+    return app_module
+
+
+@pytest.fixture
+def client(hr_app):
+    return hr_app.app.test_client()
+
+
+@pytest.fixture
+def auth_headers(client):
+    credentials = {'username': app_module.DEFAULT_USERNAME, 'password': ADMIN_PASSWORD}
+    response = client.post('/login', json=credentials)
+    assert response.status_code == 200, response.get_json()
+    headers = {'X-Session-Token': response.get_json()['token']}
+    yield headers
+    client.post('/logout', headers=headers)
+
+
+def upload_csv(client, headers, frame, name='data.csv', **fields):
+    """Upload a DataFrame as CSV through /upload and return the JSON body"""
+    data = {'file': (io.BytesIO(frame.to_csv(index=False).encode()), name), **fields}
+    response = client.post('/upload', data=data, headers=headers, content_type='multipart/form-data')
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def wait_for(predicate, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.05)
+    return False
@@ -0,0 +1,50 @@
+import numpy as np
+import pandas as pd
+
+from conftest import upload_csv
+
+
+def ratings_frame(rows=120, seed=0):
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame({
+        'الإدارة': [f'إدارة {i % 4}' for i in range(rows)],
+        'تقييم 1': rng.integers(1, 6, rows).astype(float),
+        'تقييم 2': rng.integers(1, 6, rows).astype(float),
+        'تقييم 3': rng.integers(1, 6, rows).astype(float),
+    })
+    return frame
+
+
+def test_blank_rating_cells_are_imputed_and_models_are_reused(client, auth_headers, hr_app):
+    frame = ratings_frame()
+    frame.loc[[3, 40, 77], 'تقييم 2'] = np.nan
+    frame.loc[5, 'تقييم 3'] = np.nan
+    uploaded = upload_csv(client, auth_headers, frame, name='blank-cells.csv')
+    request = {'file_id': uploaded['file_id'], 'sheet': uploaded['sheets'][0], 'dept_column': 'الإدارة',
+               'rating_columns': ['تقييم 1', 'تقييم 2', 'تقييم 3']}
+
+    first = client.post('/ai-analyze', json=request, headers=auth_headers)
+    assert first.status_code == 200
+    insights = first.get_json()['ai_insights']
+    assert 'error' not in insights['predictions']
+    assert 'error' not in insights['employee_clusters']
+    assert sum(cluster['size'] for cluster in insights['employee_clusters']['clusters']) == len(frame)
+    assert first.get_json()['models_cached'] is False
+
+    second = client.post('/ai-analyze', json=request, headers=auth_headers)
+    assert second.status_code == 200
+    assert second.get_json()['models_cached'] is True
+    assert second.get_json()['ai_insights']['predictions'] == insights['predictions']
+
+
+def test_rating_matrix_fills_blanks_with_column_means(hr_app):
+    frame = pd.DataFrame({'a': [1.0, np.nan, 3.0], 'b': [np.nan, np.nan, np.nan], 'avg_rating': [1.0, 2.0, 3.0]})
+    matrix = hr_app._rating_matrix(frame, ['a', 'b'])
+    assert matrix.tolist() == [[1.0, 2.0], [2.0, 2.0], [3.0, 2.0]]
+
+
+def test_model_cache_directory_is_private(hr_app, tmp_path):
+    registry = hr_app.ModelRegistry(str(tmp_path / 'models'), 1 << 20)
+    registry.put('key', {'prediction': {'r2': 0.5}})
+    assert (tmp_path / 'models').stat().st_mode & 0o777 == 0o700
+    assert registry.get('key') == {'prediction': {'r2': 0.5}}
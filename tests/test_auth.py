@@ -0,0 +1,68 @@
+from conftest import ADMIN_PASSWORD, app_module
+
+
+class BrokenExecutor:
+    def submit(self, *args, **kwargs):
+        raise RuntimeError('cannot schedule new futures after shutdown')
+
+
+def login(client, password=ADMIN_PASSWORD, ip='127.0.0.1'):
+    return client.post('/login', json={'username': app_module.DEFAULT_USERNAME, 'password': password},
+                       environ_base={'REMOTE_ADDR': ip})
+
+
+def test_hashing_failure_rejects_the_default_password(client, hr_app, monkeypatch):
+    monkeypatch.setattr(hr_app, 'login_hash_executor', BrokenExecutor())
+    response = login(client, ip='10.0.0.43')
+    assert response.status_code == 401
+    assert 'token' not in response.get_json()
+
+
+def test_valid_token_is_accepted(client, auth_headers):
+    response = client.get('/auth-check', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.get_json()['username'] == app_module.DEFAULT_USERNAME
+
+
+def test_tampered_signature_is_rejected(client, auth_headers, hr_app):
+    version, body, signature = auth_headers['X-Session-Token'].split('.')
+    forged = f"{version}.{body}.{signature[:-2]}{'AA' if signature[-2:] != 'AA' else 'BB'}"
+    assert hr_app.verify_session_token(forged, '127.0.0.1') == (None, 'Invalid session')
+    assert client.get('/auth-check', headers={'X-Session-Token': forged}).status_code == 401
+
+
+def test_tampered_claims_are_rejected(hr_app):
+    token, claims = hr_app.issue_session_token('admin', '127.0.0.1')
+    version, _, signature = token.split('.')
+    body = hr_app._b64encode(hr_app.json.dumps(dict(claims, u='root')).encode())
+    assert hr_app.verify_session_token(f'{version}.{body}.{signature}', '127.0.0.1') == (None, 'Invalid session')
+
+
+def test_expired_token_is_rejected(client, hr_app, monkeypatch):
+    monkeypatch.setattr(hr_app, 'SESSION_TIMEOUT', hr_app.timedelta(seconds=-1))
+    token, _ = hr_app.issue_session_token('admin', '127.0.0.1')
+    assert hr_app.verify_session_token(token, '127.0.0.1') == (None, 'Session expired')
+    assert client.get('/auth-check', headers={'X-Session-Token': token}).status_code == 401
+
+
+def test_token_is_bound_to_the_client_ip(client, auth_headers):
+    other_ip = {'REMOTE_ADDR': '10.9.8.7'}
+    assert client.get('/auth-check', headers=auth_headers, environ_base=other_ip).status_code == 401
+    assert client.get('/auth-check', headers=auth_headers).status_code == 200
+
+
+def test_logout_revokes_the_token(client):
+    token = login(client).get_json()['token']
+    headers = {'X-Session-Token': token}
+    assert client.post('/logout', headers=headers).status_code == 200
+    assert client.get('/auth-check', headers=headers).status_code == 401
+    assert client.get('/init-session', headers=headers).status_code == 401
+    assert client.post('/logout', headers=headers).status_code == 401
+
+
+def test_token_from_another_secret_is_rejected(client, hr_app, monkeypatch):
+    monkeypatch.setattr(hr_app, 'SESSION_SECRET', b'a-different-deployment')
+    foreign, _ = hr_app.issue_session_token('admin', '127.0.0.1')
+    monkeypatch.undo()
+    assert hr_app.verify_session_token(foreign, '127.0.0.1') == (None, 'Invalid session')
+    assert client.get('/auth-check', headers={'X-Session-Token': foreign}).status_code == 401
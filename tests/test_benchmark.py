@@ -0,0 +1,35 @@
+import json
+
+import benchmark
+
+
+def run(tmp_path, *args):
+    output = tmp_path / 'bench.json'
+    code = benchmark.main(['--rows', '300', '--departments', '8', '--repeat', '1', '--file-format', 'csv',
+                           '--output', str(output), *args])
+    return code, json.loads(output.read_text(encoding='utf-8'))
+
+
+def test_default_workbook_with_missing_cells_runs_clean(tmp_path):
+    code, report = run(tmp_path)
+    assert code == 0
+    assert not [r for r in report['results'] if 'error' in r]
+
+
+def test_stage_error_payload_fails_the_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(benchmark.service, '_perform_employee_clustering',
+                        lambda df, rating_columns, models=None: {'error': 'boom'})
+    code, report = run(tmp_path)
+    stages = {r['stage']: r for r in report['results']}
+    assert code == 1
+    assert stages['ai.employee_clusters[cold]']['error'] == 'boom'
+    assert 'error' not in stages['ai.predictions[cold]']
+
+
+def test_compare_skips_failed_stages():
+    ok = {'sheet': 's', 'stage': 'a', 'median': 1.0}
+    failed = {'sheet': 's', 'stage': 'b', 'median': 0.02, 'error': 'boom'}
+    baseline = {'results': [ok, failed]}
+    current = {'results': [dict(ok, median=1.1), {'sheet': 's', 'stage': 'b', 'median': 1.0}]}
+    rows = benchmark.compare(current, baseline, 1.25)
+    assert [row['stage'] for row in rows] == ['a']
@@ -0,0 +1,91 @@
+import hashlib
+import os
+
+import pandas as pd
+import pytest
+
+from conftest import upload_csv
+
+
+@pytest.fixture
+def csv_bytes():
+    frame = pd.DataFrame({'الإدارة': [f'إدارة {i % 7}' for i in range(400)],
+                          'درجة الاداء الحالية': [1 + i % 5 for i in range(400)]})
+    return frame, frame.to_csv(index=False).encode()
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def start(client, headers, data, **extra):
+    response = client.post('/upload/chunked', json={'filename': 'chunked.csv', 'size': len(data), **extra},
+                           headers=headers)
+    assert response.status_code == 200
+    return response.get_json()['upload_id']
+
+
+def put(client, headers, upload_id, offset, chunk, checksum=None):
+    return client.put(f'/upload/chunked/{upload_id}', query_string={'offset': offset}, data=chunk,
+                      headers={**headers, 'X-Chunk-SHA256': checksum or sha256(chunk)})
+
+
+def test_bad_chunk_is_truncated_and_the_upload_resumes(client, auth_headers, hr_app, csv_bytes):
+    frame, data = csv_bytes
+    third = len(data) // 3
+    chunks = [data[:third], data[third:2 * third], data[2 * third:]]
+    upload_id = start(client, auth_headers, data, sha256=sha256(data))
+    part_path = hr_app.chunked_uploads[upload_id].path
+
+    assert put(client, auth_headers, upload_id, 0, chunks[0]).get_json()['offset'] == third
+
+    corrupted = put(client, auth_headers, upload_id, third, chunks[1], checksum=sha256(b'something else'))
+    assert corrupted.status_code == 400
+    assert corrupted.get_json()['offset'] == third
+    assert os.path.getsize(part_path) == third  # the rejected bytes were cut off again
+
+    # A client that lost track asks where to resume
+    resume_at = client.get(f'/upload/chunked/{upload_id}', headers=auth_headers).get_json()['offset']
+    assert resume_at == third
+    assert put(client, auth_headers, upload_id, resume_at, chunks[1]).status_code == 200
+    last = put(client, auth_headers, upload_id, 2 * third, chunks[2]).get_json()
+    assert last == {'success': True, 'offset': len(data), 'complete': True}
+
+    completed = client.post(f'/upload/chunked/{upload_id}/complete', json={}, headers=auth_headers)
+    assert completed.status_code == 200
+    assert completed.get_json()['file_id'] == sha256(data)[:16]
+    assert completed.get_json()['file_id'] == upload_csv(client, auth_headers, frame)['file_id']
+
+
+def test_out_of_order_chunk_is_refused(client, auth_headers, csv_bytes):
+    _, data = csv_bytes
+    upload_id = start(client, auth_headers, data)
+    put(client, auth_headers, upload_id, 0, data[:100])
+
+    skipped = put(client, auth_headers, upload_id, 200, data[200:300])
+    assert skipped.status_code == 409
+    assert skipped.get_json()['offset'] == 100
+    replayed = put(client, auth_headers, upload_id, 0, data[:100])
+    assert replayed.status_code == 409
+    assert client.get(f'/upload/chunked/{upload_id}', headers=auth_headers).get_json()['offset'] == 100
+
+
+def test_incomplete_or_corrupt_uploads_do_not_complete(client, auth_headers, csv_bytes):
+    _, data = csv_bytes
+    upload_id = start(client, auth_headers, data, sha256=sha256(data + b'x'))
+    put(client, auth_headers, upload_id, 0, data[:100])
+    early = client.post(f'/upload/chunked/{upload_id}/complete', json={}, headers=auth_headers)
+    assert early.status_code == 400
+
+    put(client, auth_headers, upload_id, 100, data[100:])
+    mismatch = client.post(f'/upload/chunked/{upload_id}/complete', json={}, headers=auth_headers)
+    assert mismatch.status_code == 400
+    assert mismatch.get_json()['error'] == 'File checksum mismatch'
+
+
+def test_chunks_of_another_user_upload_are_not_found(client, auth_headers, hr_app, csv_bytes):
+    _, data = csv_bytes
+    upload_id = start(client, auth_headers, data)
+    with hr_app.lock:
+        hr_app.chunked_uploads[upload_id].owner = 'someone else'
+    assert put(client, auth_headers, upload_id, 0, data[:100]).status_code == 404
@@ -0,0 +1,72 @@
+import math
+
+import pandas as pd
+import pytest
+from scipy import stats
+
+from conftest import upload_csv
+
+BASE = {'إدارة أ': [2, 3, 4], 'إدارة ب': [4, 4, 5, 5], 'إدارة ج': [2, 2]}
+CURRENT = {'إدارة أ': [5, 5, 4, 5], 'إدارة ب': [4, 5, 4], 'إدارة د': [2, 2]}
+
+
+def frame(groups):
+    rows = [(dept, rating) for dept, ratings in groups.items() for rating in ratings]
+    return pd.DataFrame(rows, columns=['الإدارة', 'درجة الاداء الحالية'])
+
+
+def welch(a, b):
+    """Textbook Welch t statistic from the raw ratings"""
+    var_a = sum((x - sum(a) / len(a)) ** 2 for x in a) / (len(a) - 1)
+    var_b = sum((x - sum(b) / len(b)) ** 2 for x in b) / (len(b) - 1)
+    return (sum(b) / len(b) - sum(a) / len(a)) / math.sqrt(var_a / len(a) + var_b / len(b))
+
+
+@pytest.fixture
+def comparison(client, auth_headers):
+    base = upload_csv(client, auth_headers, frame(BASE), name='base.csv')
+    current = upload_csv(client, auth_headers, frame(CURRENT), name='current.csv')
+    response = client.post('/compare', json={'base_file_id': base['file_id'], 'base_sheet': base['sheets'][0],
+                                             'file_id': current['file_id'], 'sheet': current['sheets'][0],
+                                             'scope': 'dept', 'order': 'name'}, headers=auth_headers)
+    assert response.status_code == 200, response.get_json()
+    return response.get_json()
+
+
+def test_matched_departments_against_hand_computed_figures(comparison):
+    groups = {group['name']: group for group in comparison['groups']}
+
+    # أ: mean 3 -> 4.75 and rank 2 -> 1; ب: mean 4.5 -> 4.33 and rank 1 -> 2
+    first, second = groups['إدارة أ'], groups['إدارة ب']
+    assert (first['base']['avg_rating'], first['current']['avg_rating']) == (3.0, 4.75)
+    assert (first['delta'], first['delta_pct'], first['rank_change']) == (1.75, 58.3, 1)
+    assert (first['base']['std'], first['current']['std']) == (1.0, 0.5)
+    assert (second['delta'], second['rank_change']) == (-0.17, -1)
+    assert (second['base']['employees'], second['current']['employees']) == (4, 3)
+
+    for name in ('إدارة أ', 'إدارة ب'):
+        a, b = BASE[name], CURRENT[name]
+        assert groups[name]['t_statistic'] == pytest.approx(welch(a, b), abs=1e-3)
+        expected_p = stats.ttest_ind(b, a, equal_var=False).pvalue
+        assert groups[name]['p_value'] == pytest.approx(expected_p, abs=1e-4)
+        assert groups[name]['significant'] == (expected_p < 0.05)
+
+
+def test_new_and_removed_departments(comparison):
+    groups = {group['name']: group for group in comparison['groups']}
+    removed, new = groups['إدارة ج'], groups['إدارة د']
+    assert (removed['status'], removed['current'], removed['delta']) == ('removed', None, None)
+    assert removed['p_value'] is None
+    assert (new['status'], new['base'], new['delta']) == ('new', None, None)
+    assert comparison['summary'] == {'matched': 2, 'new': 1, 'removed': 1,
+                                     'improved': int(groups['إدارة أ']['significant']), 'declined': 0}
+
+
+def test_overall_figures_pool_every_rating(comparison):
+    base = [r for ratings in BASE.values() for r in ratings]
+    current = [r for ratings in CURRENT.values() for r in ratings]
+    overall = comparison['overall']
+    assert overall['base'] == {'employees': 9, 'avg_rating': round(sum(base) / 9, 2)}
+    assert overall['current'] == {'employees': 9, 'avg_rating': round(sum(current) / 9, 2)}
+    assert overall['t_statistic'] == pytest.approx(welch(base, current), abs=1e-3)
+    assert overall['p_value'] == pytest.approx(stats.ttest_ind(current, base, equal_var=False).pvalue, abs=1e-4)
@@ -0,0 +1,121 @@
+import threading
+
+import pytest
+
+from conftest import wait_for
+
+
+@pytest.fixture
+def make_scheduler(hr_app, tmp_path):
+    """JobScheduler on its own directory whose 'record' jobs log their payload name, optionally behind a gate"""
+    def make(workers=1, gate=None):
+        scheduler = hr_app.JobScheduler(str(tmp_path), workers)
+        scheduler.ran = []
+
+        @scheduler.handler('record')
+        def record(payload):
+            if gate is not None and payload.get('wait'):
+                gate.wait(10)
+            scheduler.ran.append(payload['name'])
+            return payload['name']
+        return scheduler
+    return make
+
+
+def status(scheduler, job_id):
+    return scheduler.get(job_id)[0]['status']
+
+
+def test_interactive_jobs_run_before_queued_batch_jobs(hr_app, make_scheduler):
+    gate = threading.Event()
+    scheduler = make_scheduler(gate=gate)
+    blocker = scheduler.submit('record', {'name': 'blocker', 'wait': True}, session='a')
+    assert wait_for(lambda: status(scheduler, blocker) == 'running')
+
+    for name in ('batch 1', 'batch 2'):
+        scheduler.submit('record', {'name': name}, priority=hr_app.JOB_BATCH, session='a')
+    last = scheduler.submit('record', {'name': 'interactive'}, priority=hr_app.JOB_INTERACTIVE, session='b')
+    gate.set()
+
+    assert wait_for(lambda: len(scheduler.ran) == 4)
+    assert scheduler.ran == ['blocker', 'interactive', 'batch 1', 'batch 2']
+    assert status(scheduler, last) == 'done'
+
+
+def test_promoted_sheet_overtakes_queued_background_sheets(hr_app, make_scheduler):
+    gate = threading.Event()
+    scheduler = make_scheduler(gate=gate)
+    scheduler.submit('record', {'name': 'blocker', 'wait': True}, session='a')
+    for sheet in range(1, 4):
+        scheduler.submit('record', {'name': f'sheet {sheet}'}, priority=hr_app.JOB_BATCH, session='a',
+                         key=f'analyze:f:sheet {sheet}')
+
+    # The user opens sheet 3 while sheets 1-2 are still queued behind the blocker
+    scheduler.promote('analyze:f:sheet 3')
+    gate.set()
+
+    assert wait_for(lambda: len(scheduler.ran) == 4)
+    assert scheduler.ran == ['blocker', 'sheet 3', 'sheet 1', 'sheet 2']
+
+
+def test_batch_jobs_rotate_between_sessions(hr_app, make_scheduler):
+    gate = threading.Event()
+    scheduler = make_scheduler(gate=gate)
+    scheduler.submit('record', {'name': 'blocker', 'wait': True}, session='a')
+    for name in ('a1', 'a2', 'a3'):
+        scheduler.submit('record', {'name': name}, session='a')
+    scheduler.submit('record', {'name': 'b1'}, session='b')
+    gate.set()
+
+    assert wait_for(lambda: len(scheduler.ran) == 5)
+    assert scheduler.ran == ['blocker', 'a1', 'b1', 'a2', 'a3']
+
+
+def test_identical_analyze_job_is_deduplicated(make_scheduler):
+    gate = threading.Event()
+    scheduler = make_scheduler(gate=gate)
+    first = scheduler.submit('record', {'name': 'sheet', 'wait': True}, key='analyze:f:sheet')
+    assert scheduler.submit('record', {'name': 'sheet', 'wait': True}, key='analyze:f:sheet') == first
+    gate.set()
+
+    assert wait_for(lambda: status(scheduler, first) == 'done')
+    assert scheduler.ran == ['sheet']
+    # Once finished the key is free again
+    assert wait_for(lambda: scheduler.latest('analyze:f:sheet') == ('done', None))
+    again = scheduler.submit('record', {'name': 'sheet'}, key='analyze:f:sheet')
+    assert again != first
+    assert wait_for(lambda: status(scheduler, again) == 'done')
+
+
+def test_deduplicated_submit_adds_its_payload_to_a_running_job(make_scheduler):
+    gate = threading.Event()
+    scheduler = make_scheduler(gate=gate)
+    job_id = scheduler.submit('record', {'name': 'sheet', 'wait': True}, key='analyze:f:sheet')
+    assert wait_for(lambda: status(scheduler, job_id) == 'running')
+    assert scheduler.submit('record', {'name': 'sheet', 'period': '2024-Q1'}, key='analyze:f:sheet') == job_id
+    gate.set()
+
+    assert wait_for(lambda: status(scheduler, job_id) == 'done')
+    assert scheduler.ran == ['sheet', 'sheet']  # ran once more with the merged payload
+
+
+def test_running_jobs_are_retried_after_a_restart(hr_app, make_scheduler):
+    crashed = make_scheduler(workers=0)
+    retried = crashed.submit('record', {'name': 'was running'})
+    exhausted = crashed.submit('record', {'name': 'out of attempts'})
+    queued = crashed.submit('record', {'name': 'was queued'})
+    # Simulate a process that died while two jobs were running
+    crashed._sql("UPDATE jobs SET status = 'running', attempts = 1 WHERE id = ?", (retried,))
+    crashed._sql("UPDATE jobs SET status = 'running', attempts = ? WHERE id = ?",
+                 (hr_app.JOB_MAX_ATTEMPTS, exhausted))
+
+    restarted = make_scheduler(workers=1)
+    restarted.start()
+
+    assert wait_for(lambda: len(restarted.ran) == 2)
+    assert sorted(restarted.ran) == ['was queued', 'was running']
+    job, _ = restarted.get(retried)
+    assert (job['status'], job['attempts']) == ('done', 2)
+    job, _ = restarted.get(exhausted)
+    assert (job['status'], job['error']) == ('failed', 'Interrupted by restart')
+    assert status(restarted, queued) == 'done'
@@ -0,0 +1,43 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from conftest import upload_csv
+
+
+def test_rank_extremes_pages_and_rejects_negative_bounds(hr_app):
+    top, bottom = hr_app.rank_extremes(np.arange(20.), 5, 10)
+    assert top.tolist() == [9, 8, 7, 6, 5]
+    assert bottom.tolist() == [10, 11, 12, 13, 14]
+    for k, offset in ((10, -5), (-3, 0), (0, 0)):
+        with pytest.raises(ValueError):
+            hr_app.rank_extremes(np.arange(20.), k, offset)
+
+
+@pytest.fixture
+def query_file(client, auth_headers):
+    frame = pd.DataFrame({'الإدارة': [f'إدارة {i % 8}' for i in range(80)],
+                          'درجة الاداء الحالية': [1 + (i % 8) * 0.5 for i in range(80)]})
+    uploaded = upload_csv(client, auth_headers, frame, name='query.csv')
+    return uploaded['file_id'], uploaded['sheets'][0]
+
+
+def test_query_pages_match_the_full_ranking(client, auth_headers, query_file):
+    file_id, sheet = query_file
+    full = client.post('/query', json={'file_id': file_id, 'sheet': sheet, 'top_n': 8}, headers=auth_headers)
+    page = client.post('/query', json={'file_id': file_id, 'sheet': sheet, 'top_n': 3, 'offset': 2},
+                       headers=auth_headers)
+    assert full.status_code == page.status_code == 200
+    assert page.get_json()['top_departments'] == full.get_json()['top_departments'][2:5]
+
+
+@pytest.mark.parametrize('paging', [{'offset': -5}, {'top_n': -1}, {'top_n': 0}, {'top_n': 101}, {'top_n': 'ten'}])
+def test_query_rejects_bad_paging(client, auth_headers, query_file, paging):
+    file_id, sheet = query_file
+    response = client.post('/query', json={'file_id': file_id, 'sheet': sheet, **paging}, headers=auth_headers)
+    assert response.status_code == 400
+
+
+def test_query_without_json_body_is_not_a_server_error(client, auth_headers):
+    response = client.post('/query', data='not json', headers=auth_headers)
+    assert response.status_code == 404
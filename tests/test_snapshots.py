@@ -0,0 +1,73 @@
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from conftest import upload_csv, wait_for
+
+PLANTED = []
+
+
+def plant(marker):
+    PLANTED.append(marker)
+
+
+class Payload:
+    def __reduce__(self):
+        return plant, ('unpickled',)
+
+
+def store(hr_app, tmp_path, file_id='0123456789abcdef'):
+    snapshots = hr_app.SnapshotStore(str(tmp_path), 1 << 30, timedelta(hours=1))
+    os.makedirs(os.path.join(tmp_path, file_id, 'frames'))
+    return snapshots, file_id
+
+
+def test_frame_round_trip_keeps_text_dictionary_in_json(hr_app, tmp_path):
+    snapshots, file_id = store(hr_app, tmp_path)
+    frame = pd.DataFrame({
+        'الإدارة': pd.Series(['إدارة 1', None, 'إدارة 2', 'إدارة 1'], dtype='str'),
+        'mixed': pd.Series(['ممتاز', 4, np.nan, 3.5], dtype=object),
+        'score': [1.0, 2.5, np.nan, 4.0],
+    })
+    snapshots.save_frame(file_id, 'Sheet1', frame)
+
+    frame_dir = os.path.join(tmp_path, file_id, 'frames', snapshots._sheet_key('Sheet1'))
+    assert sorted(name for name in os.listdir(frame_dir) if 'values' in name) == ['0.values.json', '1.values.json']
+    pd.testing.assert_frame_equal(snapshots.load_frame(file_id, 'Sheet1'), frame)
+    pd.testing.assert_frame_equal(snapshots.load_frame(file_id, 'Sheet1', ['score']), frame[['score']])
+
+
+def test_planted_pickle_is_never_loaded(hr_app, tmp_path):
+    snapshots, file_id = store(hr_app, tmp_path)
+    snapshots.save_frame(file_id, 'Sheet1', pd.DataFrame({'name': ['a', 'b', 'a']}))
+    frame_dir = os.path.join(tmp_path, file_id, 'frames', snapshots._sheet_key('Sheet1'))
+    with open(os.path.join(frame_dir, '0.values.json'), 'wb') as f:
+        np.save(f, np.array([Payload()], dtype=object), allow_pickle=True)
+
+    assert snapshots.load_frame(file_id, 'Sheet1') is None
+    assert PLANTED == []
+
+
+def test_columns_of_arbitrary_objects_are_not_snapshotted(hr_app, tmp_path):
+    snapshots, file_id = store(hr_app, tmp_path)
+    snapshots.save_frame(file_id, 'Sheet1', pd.DataFrame({'when': pd.Series([datetime(2024, 1, 1), 'x'])}))
+    assert not snapshots.has_frame(file_id, 'Sheet1')
+
+
+def test_expired_file_snapshot_is_removed_outside_the_lock(client, auth_headers, hr_app):
+    frame = pd.DataFrame({'الإدارة': [f'إدارة {i % 3}' for i in range(30)],
+                          'درجة الاداء الحالية': np.arange(30) % 5 + 1})
+    uploaded = upload_csv(client, auth_headers, frame, name='expiring.csv')
+    file_id = uploaded['file_id']
+    snapshot_dir = os.path.join(hr_app.SNAPSHOT_DIR, file_id)
+    assert wait_for(lambda: hr_app.snapshots.has_result(file_id, uploaded['sheets'][0]))
+
+    with hr_app.lock:
+        assert hr_app.reap_file(file_id, datetime.now() + timedelta(days=1))
+        assert os.path.isdir(snapshot_dir)  # still there while the global lock is held
+    hr_app.reaper.run_deferred()
+
+    assert wait_for(lambda: not os.path.exists(snapshot_dir))
+    assert not hr_app.file_available(file_id)